@@ -0,0 +1,285 @@
+/* Optional compiled kernel for hyperminhash.py
+ *
+ * Provides MurmurHash3_x64_128 (seed 0, identical to mmh3.hash64 modulo 2^64) over
+ * fixed-length records and over concatenated variable-length keys, and the dense
+ * bucket update of HyperMinHash.update_hashes. All functions work on buffers (NumPy
+ * arrays or bytes) and release the GIL while they run, so that several threads can
+ * hash and insert batches in parallel. Build with: python3 build_kernel.py
+ */
+#define PY_SSIZE_T_CLEAN
+#include <Python.h>
+#include <stdint.h>
+#include <string.h>
+
+#define C1 0x87c37b91114253d5ULL
+#define C2 0x4cf5ad432745937fULL
+
+static inline uint64_t rotl64(uint64_t x, int r) {
+    return (x << r) | (x >> (64 - r));
+}
+
+static inline uint64_t fmix64(uint64_t k) {
+    k ^= k >> 33;
+    k *= 0xff51afd7ed558ccdULL;
+    k ^= k >> 33;
+    k *= 0xc4ceb9fe1a85ec53ULL;
+    k ^= k >> 33;
+    return k;
+}
+
+static inline uint64_t bit_length64(uint64_t x) {
+#if defined(__GNUC__)
+    return x ? 64 - (uint64_t)__builtin_clzll(x) : 0;
+#else
+    uint64_t n = 0;
+    for (; x; x >>= 1)
+        n++;
+    return n;
+#endif
+}
+
+static inline uint64_t load64(const uint8_t *p) {
+    uint64_t k;
+    memcpy(&k, p, 8);
+#if defined(__BYTE_ORDER__) && __BYTE_ORDER__ == __ORDER_BIG_ENDIAN__
+    k = __builtin_bswap64(k);
+#endif
+    return k;
+}
+
+static void murmur3_x64_128(const uint8_t *data, Py_ssize_t length, uint64_t *out1, uint64_t *out2) {
+    Py_ssize_t nblocks = length / 16;
+    uint64_t h1 = 0, h2 = 0, k1, k2;
+    const uint8_t *tail = data + 16 * nblocks;
+    for (Py_ssize_t b = 0; b < nblocks; b++) {
+        k1 = load64(data + 16 * b);
+        k2 = load64(data + 16 * b + 8);
+        k1 *= C1; k1 = rotl64(k1, 31); k1 *= C2; h1 ^= k1;
+        h1 = rotl64(h1, 27); h1 += h2; h1 = h1 * 5 + 0x52dce729;
+        k2 *= C2; k2 = rotl64(k2, 33); k2 *= C1; h2 ^= k2;
+        h2 = rotl64(h2, 31); h2 += h1; h2 = h2 * 5 + 0x38495ab5;
+    }
+    k1 = k2 = 0;
+    switch (length & 15) {
+    case 15: k2 ^= (uint64_t)tail[14] << 48; /* fall through */
+    case 14: k2 ^= (uint64_t)tail[13] << 40; /* fall through */
+    case 13: k2 ^= (uint64_t)tail[12] << 32; /* fall through */
+    case 12: k2 ^= (uint64_t)tail[11] << 24; /* fall through */
+    case 11: k2 ^= (uint64_t)tail[10] << 16; /* fall through */
+    case 10: k2 ^= (uint64_t)tail[9] << 8; /* fall through */
+    case 9:
+        k2 ^= (uint64_t)tail[8];
+        k2 *= C2; k2 = rotl64(k2, 33); k2 *= C1; h2 ^= k2;
+        /* fall through */
+    case 8: k1 ^= (uint64_t)tail[7] << 56; /* fall through */
+    case 7: k1 ^= (uint64_t)tail[6] << 48; /* fall through */
+    case 6: k1 ^= (uint64_t)tail[5] << 40; /* fall through */
+    case 5: k1 ^= (uint64_t)tail[4] << 32; /* fall through */
+    case 4: k1 ^= (uint64_t)tail[3] << 24; /* fall through */
+    case 3: k1 ^= (uint64_t)tail[2] << 16; /* fall through */
+    case 2: k1 ^= (uint64_t)tail[1] << 8; /* fall through */
+    case 1:
+        k1 ^= (uint64_t)tail[0];
+        k1 *= C1; k1 = rotl64(k1, 31); k1 *= C2; h1 ^= k1;
+    }
+    h1 ^= (uint64_t)length;
+    h2 ^= (uint64_t)length;
+    h1 += h2;
+    h2 += h1;
+    h1 = fmix64(h1);
+    h2 = fmix64(h2);
+    h1 += h2;
+    h2 += h1;
+    *out1 = h1;
+    *out2 = h2;
+}
+
+/* Checks that view holds count items of itemsize bytes */
+static int check_view(Py_buffer *view, Py_ssize_t count, Py_ssize_t itemsize, const char *name) {
+    if (view->len != count * itemsize) {
+        PyErr_Format(PyExc_ValueError, "%s must hold %zd items of %zd bytes", name, count, itemsize);
+        return 0;
+    }
+    return 1;
+}
+
+PyDoc_STRVAR(murmur3_records_doc,
+"murmur3_records(records, length, h1, h2)\n\n"
+"Hashes the consecutive records of length bytes in the buffer records, writing the\n"
+"two 64-bit halves of every hash to the uint64 buffers h1 and h2.");
+
+static PyObject *murmur3_records(PyObject *self, PyObject *args) {
+    Py_buffer records, h1, h2;
+    Py_ssize_t length, n;
+    if (!PyArg_ParseTuple(args, "y*nw*w*", &records, &length, &h1, &h2))
+        return NULL;
+    PyObject *result = NULL;
+    n = h1.len / 8;
+    if (length < 0 || records.len != n * length) {
+        PyErr_SetString(PyExc_ValueError, "records must hold one record of length bytes per hash");
+        goto done;
+    }
+    if (!check_view(&h1, n, 8, "h1") || !check_view(&h2, n, 8, "h2"))
+        goto done;
+    Py_BEGIN_ALLOW_THREADS
+    const uint8_t *data = records.buf;
+    uint64_t *out1 = h1.buf, *out2 = h2.buf;
+    for (Py_ssize_t k = 0; k < n; k++)
+        murmur3_x64_128(data + k * length, length, out1 + k, out2 + k);
+    Py_END_ALLOW_THREADS
+    Py_INCREF(Py_None);
+    result = Py_None;
+done:
+    PyBuffer_Release(&records);
+    PyBuffer_Release(&h1);
+    PyBuffer_Release(&h2);
+    return result;
+}
+
+PyDoc_STRVAR(murmur3_keys_doc,
+"murmur3_keys(data, offsets, h1, h2)\n\n"
+"Hashes the keys data[offsets[k]:offsets[k + 1]] of the concatenated keys data, for\n"
+"the int64 buffer offsets of n + 1 elements, writing the two 64-bit halves of every\n"
+"hash to the uint64 buffers h1 and h2 of n elements.");
+
+static PyObject *murmur3_keys(PyObject *self, PyObject *args) {
+    Py_buffer data, offsets, h1, h2;
+    if (!PyArg_ParseTuple(args, "y*y*w*w*", &data, &offsets, &h1, &h2))
+        return NULL;
+    PyObject *result = NULL;
+    Py_ssize_t n = h1.len / 8;
+    if (!check_view(&offsets, n + 1, 8, "offsets") || !check_view(&h1, n, 8, "h1") || !check_view(&h2, n, 8, "h2"))
+        goto done;
+    const int64_t *off = offsets.buf;
+    for (Py_ssize_t k = 0; k < n; k++) {
+        if (off[k] < 0 || off[k + 1] < off[k] || off[k + 1] > data.len) {
+            PyErr_SetString(PyExc_ValueError, "offsets must be non-decreasing and within data");
+            goto done;
+        }
+    }
+    Py_BEGIN_ALLOW_THREADS
+    const uint8_t *bytes = data.buf;
+    uint64_t *out1 = h1.buf, *out2 = h2.buf;
+    for (Py_ssize_t k = 0; k < n; k++)
+        murmur3_x64_128(bytes + off[k], off[k + 1] - off[k], out1 + k, out2 + k);
+    Py_END_ALLOW_THREADS
+    Py_INCREF(Py_None);
+    result = Py_None;
+done:
+    PyBuffer_Release(&data);
+    PyBuffer_Release(&offsets);
+    PyBuffer_Release(&h1);
+    PyBuffer_Release(&h2);
+    return result;
+}
+
+/* Inserts every hash into the buckets: the largest val wins, ties broken by the smallest aug */
+#define UPDATE_LOOP(BBIT_TYPE)                                                  \
+    do {                                                                        \
+        BBIT_TYPE *bbit = bbit_view.buf;                                        \
+        for (Py_ssize_t k = 0; k < n; k++) {                                    \
+            uint64_t yk = y[k], h2k = h2[k];                                    \
+            uint64_t val = 65 - bit_length64(yk);                               \
+            if (val > maxval)                                                   \
+                val = maxval;                                                   \
+            uint64_t i = shift >= 64 ? 0 : h2k >> shift;                        \
+            BBIT_TYPE aug = (BBIT_TYPE)(h2k & mask);                            \
+            if (val > hll[i] || (val == hll[i] && aug < bbit[i])) {             \
+                if (hist && hll[i] <= maxval) {                                 \
+                    hist[hll[i]]--;                                             \
+                    hist[val]++;                                                \
+                }                                                               \
+                hll[i] = (uint8_t)val;                                          \
+                bbit[i] = aug;                                                  \
+                if (!changed) {                                                 \
+                    replaced++;                                                 \
+                } else if (!(changed[i >> 3] & (1 << (i & 7)))) {               \
+                    changed[i >> 3] |= (uint8_t)(1 << (i & 7));                 \
+                    replaced++;                                                 \
+                }                                                               \
+            }                                                                   \
+        }                                                                       \
+    } while (0)
+
+PyDoc_STRVAR(update_buckets_doc,
+"update_buckets(y, h2, hll, bbit, bbit_itemsize, histogram, maxval, shift, mask, distinct=False)\n\n"
+"Inserts the hashes given by the uint64 buffers y and h2 into the uint8 buffer hll\n"
+"and the unsigned buffer bbit (of bbit_itemsize = 1, 2, 4 or 8 byte items), with the rules of\n"
+"HyperMinHash.triples_from_hashes and update_triples. histogram is None or an int64\n"
+"buffer of maxval + 1 register counts, kept up to date. Returns the number of bucket\n"
+"replacements or, if distinct is true, the number of distinct buckets changed, which\n"
+"takes a temporary bitmap of the buckets.");
+
+static PyObject *update_buckets(PyObject *self, PyObject *args) {
+    Py_buffer y_view, h2_view, hll_view, bbit_view, hist_view;
+    PyObject *hist_obj;
+    Py_ssize_t itemsize;
+    unsigned long long maxval, shift, mask;
+    int distinct = 0;
+    if (!PyArg_ParseTuple(args, "y*y*w*w*nOKKK|p", &y_view, &h2_view, &hll_view, &bbit_view, &itemsize, &hist_obj, &maxval, &shift, &mask, &distinct))
+        return NULL;
+    PyObject *result = NULL;
+    uint8_t *changed = NULL;
+    int has_hist = 0;
+    Py_ssize_t n = y_view.len / 8;
+    Py_ssize_t buckets = hll_view.len;
+    if (hist_obj != Py_None) {
+        if (PyObject_GetBuffer(hist_obj, &hist_view, PyBUF_WRITABLE | PyBUF_C_CONTIGUOUS) < 0)
+            goto done;
+        has_hist = 1;
+        if (!check_view(&hist_view, (Py_ssize_t)maxval + 1, 8, "histogram"))
+            goto done;
+    }
+    if (!check_view(&y_view, n, 8, "y") || !check_view(&h2_view, n, 8, "h2") || !check_view(&hll_view, buckets, 1, "hll"))
+        goto done;
+    if ((itemsize != 1 && itemsize != 2 && itemsize != 4 && itemsize != 8) || bbit_view.len != buckets * itemsize) {
+        PyErr_SetString(PyExc_ValueError, "bbit must hold one 1, 2, 4 or 8 byte item per bucket");
+        goto done;
+    }
+    if (maxval > 64 || ((shift >= 64 ? 1 : (unsigned long long)1 << (64 - shift)) != (unsigned long long)buckets)) {
+        PyErr_SetString(PyExc_ValueError, "hll must hold 2^(64 - shift) buckets and maxval cannot exceed 64");
+        goto done;
+    }
+    if (distinct && !(changed = PyMem_Calloc((size_t)buckets / 8 + 1, 1))) {
+        PyErr_NoMemory();
+        goto done;
+    }
+    Py_ssize_t replaced = 0;
+    Py_BEGIN_ALLOW_THREADS
+    const uint64_t *y = y_view.buf, *h2 = h2_view.buf;
+    uint8_t *hll = hll_view.buf;
+    int64_t *hist = has_hist ? hist_view.buf : NULL;
+    switch (itemsize) {
+    case 1: UPDATE_LOOP(uint8_t); break;
+    case 2: UPDATE_LOOP(uint16_t); break;
+    case 4: UPDATE_LOOP(uint32_t); break;
+    default: UPDATE_LOOP(uint64_t); break;
+    }
+    Py_END_ALLOW_THREADS
+    result = PyLong_FromSsize_t(replaced);
+done:
+    PyMem_Free(changed);
+    if (has_hist)
+        PyBuffer_Release(&hist_view);
+    PyBuffer_Release(&y_view);
+    PyBuffer_Release(&h2_view);
+    PyBuffer_Release(&hll_view);
+    PyBuffer_Release(&bbit_view);
+    return result;
+}
+
+static PyMethodDef kernel_methods[] = {
+    {"murmur3_records", murmur3_records, METH_VARARGS, murmur3_records_doc},
+    {"murmur3_keys", murmur3_keys, METH_VARARGS, murmur3_keys_doc},
+    {"update_buckets", update_buckets, METH_VARARGS, update_buckets_doc},
+    {NULL, NULL, 0, NULL}
+};
+
+static struct PyModuleDef kernel_module = {
+    PyModuleDef_HEAD_INIT, "_hyperminhash_kernel",
+    "Optional compiled hashing and bucket update kernel for hyperminhash", -1, kernel_methods
+};
+
+PyMODINIT_FUNC PyInit__hyperminhash_kernel(void) {
+    return PyModule_Create(&kernel_module);
+}
@@ -0,0 +1,50 @@
+#!/usr/bin/env python3
+'''Compares the error and latency of the classic and improved count() estimators
+
+For cardinalities spread over the small range, the HLL/linear counting transition and
+the HLL/MinHash switch at 2^(bucketbits + 10), reports the mean relative error, the
+relative RMSE and the mean count() latency of each estimator.
+'''
+import argparse
+import os
+import sys
+import time
+dir_path = os.path.dirname(os.path.realpath(__file__))
+sys.path.insert(0, os.path.dirname(dir_path))
+import numpy as np  # noqa: E402
+from hyperminhash import HyperMinHash  # noqa: E402
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--params", type=int, nargs=3, default=[10, 6, 10], metavar=("BUCKETBITS", "BUCKETSIZE", "SUBBUCKETSIZE"))
+    parser.add_argument("--reps", type=int, default=20)
+    parser.add_argument("--max-log2", type=int, default=None, help="largest cardinality, as a power of two (default bucketbits + 12)")
+    parser.add_argument("--seed", type=int, default=314159)
+    args = parser.parse_args()
+
+    bucketbits = args.params[0]
+    max_log2 = args.max_log2 if args.max_log2 is not None else bucketbits + 12
+    cardinalities = sorted(set(int(2**x) for x in np.arange(4, max_log2 + 0.01, 0.5)))
+    rng = np.random.default_rng(args.seed)
+    print("Cardinality\tEstimator\tMean rel. error\tRel. RMSE\tcount() (s)")
+    for n in cardinalities:
+        errors = {"classic": [], "improved": []}
+        latency = {"classic": 0., "improved": 0.}
+        for _ in range(args.reps):
+            hmh = HyperMinHash(*args.params, hasher="native")
+            hmh.update(rng.integers(0, 2**63, size=n))
+            for estimator in errors:
+                hmh.invalidate_count()
+                starttime = time.perf_counter()
+                estimate = hmh.count(estimator=estimator)
+                latency[estimator] += time.perf_counter() - starttime
+                errors[estimator].append(estimate / n - 1)
+        for estimator, err in errors.items():
+            err = np.array(err)
+            print("{}\t{}\t{:+.5f}\t{:.5f}\t{:.6f}".format(
+                n, estimator, err.mean(), np.sqrt(np.mean(err**2)), latency[estimator] / args.reps), flush=True)
+
+
+if __name__ == "__main__":
+    main()
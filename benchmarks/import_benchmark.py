@@ -0,0 +1,82 @@
+#!/usr/bin/env python3
+'''Measures the startup cost of importing hyperminhash, against a regression budget
+
+Every run starts a fresh interpreter and reports:
+    total    seconds to import hyperminhash, including NumPy
+    own      seconds to import hyperminhash once NumPy is already loaded, i.e. the cost
+             of the module itself and of what it imports beyond NumPy
+The medians over --runs interpreters are compared against --budget-ms (own) and
+--total-budget-ms (total, unchecked by default). The script also checks that none of
+LAZY_MODULES, which hyperminhash only imports on first use, is loaded by the import.
+It exits with status 1 if a budget is exceeded or a lazy module was loaded.
+With --no-bytecode, the interpreters neither read nor write cached bytecode, as when
+the bytecode cache is missing or not writable, and compiling the source dominates.
+
+    python benchmarks/import_benchmark.py
+    python benchmarks/import_benchmark.py --no-bytecode --budget-ms 30
+'''
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+dir_path = os.path.dirname(os.path.realpath(__file__))
+repo_path = os.path.dirname(dir_path)
+
+# Modules that importing hyperminhash must not load
+LAZY_MODULES = ["asyncio", "sqlite3", "argparse", "gzip", "decimal", "zlib", "lzma", "bz2", "mmh3",
+                "concurrent.futures", "hyperminhash_services", "hyperminhash_cli"]
+
+MEASURE = '''
+import json, sys, time
+starttime = time.perf_counter()
+import numpy
+numpy_time = time.perf_counter() - starttime
+starttime = time.perf_counter()
+import hyperminhash
+own = time.perf_counter() - starttime
+print(json.dumps({{"numpy": numpy_time, "own": own, "loaded": [m for m in {lazy!r} if m in sys.modules]}}))
+'''
+
+
+def run(pycache_prefix=None):
+    '''Returns the measurements of one fresh interpreter, which looks for cached
+    bytecode in pycache_prefix (and writes none) if it is given'''
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join([repo_path] + os.environ.get("PYTHONPATH", "").split(os.pathsep)))
+    command = [sys.executable]
+    if pycache_prefix is not None:
+        command += ["-B", "-X", "pycache_prefix=" + pycache_prefix]
+    command += ["-c", MEASURE.format(lazy=LAZY_MODULES)]
+    return json.loads(subprocess.run(command, env=env, check=True, stdout=subprocess.PIPE).stdout)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--runs", type=int, default=20)
+    parser.add_argument("--budget-ms", type=float, default=10., help="budget for the median own import time")
+    parser.add_argument("--total-budget-ms", type=float, default=None, help="budget for the median total import time")
+    parser.add_argument("--no-bytecode", action="store_true", help="do not use cached bytecode")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as empty:
+        runs = [run(empty if args.no_bytecode else None) for _ in range(args.runs)]
+    own = statistics.median(r["own"] for r in runs)
+    total = statistics.median(r["numpy"] + r["own"] for r in runs)
+    loaded = sorted(set(m for r in runs for m in r["loaded"]))
+    print("Metric\tMedian (ms)\tBudget (ms)")
+    print("own\t{:.2f}\t{}".format(own * 1e3, args.budget_ms))
+    print("total\t{:.2f}\t{}".format(total * 1e3, args.total_budget_ms))
+    print("Lazy modules loaded:\t{}".format(", ".join(loaded) or "none"))
+
+    failed = bool(loaded) or own * 1e3 > args.budget_ms
+    if args.total_budget_ms is not None and total * 1e3 > args.total_budget_ms:
+        failed = True
+    if failed:
+        print("Import startup regression", file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
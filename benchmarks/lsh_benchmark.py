@@ -0,0 +1,71 @@
+#!/usr/bin/env python3
+'''Benchmarks LSHIndex against a brute-force scan with HyperMinHash.jaccard
+
+Reports index build time, mean query latency and recall at several Jaccard thresholds.
+'''
+import argparse
+import os
+import sys
+import time
+dir_path = os.path.dirname(os.path.realpath(__file__))
+sys.path.insert(0, os.path.dirname(dir_path))
+import numpy as np  # noqa: E402
+from hyperminhash import HyperMinHash, LSHIndex  # noqa: E402
+
+
+def make_sketches(num_sketches, family_size, base_size, params, rng):
+    '''Returns num_sketches sketches in families of family_size members, where members of
+    a family are random subsets of a shared base set, so Jaccard indices spread over [0, 1]'''
+    sketches = []
+    for family in range(num_sketches // family_size):
+        base = np.arange(base_size) + family * base_size
+        for _ in range(family_size):
+            keep = rng.random() * 0.8 + 0.2
+            hmh = HyperMinHash(*params, collision_correction="false")
+            hmh.update(base[rng.random(base_size) < keep])
+            sketches.append(hmh)
+    return sketches
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--sketches", type=int, default=2000)
+    parser.add_argument("--queries", type=int, default=50)
+    parser.add_argument("--params", type=int, nargs=3, default=[8, 6, 10], metavar=("BUCKETBITS", "BUCKETSIZE", "SUBBUCKETSIZE"))
+    parser.add_argument("--rows-per-band", type=int, nargs="+", default=[2, 4, 8])
+    parser.add_argument("--thresholds", type=float, nargs="+", default=[0.3, 0.5, 0.7, 0.9])
+    parser.add_argument("--seed", type=int, default=314159)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(args.seed)
+    sketches = make_sketches(args.sketches, 10, 2000, tuple(args.params), rng)
+    queries = [sketches[i] for i in rng.choice(len(sketches), size=args.queries, replace=False)]
+
+    starttime = time.time()
+    truth = {t: [] for t in args.thresholds}
+    for query in queries:
+        scores = np.array([query.jaccard(other) for other in sketches])
+        for t in args.thresholds:
+            truth[t].append(set(np.nonzero(scores >= t)[0]))
+    brute_time = (time.time() - starttime) / len(queries)
+    print("Brute force:\tquery (s):\t{:.6f}".format(brute_time))
+
+    for rows_per_band in args.rows_per_band:
+        index = LSHIndex(*args.params, rows_per_band=rows_per_band)
+        starttime = time.time()
+        for key, sketch in enumerate(sketches):
+            index.insert(key, sketch)
+        build_time = time.time() - starttime
+        for t in args.thresholds:
+            starttime = time.time()
+            found = [set(key for key, _ in index.query(query, t)) for query in queries]
+            query_time = (time.time() - starttime) / len(queries)
+            relevant = sum(len(x) for x in truth[t])
+            hits = sum(len(x & y) for x, y in zip(truth[t], found))
+            recall = hits / relevant if relevant else 1.
+            print("Rows per band:\t{}\t|\tBuild (s):\t{:.3f}\t|\tThreshold:\t{}\t|\tQuery (s):\t{:.6f}\t|\tRecall:\t{:.4f}".format(
+                rows_per_band, build_time, t, query_time, recall), flush=True)
+
+
+if __name__ == "__main__":
+    main()
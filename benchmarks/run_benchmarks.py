@@ -0,0 +1,162 @@
+#!/usr/bin/env python3
+'''Runs the HyperMinHash performance benchmark suite and writes the results as JSON
+
+For every parameter set (bucketbits-bucketsize-subbucketsize), two overlapping sketches
+are built and the following are measured:
+    update_str / update_native    items per second inserted by update, per hasher
+    add, serialize, deserialize,
+    count, jaccard, intersection  latency in seconds of one call (best of --repeat)
+    peak_memory                   peak bytes allocated (tracemalloc) while building the
+                                  sketches and running the operations above
+The defaults cover the parameter sets used in the paper (6-4-4, 6-0-8, 5-0-16) and
+larger production ones (14-6-10, 16-6-10).
+
+With --baseline, the results are compared against an earlier results file, and the
+script exits with status 1 if any throughput dropped, or any latency or peak memory
+rose, by more than --tolerance (relative). benchmarks/baseline.json is the tracked
+baseline, recorded with the default options and without the compiled kernel; absolute
+numbers depend on the machine, so regenerate it on the machine that runs the
+comparison (and commit it when a change is meant to move the numbers).
+
+    python benchmarks/run_benchmarks.py -o results.json
+    python benchmarks/run_benchmarks.py -o new.json --baseline benchmarks/baseline.json
+'''
+import argparse
+import json
+import os
+import platform
+import sys
+import time
+import tracemalloc
+dir_path = os.path.dirname(os.path.realpath(__file__))
+sys.path.insert(0, os.path.dirname(dir_path))
+import numpy as np  # noqa: E402
+import hyperminhash  # noqa: E402
+from hyperminhash import HyperMinHash  # noqa: E402
+
+DEFAULT_PARAMS = ["6-4-4", "6-0-8", "5-0-16", "14-6-10", "16-6-10"]
+# Metrics where larger is better; every other metric is a latency or a size
+THROUGHPUT_METRICS = {"update_str", "update_native"}
+
+
+def best_time(fn, repeat, number=1):
+    '''Returns the smallest mean time of number calls of fn, over repeat runs'''
+    best = float('Inf')
+    for _ in range(repeat):
+        starttime = time.perf_counter()
+        for _ in range(number):
+            fn()
+        best = min(best, (time.perf_counter() - starttime) / number)
+    return best
+
+
+def bench_params(params, items, repeat):
+    '''Returns a dict of metric: value for one parameter set'''
+    bucketbits, bucketsize, subbucketsize = params
+    rng = np.random.default_rng(314159)
+    x_items = rng.integers(0, 2**63, size=items)
+    y_items = np.concatenate((x_items[:items // 2], rng.integers(0, 2**63, size=items - items // 2)))
+    x_floats = list(rng.random(items))
+    results = dict()
+
+    tracemalloc.start()
+
+    def build(hasher, l):
+        # The approx collision correction rejects cardinalities this large for the paper's small sketches
+        hmh = HyperMinHash(bucketbits, bucketsize, subbucketsize, collision_correction="precise", hasher=hasher)
+        hmh.update(l)
+        return hmh
+    results["update_str"] = items / best_time(lambda: build("str", x_floats), repeat)
+    results["update_native"] = items / best_time(lambda: build("native", x_items), repeat)
+
+    hmx, hmy = build("native", x_items), build("native", y_items)
+    data = hmx.serialize()
+
+    def count():
+        hmx.invalidate_count()
+        return hmx.count()
+
+    def pair_op(fn):
+        def op():
+            hmx.invalidate_count()
+            hmy.invalidate_count()
+            return fn(hmy)
+        return op
+    # Warm up lazily built tables (e.g. the collision table) before timing
+    hmx.intersection(hmy)
+    results["add"] = best_time(lambda: hmx + hmy, repeat, number=10)
+    results["serialize"] = best_time(hmx.serialize, repeat, number=10)
+    results["deserialize"] = best_time(lambda: HyperMinHash.deserialize(data), repeat, number=10)
+    results["count"] = best_time(count, repeat, number=10)
+    results["jaccard"] = best_time(pair_op(hmx.jaccard), repeat, number=10)
+    results["intersection"] = best_time(pair_op(hmx.intersection), repeat, number=10)
+
+    results["peak_memory"] = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return results
+
+
+def compare(results, baseline, tolerance):
+    '''Prints a comparison of results against baseline, returning the list of regressions'''
+    regressions = []
+    print("Params\tMetric\tBaseline\tCurrent\tChange")
+    for name, metrics in results["results"].items():
+        for metric, value in metrics.items():
+            old = baseline.get("results", {}).get(name, {}).get(metric)
+            if old is None or old == 0:
+                continue
+            change = value / old - 1
+            if metric in THROUGHPUT_METRICS:
+                regressed = change < -tolerance
+            else:
+                regressed = change > tolerance
+            print("{}\t{}\t{:.6g}\t{:.6g}\t{:+.1%}{}".format(name, metric, old, value, change, "\tREGRESSION" if regressed else ""))
+            if regressed:
+                regressions.append((name, metric))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("-o", "--output", default=None, help="JSON file to write the results to")
+    parser.add_argument("--params", nargs="+", default=DEFAULT_PARAMS, help="parameter sets as bucketbits-bucketsize-subbucketsize")
+    parser.add_argument("--items", type=int, default=2**18, help="items inserted into each sketch")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--baseline", default=None, help="JSON results file to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="relative change counted as a regression")
+    args = parser.parse_args()
+
+    results = {
+        "meta": {
+            "python": platform.python_version(),
+            "numpy": np.__version__,
+            "platform": platform.platform(),
+            "items": args.items,
+            "repeat": args.repeat,
+            "kernel": hyperminhash._kernel is not None,
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        },
+        "results": dict(),
+    }
+    for name in args.params:
+        params = tuple(int(p) for p in name.split("-"))
+        results["results"][name] = bench_params(params, args.items, args.repeat)
+        print("{}\t{}".format(name, json.dumps(results["results"][name])), file=sys.stderr, flush=True)
+
+    if args.output is not None:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+    if args.baseline is not None:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        for key in ["kernel", "items", "platform"]:
+            if baseline.get("meta", {}).get(key) != results["meta"][key]:
+                print("Warning: baseline was recorded with {} = {}".format(key, baseline.get("meta", {}).get(key)), file=sys.stderr)
+        regressions = compare(results, baseline, args.tolerance)
+        if regressions:
+            print("{} regression(s) beyond {:.0%}".format(len(regressions), args.tolerance), file=sys.stderr)
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
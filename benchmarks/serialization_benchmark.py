@@ -0,0 +1,48 @@
+#!/usr/bin/env python3
+'''Compares the size and speed of the packed and compressed serialization formats
+
+For sketches filled to a range of cardinalities, reports the serialized size in bytes
+and the mean serialize and deserialize latency of the original fixed-width format and
+of every codec in COMPRESSORS.
+'''
+import argparse
+import os
+import sys
+import time
+dir_path = os.path.dirname(os.path.realpath(__file__))
+sys.path.insert(0, os.path.dirname(dir_path))
+import numpy as np  # noqa: E402
+from hyperminhash import HyperMinHash, COMPRESSORS  # noqa: E402
+
+
+def timed(fn, reps):
+    '''Returns (result, mean seconds) of calling fn reps times'''
+    starttime = time.perf_counter()
+    for _ in range(reps):
+        result = fn()
+    return result, (time.perf_counter() - starttime) / reps
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--params", type=int, nargs=3, default=[14, 6, 10], metavar=("BUCKETBITS", "BUCKETSIZE", "SUBBUCKETSIZE"))
+    parser.add_argument("--cardinalities", type=int, nargs="+", default=[10**3, 10**4, 10**5, 10**6, 10**7])
+    parser.add_argument("--reps", type=int, default=20)
+    parser.add_argument("--seed", type=int, default=314159)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(args.seed)
+    print("Cardinality\tFormat\tBytes\tRatio\tserialize (s)\tdeserialize (s)")
+    for n in args.cardinalities:
+        hmh = HyperMinHash(*args.params, hasher="native")
+        hmh.update(rng.integers(0, 2**63, size=n))
+        baseline = len(hmh.serialize())
+        for compression in [None] + sorted(COMPRESSORS):
+            data, encode = timed(lambda: hmh.serialize(compression=compression), args.reps)
+            _, decode = timed(lambda: HyperMinHash.deserialize(data), args.reps)
+            print("{}\t{}\t{}\t{:.3f}\t{:.6f}\t{:.6f}".format(
+                n, compression or "packed", len(data), len(data) / baseline, encode, decode), flush=True)
+
+
+if __name__ == "__main__":
+    main()
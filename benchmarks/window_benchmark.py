@@ -0,0 +1,57 @@
+#!/usr/bin/env python3
+'''Measures the update cost, memory and query latency of WindowedHyperMinHash
+
+Streams a fixed number of items per epoch through a windowed sketch and a plain
+HyperMinHash, and reports the update throughput of both, the memory of the ring of
+sub-sketches, and the latency and relative error of count() over several trailing
+windows (first and repeated queries, the latter using the cached union of past epochs).
+'''
+import argparse
+import os
+import sys
+import time
+dir_path = os.path.dirname(os.path.realpath(__file__))
+sys.path.insert(0, os.path.dirname(dir_path))
+import numpy as np  # noqa: E402
+from hyperminhash import HyperMinHash, WindowedHyperMinHash  # noqa: E402
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--params", type=int, nargs=3, default=[14, 6, 10], metavar=("BUCKETBITS", "BUCKETSIZE", "SUBBUCKETSIZE"))
+    parser.add_argument("--epochs", type=int, default=60)
+    parser.add_argument("--items-per-epoch", type=int, default=10**5)
+    parser.add_argument("--seed", type=int, default=314159)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(args.seed)
+    batches = [rng.integers(0, 2**63, size=args.items_per_epoch) for _ in range(args.epochs)]
+    windowed = WindowedHyperMinHash(*args.params, epochs=args.epochs, hasher="native")
+    plain = HyperMinHash(*args.params, hasher="native")
+    windowed_time = plain_time = 0.
+    for epoch, batch in enumerate(batches):
+        starttime = time.perf_counter()
+        windowed.update(batch, epoch=epoch)
+        windowed_time += time.perf_counter() - starttime
+        starttime = time.perf_counter()
+        plain.update(batch)
+        plain_time += time.perf_counter() - starttime
+    total = args.epochs * args.items_per_epoch
+    print("Sketch\tItems/s\tBytes")
+    print("HyperMinHash\t{:.0f}\t{}".format(total / plain_time, plain.nbytes))
+    print("WindowedHyperMinHash\t{:.0f}\t{}".format(total / windowed_time, windowed.nbytes))
+    print()
+    print("Window (epochs)\tTrue cardinality\tRel. error\tFirst count() (s)\tRepeated count() (s)")
+    for window in sorted(set([1, 5, args.epochs // 2, args.epochs])):
+        truth = len(np.unique(np.concatenate(batches[-window:])))
+        starttime = time.perf_counter()
+        estimate = windowed.count(window)
+        first = time.perf_counter() - starttime
+        starttime = time.perf_counter()
+        windowed.count(window)
+        repeated = time.perf_counter() - starttime
+        print("{}\t{}\t{:+.5f}\t{:.6f}\t{:.6f}".format(window, truth, estimate / truth - 1, first, repeated), flush=True)
+
+
+if __name__ == "__main__":
+    main()
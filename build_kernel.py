@@ -0,0 +1,20 @@
+#!/usr/bin/env python3
+'''Builds the optional compiled kernel, _hyperminhash_kernel.c, next to hyperminhash.py
+
+    python3 build_kernel.py
+
+hyperminhash uses the kernel for hashing and dense bucket updates whenever it can be
+imported, and otherwise falls back to its NumPy code; results are identical either way.
+Building requires setuptools and a C compiler.'''
+import os
+import tempfile
+from setuptools import Extension, setup
+
+dir_path = os.path.dirname(os.path.realpath(__file__))
+
+if __name__ == "__main__":
+    os.chdir(dir_path)
+    with tempfile.TemporaryDirectory() as build_temp:
+        setup(name="_hyperminhash_kernel",
+              ext_modules=[Extension("_hyperminhash_kernel", ["_hyperminhash_kernel.c"])],
+              script_args=["build_ext", "--inplace", "--build-temp", build_temp])
@@ -0,0 +1,206 @@
+#!/usr/bin/env python3
+'''Resumable, fast regeneration of the accuracy experiments of tests_full.py
+
+Runs the same experiment plan as tests_full.py (the same parameter sets, set sizes,
+multiplier ranges and repetitions) and writes the same full_results-* files, which
+error_plot_full.py reads. Instead of hashing random floats one batch at a time, every
+sketch is built in one of three ways (--mode):
+    sampled  draws the final buckets directly from their exact distribution for n
+             distinct uniformly hashed items (see synthetic_sketch), at a cost
+             independent of n; the whole plan runs in seconds
+    hashes   inserts n random 64-bit hash pairs through update_triples in batches
+    items    inserts n random floats through the batched update, as tests_full.py does
+The sketches of X and Y are the unions of a sketch of the intersection with sketches of
+the X-only and Y-only items, which is what inserting the items of X and Y gives.
+hyperminhash_test in hyperminhash_tests.py inserts the Y-only items into the sketch of X
+rather than Y; --y-into-x reproduces that, to match the published full_results-* files.
+
+All cells (run, multiplier, repetition) are computed by one reused worker pool, and every
+completed cell is appended to a checkpoint file, so an interrupted run resumes where it
+stopped when started again with the same --mode and --seed. Every cell has its own
+random stream derived from the seed, so results do not depend on the number of workers.
+The full_results-* files are rewritten from the checkpoint at the end of every run.
+
+    python3 experiments/fast_experiments.py --output-dir experiments_precomputed
+'''
+import argparse
+import json
+import multiprocessing
+import os
+import sys
+import time
+dir_path = os.path.dirname(os.path.realpath(__file__))
+sys.path.insert(0, os.path.dirname(dir_path))
+import numpy as np  # noqa: E402
+from hyperminhash import HyperMinHash  # noqa: E402
+
+# (bucketbits, bucketsize, subbucketsize) of the sketches compared in Figure 6
+PARAMS = [(6, 4, 4), (6, 0, 8), (5, 0, 16)]
+# (x_size, y_size, int_size) of the compared sets; Jaccard indices 1/10, 1/3, 1/2 and 9/10
+SET_SIZES = [(11, 11, 2), (2, 2, 1), (3, 3, 2), (19, 19, 18)]
+# The (test_range, test_reps) of every set size, in the successive stages of tests_full.py
+STAGES = [
+    [(24, 8), (27, 8), (27, 8), (24, 8)],
+    [(23, 8), (26, 8), (26, 8), (23, 8)],
+    [(20, 16), (23, 16), (23, 16), (20, 64)],
+    [(15, 64), (18, 64), (18, 64), (15, 64)],
+]
+
+
+def full_plan(params=PARAMS, max_range=None):
+    '''Returns the list of runs of tests_full.py, as dicts of hmh_test_range arguments'''
+    plan = []
+    for bucketbits, bucketsize, subbucketsize in params:
+        for stage in STAGES:
+            for (x_size, y_size, int_size), (test_range, test_reps) in zip(SET_SIZES, stage):
+                if max_range is not None:
+                    test_range = min(test_range, max_range)
+                plan.append(dict(x_size=x_size, y_size=y_size, int_size=int_size, bucketbits=bucketbits,
+                                 bucketsize=bucketsize, subbucketsize=subbucketsize,
+                                 test_range=test_range, test_reps=test_reps))
+    return plan
+
+
+def synthetic_sketch(n, bucketbits, bucketsize, subbucketsize, collision_correction, rng):
+    '''Returns a sketch distributed exactly like the sketch of n distinct items with
+    independent uniform 64-bit hashes, in time independent of n
+
+    The number of items in every bucket is drawn from a multinomial distribution. The
+    bucket of k items keeps the largest of k (hll, bbit) pairs in the order "larger hll,
+    then smaller bbit", whose distribution function is F**k for the distribution function
+    F of a single pair; it is drawn by inverting F at a uniform quantile raised to 1/k.
+    A single pair has hll >= v with probability 2**(1 - v) for v up to 2**bucketsize.'''
+    hmh = HyperMinHash(bucketbits, bucketsize, subbucketsize, collision_correction=collision_correction)
+    num_buckets = 2**bucketbits
+    k = rng.multinomial(n, np.full(num_buckets, 1. / num_buckets))
+    filled = k > 0
+    k = k[filled]
+    # q is one minus the quantile of a single pair, computed without cancellation
+    q = -np.expm1(np.log1p(-rng.random(len(k))) / k)
+    cap = 2**bucketsize
+    val = np.clip(np.floor(-np.log2(q)).astype(np.int64) + 1, 1, cap)
+    tail = np.exp2(1. - val)
+    next_tail = np.where(val < cap, np.exp2(-val.astype(np.float64)), 0.)
+    # Position within the pairs of value val, from the largest bbit to the smallest
+    within = (tail - q) / (tail - next_tail)
+    aug = 2**subbucketsize - 1 - np.minimum(np.floor(within * 2**subbucketsize), 2**subbucketsize - 1)
+    hll = np.zeros(num_buckets, dtype=hmh._hll_type)
+    bbit = np.zeros(num_buckets, dtype=hmh._subbucket_type)
+    hll[filled] = val
+    bbit[filled] = aug
+    hmh.hll = hll
+    hmh.bbit = bbit
+    return hmh
+
+
+def hashed_sketch(n, bucketbits, bucketsize, subbucketsize, collision_correction, rng, batch_size=2**20):
+    '''Returns the sketch of n random 64-bit hash pairs, inserted in batches'''
+    hmh = HyperMinHash(bucketbits, bucketsize, subbucketsize, collision_correction=collision_correction)
+    for start in range(0, n, batch_size):
+        size = min(batch_size, n - start)
+        y, h2 = rng.integers(0, 2**64, size=(2, size), dtype=np.uint64)
+        hmh.update_triples(*hmh.triples_from_hashes(y, h2))
+    return hmh
+
+
+def item_sketch(n, bucketbits, bucketsize, subbucketsize, collision_correction, rng, batch_size=2**16):
+    '''Returns the sketch of n random floats, inserted with the batched update'''
+    hmh = HyperMinHash(bucketbits, bucketsize, subbucketsize, collision_correction=collision_correction)
+    for start in range(0, n, batch_size):
+        hmh.update(rng.random(min(batch_size, n - start)))
+    return hmh
+
+
+SKETCHERS = {"sampled": synthetic_sketch, "hashes": hashed_sketch, "items": item_sketch}
+
+
+def run_cell(task):
+    '''Computes one (run, multiplier exponent, repetition) cell, returning (cell, result line)'''
+    cell, run, mode, collision_correction, seed, y_into_x = task
+    run_index, exponent, rep = cell
+    rng = np.random.default_rng([seed, run_index, exponent, rep])
+    m = 2**exponent
+    x_size, y_size, int_size = run["x_size"] * m, run["y_size"] * m, run["int_size"] * m
+    params = (run["bucketbits"], run["bucketsize"], run["subbucketsize"], collision_correction, rng)
+    sketch = SKETCHERS[mode]
+    hmi = sketch(int_size, *params)
+    hmx = hmi + sketch(x_size - int_size, *params)
+    if y_into_x:
+        hmx, hmy = hmx + sketch(y_size - int_size, *params), hmi
+    else:
+        hmy = hmi + sketch(y_size - int_size, *params)
+    return cell, [x_size, y_size, int_size] + list(hmx.intersection(hmy))
+
+
+def read_checkpoint(path):
+    '''Returns {cell: result line} of the cells completed in the checkpoint at path'''
+    done = dict()
+    if os.path.exists(path):
+        with open(path) as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue  # A line cut short by an interrupted run
+                done[tuple(record["cell"])] = record["result"]
+    return done
+
+
+def write_results(plan, done, output_dir, prefix, collision_correction):
+    '''Rewrites the full_results-* files from the completed cells, in plan order'''
+    files = dict()
+    for cell in sorted(done):
+        run = plan[cell[0]]
+        if cell[1] >= run["test_range"]:
+            continue  # Completed by an earlier run with a larger --max-range
+        name = '{}_results-{}-{}-{}-{}.txt'.format(prefix, run["bucketbits"], run["bucketsize"], run["subbucketsize"], collision_correction)
+        files.setdefault(name, []).append("\t".join(str(x) for x in done[cell]))
+    for name, lines in files.items():
+        path = os.path.join(output_dir, name)
+        with open(path + ".tmp", "w") as f:
+            f.write("\n".join(lines) + "\n")
+        os.replace(path + ".tmp", path)
+    return sorted(files)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--mode", choices=sorted(SKETCHERS), default="sampled")
+    parser.add_argument("--workers", type=int, default=None, help="worker processes (default: number of CPUs)")
+    parser.add_argument("--seed", type=int, default=314159)
+    parser.add_argument("--output-dir", default=".")
+    parser.add_argument("--prefix", default="full")
+    parser.add_argument("--collision-correction", choices=["approx", "precise", "false"], default="false")
+    parser.add_argument("--y-into-x", action="store_true", help="insert the Y-only items into X, as tests_full.py does")
+    parser.add_argument("--max-range", type=int, default=None, help="cap every test_range, for quicker partial runs")
+    args = parser.parse_args()
+
+    plan = full_plan(max_range=args.max_range)
+    checkpoint = os.path.join(args.output_dir, "{}_checkpoint-{}-{}-{}{}.jsonl".format(
+        args.prefix, args.mode, args.seed, args.collision_correction, "-y-into-x" if args.y_into_x else ""))
+    done = read_checkpoint(checkpoint)
+    tasks = [((run_index, exponent, rep), run, args.mode, args.collision_correction, args.seed, args.y_into_x)
+             for run_index, run in enumerate(plan)
+             for exponent in range(run["test_range"])
+             for rep in range(run["test_reps"])
+             if (run_index, exponent, rep) not in done]
+    print("{} cells done, {} to run".format(len(done), len(tasks)), flush=True)
+
+    starttime = time.time()
+    if tasks:
+        # Large multipliers first, so the slowest cells do not straggle at the end
+        tasks.sort(key=lambda task: -task[0][1])
+        with multiprocessing.Pool(args.workers) as pool, open(checkpoint, "a") as f:
+            if f.tell() > 0:
+                print(file=f)  # Terminates a line cut short by an interrupted run
+            for count, (cell, result) in enumerate(pool.imap_unordered(run_cell, tasks, chunksize=8), 1):
+                done[cell] = result
+                print(json.dumps({"cell": cell, "result": result}), file=f, flush=True)
+                if count % 1000 == 0 or count == len(tasks):
+                    print("Cells:\t{}/{}\t|\tTime (s):\t{:.1f}".format(count, len(tasks), time.time() - starttime), flush=True)
+    for name in write_results(plan, done, args.output_dir, args.prefix, args.collision_correction):
+        print("Wrote", os.path.join(args.output_dir, name))
+
+
+if __name__ == "__main__":
+    main()
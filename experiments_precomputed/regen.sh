@@ -15,5 +15,8 @@ echo
 echo Also, note that that command will append to the full_results-*
 echo files present in this directory. Simply delete the existing 
 echo full_results-* files to regenerate anew.
-
-
+echo
+echo Alternatively, the following resumable command regenerates the
+echo full_results-* files in seconds, from sketches drawn from their exact
+echo distribution \(see its --help\), overwriting rather than appending:
+echo "    python3 ../experiments/fast_experiments.py --y-into-x"
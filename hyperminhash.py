@@ -3,43 +3,306 @@
 import sys
 assert(sys.version_info.major >= 3)
 
-import hashlib
-import mmh3
 import numpy as np
 import math
 import os
 import copy
-import decimal
 import time
 import struct
-import bitstring
+import itertools
+import functools
+import collections
+import importlib
+# Modules needed only by optional features (mmh3, decimal, threading, concurrent.futures
+# and the compression codecs) are imported where they are used, and the keyed services
+# and the command line interface live in sibling modules imported on first access (see
+# _LAZY_ATTRIBUTES), so that importing this module stays cheap for short-lived
+# processes; benchmarks/import_benchmark.py checks this.
+try:
+    import _hyperminhash_kernel as _kernel
+except ImportError:  # The optional compiled kernel is not built; see build_kernel.py
+    _kernel = None
+
+# Attributes of this module defined in sibling modules, by the name of the module
+_LAZY_ATTRIBUTES = {
+    "SketchStore": "hyperminhash_services",
+    "AsyncSketchService": "hyperminhash_services",
+    "read_item_batches": "hyperminhash_cli",
+    "main": "hyperminhash_cli",
+}
+
+
+def __getattr__(name):
+    '''Imports the attributes in _LAZY_ATTRIBUTES on first access'''
+    if name not in _LAZY_ATTRIBUTES:
+        raise AttributeError("module {!r} has no attribute {!r}".format(__name__, name))
+    value = getattr(importlib.import_module(_LAZY_ATTRIBUTES[name]), name)
+    globals()[name] = value
+    return value
+
+
+_UINT64_MASK = 2**64 - 1
+# 2^-k for every value k of a uint8 register
+_NEG_POW2 = np.exp2(-np.arange(256, dtype=np.float64))
+
+
+def _packing_dtype(b):
+    '''Returns the smallest big-endian unsigned NumPy type holding b bits'''
+    for nbytes in (1, 2, 4, 8):
+        if b <= 8 * nbytes:
+            return np.dtype(">u{}".format(nbytes))
+    raise ValueError("Cannot pack integers wider than 64 bits")
 
 
 def packbits(b, L):
-    '''Returns a bytestring corresponding to a packed array of integers, using at most b bits per integer. We prepend with a (b, len(L)) as 64-bit unsigned integers'''
+    '''Returns a bytestring corresponding to a packed array of integers, using at most b bits per integer. We prepend with a (b, len(L)) as 64-bit unsigned integers
+
+    Integers are written most significant bit first, back to back, and the final byte is zero padded.'''
     assert(b <= 64)
+    L = np.asarray(L, dtype=np.uint64)
     params = struct.pack("<2Q", b, len(L))
-    array = bitstring.BitArray()
-    for x in L:
-        array += bitstring.BitArray(uint=x, length=b)
-    if len(array) % 8 != 0:
-        pad = 8 - (len(array) % 8)
-        array += bitstring.BitArray(uint=0, length=pad)
-    return params + array.bytes
+    if b < 64 and np.any(L >> np.uint64(b)):
+        raise ValueError("Integers to pack do not fit in {} bits".format(b))
+    dtype = _packing_dtype(b)
+    width = 8 * dtype.itemsize
+    bits = np.unpackbits(L.astype(dtype).view(np.uint8).reshape(-1, dtype.itemsize), axis=1)
+    return params + np.packbits(bits[:, width - b:]).tobytes()
 
 
 def unpackbits(X):
     '''Returns a tuple (b, L) corresponding to a list of unsigned b-bit integers, from X'''
     params = X[0:16]
     b, length = struct.unpack("<2Q", params)
-    L = np.zeros(length, dtype=np.uint64)
-    array = bitstring.BitArray(X[16:])
-    array = bitstring.BitStream(array)
-    for i in range(length):
-        L[i] = array.read(b).uint
+    dtype = _packing_dtype(b)
+    width = 8 * dtype.itemsize
+    bits = np.unpackbits(np.frombuffer(X, dtype=np.uint8, offset=16), count=b * length)
+    padded = np.zeros((length, width), dtype=np.uint8)
+    padded[:, width - b:] = bits.reshape(length, b)
+    L = np.packbits(padded, axis=1).view(dtype).ravel().astype(np.uint64)
     return (b, L)
 
 
+def iter_batches(l, batch_size):
+    '''Yields successive batches of at most batch_size items from l; NumPy arrays are sliced,
+    and other iterables are consumed into lists'''
+    if isinstance(l, np.ndarray):
+        for start in range(0, len(l), batch_size):
+            yield l[start:start + batch_size]
+        return
+    it = iter(l)
+    while True:
+        batch = list(itertools.islice(it, batch_size))
+        if not batch:
+            break
+        yield batch
+
+
+_C1 = np.uint64(0x87c37b91114253d5)
+_C2 = np.uint64(0x4cf5ad432745937f)
+
+
+def _rotl64(x, r):
+    return (x << np.uint64(r)) | (x >> np.uint64(64 - r))
+
+
+def _fmix64(k):
+    k = k ^ (k >> np.uint64(33))
+    k = k * np.uint64(0xff51afd7ed558ccd)
+    k = k ^ (k >> np.uint64(33))
+    k = k * np.uint64(0xc4ceb9fe1a85ec53)
+    return k ^ (k >> np.uint64(33))
+
+
+def murmur3_x64_128(records):
+    '''Vectorized MurmurHash3_x64_128 with seed 0 over an (n, length) array of bytes
+
+    Every row is hashed as one key. Returns the two 64-bit halves (h1, h2) as unsigned
+    arrays, equal to mmh3.hash64 of each row's bytes (taken modulo 2^64). Uses the
+    compiled kernel when it is available.'''
+    records = np.ascontiguousarray(records, dtype=np.uint8)
+    n, length = records.shape
+    if _kernel is not None:
+        h1 = np.empty(n, dtype=np.uint64)
+        h2 = np.empty(n, dtype=np.uint64)
+        _kernel.murmur3_records(records, length, h1, h2)
+        return h1, h2
+    nblocks = length // 16
+    h1 = np.zeros(n, dtype=np.uint64)
+    h2 = np.zeros(n, dtype=np.uint64)
+    with np.errstate(over="ignore"):
+        if nblocks:
+            blocks = records[:, :16 * nblocks].copy().view("<u8").reshape(n, nblocks, 2)
+            for b in range(nblocks):
+                k1 = blocks[:, b, 0].astype(np.uint64)
+                k2 = blocks[:, b, 1].astype(np.uint64)
+                h1 ^= _rotl64(k1 * _C1, 31) * _C2
+                h1 = (_rotl64(h1, 27) + h2) * np.uint64(5) + np.uint64(0x52dce729)
+                h2 ^= _rotl64(k2 * _C2, 33) * _C1
+                h2 = (_rotl64(h2, 31) + h1) * np.uint64(5) + np.uint64(0x38495ab5)
+        tail_length = length % 16
+        if tail_length:
+            tail = np.zeros((n, 16), dtype=np.uint8)
+            tail[:, :tail_length] = records[:, 16 * nblocks:]
+            tail = tail.view("<u8").astype(np.uint64)
+            if tail_length > 8:
+                h2 ^= _rotl64(tail[:, 1] * _C2, 33) * _C1
+            h1 ^= _rotl64(tail[:, 0] * _C1, 31) * _C2
+        h1 ^= np.uint64(length)
+        h2 ^= np.uint64(length)
+        h1 += h2
+        h2 += h1
+        h1 = _fmix64(h1)
+        h2 = _fmix64(h2)
+        h1 += h2
+        h2 += h1
+    return h1, h2
+
+
+def murmur3_x64_128_many(keys):
+    '''Returns the (h1, h2) MurmurHash3_x64_128 halves of a list of bytes objects as
+    unsigned arrays; keys of equal length are hashed together with murmur3_x64_128, or
+    all keys in one pass by the compiled kernel when it is available'''
+    lengths = np.fromiter(map(len, keys), dtype=np.int64, count=len(keys))
+    h1 = np.zeros(len(keys), dtype=np.uint64)
+    h2 = np.zeros(len(keys), dtype=np.uint64)
+    if _kernel is not None:
+        offsets = np.zeros(len(keys) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=offsets[1:])
+        _kernel.murmur3_keys(b"".join(keys), offsets, h1, h2)
+        return h1, h2
+    order = np.argsort(lengths, kind="stable")
+    boundaries = np.flatnonzero(np.diff(lengths[order])) + 1
+    for group in np.split(order, boundaries):
+        if len(group) == 0:
+            continue
+        length = int(lengths[group[0]])
+        records = np.frombuffer(b"".join([keys[k] for k in group]), dtype=np.uint8).reshape(len(group), length)
+        h1[group], h2[group] = murmur3_x64_128(records)
+    return h1, h2
+
+
+def hash_str(items):
+    '''Hasher that hashes str(item).encode() for every item; this is the original
+    HyperMinHash hashing, kept for compatibility with existing sketches'''
+    return murmur3_x64_128_many([str(item).encode() for item in items])
+
+
+def _native_bytes(item):
+    '''Returns the bytes hashed by hash_native for a single item'''
+    if isinstance(item, bytes):
+        return item
+    if isinstance(item, str):
+        return item.encode("utf-8")
+    if isinstance(item, (bytearray, memoryview)):
+        return bytes(item)
+    if isinstance(item, (float, np.floating)):
+        return struct.pack("<d", item)
+    if isinstance(item, (int, np.integer, np.bool_)):
+        item = int(item)
+        if not -2**63 <= item < 2**64:
+            raise ValueError("Integer {} does not fit in 64 bits".format(item))
+        return (item & _UINT64_MASK).to_bytes(8, "little")
+    raise TypeError("hash_native cannot hash items of type {}".format(type(item).__name__))
+
+
+def hash_native(items):
+    '''Hasher that hashes the raw bytes of items, without formatting them as strings
+
+    bytes, bytearray and memoryview items are hashed as-is, and str items as UTF-8.
+    Integers are hashed as 8 little-endian bytes (modulo 2^64) and floats as
+    little-endian float64, so that e.g. 3, np.int32(3) and an element of an int64
+    array hash identically. Numeric NumPy arrays are hashed fully vectorized; each row
+    of a 2-D array is hashed as one item made of the row's raw bytes.'''
+    if isinstance(items, np.ndarray) and items.dtype.kind in "biufV":
+        if items.ndim == 2:
+            records = np.ascontiguousarray(items).view(np.uint8).reshape(len(items), -1)
+        elif items.dtype.kind == "f":
+            records = items.astype("<f8").view(np.uint8).reshape(-1, 8)
+        elif items.dtype.kind == "V":
+            records = np.ascontiguousarray(items).view(np.uint8).reshape(len(items), -1)
+        else:
+            records = items.astype("<u8" if items.dtype.kind == "u" else "<i8").view(np.uint8).reshape(-1, 8)
+        return murmur3_x64_128(records)
+    return murmur3_x64_128_many([_native_bytes(item) for item in items])
+
+
+# Hashers by name: (one-byte code recorded in serialized sketches, hash function).
+# A hash function maps a batch of items to two unsigned 64-bit arrays (h1, h2).
+HASHERS = {
+    "str": (b"s", hash_str),
+    "native": (b"n", hash_native),
+}
+
+
+def register_hasher(name, code, hash_function):
+    '''Registers a hash function under name, with a one-byte serialization code'''
+    if len(code) != 1:
+        raise ValueError("Hasher codes must be a single byte")
+    for other, (other_code, _) in HASHERS.items():
+        if other_code == code and other != name:
+            raise ValueError("Hasher code {} is already used by {}".format(code, other))
+    HASHERS[name] = (code, hash_function)
+
+
+def _hasher_from_code(code):
+    '''Returns the name of the hasher with the given serialization code'''
+    for name, (hasher_code, _) in HASHERS.items():
+        if hasher_code == code:
+            return name
+    raise ValueError("Unknown hasher code {} in deserialization".format(code))
+
+
+def _sketch_items(params, items):
+    '''Worker for HyperMinHash.parallel_update: returns the serialized sketch of items'''
+    sketch = HyperMinHash(*params)
+    sketch.update(items)
+    return sketch.serialize()
+
+
+def _sketch_file(params, path):
+    '''Worker for HyperMinHash.parallel_update: returns the serialized sketch of the lines of a
+    (possibly gzip compressed) file'''
+    from hyperminhash_cli import read_item_batches
+    sketch = HyperMinHash(*params)
+    for batch in read_item_batches(path):
+        sketch.update_batch(batch)
+    return sketch.serialize()
+
+
+def reduce_bucket_entries(i, val, aug):
+    '''Reduces (bucket index, val, aug) arrays to one winning entry per bucket
+
+    Within each bucket, the largest val wins, with ties broken by the smallest aug.
+    Returns (idx, val, aug) arrays sorted by bucket index.'''
+    # Sort by bucket, then val ascending, then aug descending, so the last entry
+    # of every bucket run is the winner of that bucket
+    order = np.lexsort((~aug, val, i))
+    i = i[order]
+    last = np.empty(len(i), dtype=bool)
+    np.not_equal(i[1:], i[:-1], out=last[:-1])
+    last[-1:] = True
+    return i[last], val[order][last], aug[order][last]
+
+
+def bit_length64(x):
+    '''Returns the elementwise int.bit_length() of an array of unsigned 64-bit integers'''
+    x = np.asarray(x, dtype=np.uint64)
+    n = np.zeros(x.shape, dtype=np.int64)
+    for shift in (32, 16, 8, 4, 2, 1):
+        high = x >= np.uint64(1 << shift)
+        n += high * shift
+        x = np.where(high, x >> np.uint64(shift), x)
+    return n + x.astype(np.int64)
+
+
+def union_take_other(hll_a, bbit_a, hll_b, bbit_b):
+    '''Returns a boolean mask of the buckets where sketch b wins a union with sketch a
+
+    b wins a bucket if its hll value is larger, or if the hll values are equal and its
+    bbit value is smaller.'''
+    return (hll_b > hll_a) | ((hll_b == hll_a) & (bbit_b < bbit_a))
+
+
 def num_bytes_packbits(b, n):
     '''Returns number of bytes needed to pack n b-bit integers, plus two 64-bit integers'''
     raw = b * n
@@ -51,27 +314,390 @@ def num_bytes_packbits(b, n):
     return 16 + padded_bytes
 
 
+_MMAP_MAGIC = b"HMHm"
+_MMAP_VERSION = 1
+# magic, version, bucketbits, bucketsize, subbucketsize, collision_correction code,
+# hasher code, byte offset of the hll array, byte offset of the bbit array
+_MMAP_HEADER = struct.Struct("<4s4Lcc2x2Q")
+_MMAP_ALIGN = 64
+
+# Compressed serialization format: a header followed by an hll stream and a bbit stream.
+# The hll stream is the registers as one byte each compressed by the chosen codec, and
+# the bbit stream the packbits-encoded bbit array compressed by the codec; either falls
+# back to plain packbits when compression would make it larger
+_WIRE_MAGIC = b"HMHz"
+_WIRE_VERSION = 1
+# magic, version, codec code, flags (bit 0: hll stream compressed, bit 1: bbit stream
+# compressed), bucketbits, bucketsize, subbucketsize, collision_correction code,
+# hasher code, byte lengths of the hll and bbit streams
+_WIRE_HEADER = struct.Struct("<4sBBB3Lcc2Q")
+# Compression codecs available to serialize, as name: (one-byte code, name of the module
+# providing compress and decompress, imported on first use)
+COMPRESSORS = {
+    "zlib": (1, "zlib"),
+    "lzma": (2, "lzma"),
+    "bz2": (3, "bz2"),
+}
+
+
+def _codec(name):
+    '''Returns the (compress, decompress) functions of the codec name in COMPRESSORS'''
+    module = importlib.import_module(COMPRESSORS[name][1])
+    return module.compress, module.decompress
+
+
+def _collision_correction_from_code(cc):
+    '''Returns the collision_correction mode for its one-byte serialization code'''
+    cc = cc.decode("utf-8")
+    if cc == 'a':
+        return "approx"
+    elif cc == 'p':
+        return "precise"
+    elif cc == 'f':
+        return "false"
+    raise ValueError("Invalid collision_correction code in deserialization")
+
+
+def _mmap_layout(bucketbits, subbucket_itemsize):
+    '''Returns (hll_offset, bbit_offset, total_size) of the memory-mappable layout'''
+    def align(x):
+        return -(-x // _MMAP_ALIGN) * _MMAP_ALIGN
+    hll_offset = align(_MMAP_HEADER.size)
+    bbit_offset = align(hll_offset + 2**bucketbits)
+    return hll_offset, bbit_offset, bbit_offset + 2**bucketbits * subbucket_itemsize
+
+
+def _read_mmap_header(header):
+    '''Parses the header of the memory-mappable layout, returning
+    (bucketbits, bucketsize, subbucketsize, collision_correction, hasher, hll_offset, bbit_offset)'''
+    if len(header) < _MMAP_HEADER.size:
+        raise ValueError("Buffer too short for a memory-mappable HyperMinHash header")
+    magic, version, bucketbits, bucketsize, subbucketsize, cc, hasher, hll_offset, bbit_offset = _MMAP_HEADER.unpack(header)
+    if magic != _MMAP_MAGIC:
+        raise ValueError("Not a memory-mappable HyperMinHash sketch")
+    if version != _MMAP_VERSION:
+        raise ValueError("Unsupported memory-mappable HyperMinHash version {}".format(version))
+    # Files written before hashers were recorded have a zero byte here
+    hasher = "str" if hasher == b"\x00" else _hasher_from_code(hasher)
+    return bucketbits, bucketsize, subbucketsize, _collision_correction_from_code(cc), hasher, hll_offset, bbit_offset
+
+
+# Latency histograms have buckets with upper bounds 2^k seconds for k in this range
+_LATENCY_MIN_EXP = -20
+_LATENCY_MAX_EXP = 11
+
+
+class Instrumentation:
+    '''Counters and per-operation latency histograms of HyperMinHash operations,
+    recorded while this object is installed by enable_instrumentation
+
+    Counters:
+        items_ingested          hashed items inserted through update and update_triples
+        bucket_updates_applied  buckets changed by each batch of items, counted once per
+                                bucket and batch, with or without the compiled kernel
+        bucket_updates_skipped  items_ingested - bucket_updates_applied
+        merges                  sketches merged by __add__, merge_into and union_many
+        serialized_bytes        bytes returned by serialize
+        deserialized_bytes      bytes read by deserialize
+        comparisons_<mode>      sketch pairs compared with collision_correction=<mode>
+    Latencies (in seconds, including nested operations) are recorded for the operations
+    hash, update, count, union, serialize, deserialize, jaccard, intersection,
+    query_many and collisions.'''
+    def __init__(self):
+        import threading
+        self._lock = threading.Lock()
+        self.bounds = [2.**k for k in range(_LATENCY_MIN_EXP, _LATENCY_MAX_EXP + 1)]
+        self.reset()
+
+    def reset(self):
+        '''Sets all counters and histograms back to zero'''
+        with self._lock:
+            self._counters = collections.Counter()
+            self._latencies = dict()
+
+    def add(self, name, value=1):
+        '''Adds value to the counter name'''
+        with self._lock:
+            self._counters[name] += value
+
+    def observe(self, operation, seconds):
+        '''Records one call of operation that took seconds'''
+        if seconds > 0:
+            index = min(max(math.frexp(seconds)[1] - _LATENCY_MIN_EXP, 0), len(self.bounds))
+        else:
+            index = 0
+        with self._lock:
+            stats = self._latencies.get(operation)
+            if stats is None:
+                stats = self._latencies[operation] = {"count": 0, "sum": 0., "max": 0., "buckets": [0] * (len(self.bounds) + 1)}
+            stats["count"] += 1
+            stats["sum"] += seconds
+            stats["max"] = max(stats["max"], seconds)
+            stats["buckets"][index] += 1
+
+    def snapshot(self):
+        '''Returns a JSON-serializable copy of the current values:
+            {"counters": {name: value},
+             "latencies": {operation: {"count", "sum", "max", "buckets"}},
+             "bounds": upper bounds of the latency buckets}
+        where "buckets" has one count per bound, plus a last count for slower calls.'''
+        with self._lock:
+            return {"counters": {name: int(value) for name, value in self._counters.items()},
+                    "latencies": {operation: dict(stats, buckets=list(stats["buckets"]))
+                                  for operation, stats in self._latencies.items()},
+                    "bounds": list(self.bounds)}
+
+    def export_text(self, prefix="hyperminhash"):
+        '''Returns the current values in the Prometheus text exposition format'''
+        snapshot = self.snapshot()
+        lines = []
+        for name, value in sorted(snapshot["counters"].items()):
+            lines.append("# TYPE {}_{}_total counter".format(prefix, name))
+            lines.append("{}_{}_total {}".format(prefix, name, value))
+        if snapshot["latencies"]:
+            lines.append("# TYPE {}_operation_seconds histogram".format(prefix))
+        for operation, stats in sorted(snapshot["latencies"].items()):
+            cumulative = 0
+            for bound, count in zip(snapshot["bounds"] + ["+Inf"], stats["buckets"]):
+                cumulative += count
+                lines.append('{}_operation_seconds_bucket{{operation="{}",le="{}"}} {}'.format(prefix, operation, bound, cumulative))
+            lines.append('{}_operation_seconds_sum{{operation="{}"}} {!r}'.format(prefix, operation, stats["sum"]))
+            lines.append('{}_operation_seconds_count{{operation="{}"}} {}'.format(prefix, operation, stats["count"]))
+        return "\n".join(lines) + "\n"
+
+
+# The Instrumentation receiving records, or None while instrumentation is disabled
+_instrumentation = None
+
+
+def enable_instrumentation(instrumentation=None):
+    '''Starts recording counters and latencies into instrumentation (a new
+    Instrumentation by default), and returns it'''
+    global _instrumentation
+    if instrumentation is None:
+        instrumentation = Instrumentation()
+    _instrumentation = instrumentation
+    return instrumentation
+
+
+def disable_instrumentation():
+    '''Stops recording, and returns the Instrumentation that was recording, if any'''
+    global _instrumentation
+    instrumentation, _instrumentation = _instrumentation, None
+    return instrumentation
+
+
+def get_instrumentation():
+    '''Returns the Instrumentation currently recording, or None'''
+    return _instrumentation
+
+
+def _instrumented(operation):
+    '''Decorator recording the latency of every call under operation while
+    instrumentation is enabled; disabled, it costs one global lookup per call'''
+    def decorate(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            instrumentation = _instrumentation
+            if instrumentation is None:
+                return fn(*args, **kwargs)
+            starttime = time.perf_counter()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                instrumentation.observe(operation, time.perf_counter() - starttime)
+        return wrapper
+    return decorate
+
+
+def _add_counter(name, value=1):
+    '''Adds value to the counter name while instrumentation is enabled'''
+    instrumentation = _instrumentation
+    if instrumentation is not None:
+        instrumentation.add(name, value)
+
+
+def _record_ingest(instrumentation, items, applied):
+    '''Counts, in instrumentation, items inserted into a sketch in one batch, which
+    changed applied buckets'''
+    instrumentation.add("items_ingested", items)
+    instrumentation.add("bucket_updates_applied", applied)
+    instrumentation.add("bucket_updates_skipped", items - applied)
+
+
+def _sparse_changes(old, new):
+    '''Number of entries of the sparse entries new that are not also in old'''
+    old_idx, old_val, old_aug = old
+    new_idx, new_val, new_aug = new
+    if len(old_idx) == 0:
+        return len(new_idx)
+    pos = np.minimum(np.searchsorted(old_idx, new_idx), len(old_idx) - 1)
+    unchanged = (old_idx[pos] == new_idx) & (old_val[pos] == new_val) & (old_aug[pos] == new_aug)
+    return len(new_idx) - int(np.count_nonzero(unchanged))
+
+
+class PackedBuckets:
+    '''Stores the (hll, bbit) values of count buckets bit-packed into a uint64 word array
+
+    Every bucket takes exactly hllbits + bbitbits bits: bucket k is the field starting
+    at bit k * width of the little-endian bit stream formed by the words, holding
+    (hll << bbitbits) | bbit. Fields may straddle two words; one trailing padding word
+    lets every field be read with two word lookups. All operations are vectorized over
+    index arrays, and whole-array operations work through chunk_size buckets at a time.'''
+    chunk_size = 2**16
+
+    def __init__(self, count, hllbits, bbitbits, bbit_type=np.uint64):
+        self.width = hllbits + bbitbits
+        if self.width > 64:
+            raise ValueError('Packed buckets cannot be wider than 64 bits')
+        self.count = count
+        self.bbitbits = bbitbits
+        self.bbit_type = bbit_type
+        self._width = np.uint64(self.width)
+        self._field_mask = np.uint64(2**self.width - 1)
+        self._bbit_mask = np.uint64(2**bbitbits - 1)
+        self.words = np.zeros(-(-count * self.width // 64) + 1, dtype=np.uint64)
+
+    @property
+    def nbytes(self):
+        '''Number of bytes used by the word array'''
+        return self.words.nbytes
+
+    def copy(self):
+        '''Returns an independent copy'''
+        result = copy.copy(self)
+        result.words = self.words.copy()
+        return result
+
+    def _locate(self, idx):
+        '''Returns the word index and bit offset of the first bit of the fields idx'''
+        bit = np.asarray(idx, dtype=np.uint64) * self._width
+        return (bit >> np.uint64(6)).astype(np.intp), bit & np.uint64(63)
+
+    def get_fields(self, idx):
+        '''Returns the packed fields of the buckets idx'''
+        word, off = self._locate(idx)
+        fields = self.words[word] >> off
+        # The shift is taken mod 64, so it is only meaningful where the field straddles two words
+        spill = self.words[word + 1] << ((np.uint64(64) - off) & np.uint64(63))
+        fields |= np.where(off + self._width > 64, spill, np.uint64(0))
+        return fields & self._field_mask
+
+    def set_fields(self, idx, fields):
+        '''Overwrites the fields of the buckets idx, which must be distinct'''
+        word, off = self._locate(idx)
+        fields = np.asarray(fields, dtype=np.uint64)
+        # Distinct fields can share a word, so writes go through unbuffered ufunc.at
+        np.bitwise_and.at(self.words, word, ~(self._field_mask << off))
+        np.bitwise_or.at(self.words, word, fields << off)
+        spill = off + self._width > 64
+        if np.any(spill):
+            word, shift = word[spill] + 1, np.uint64(64) - off[spill]
+            np.bitwise_and.at(self.words, word, ~(self._field_mask >> shift))
+            np.bitwise_or.at(self.words, word, fields[spill] >> shift)
+
+    def split(self, fields):
+        '''Splits packed fields into (hll, bbit) arrays'''
+        return ((fields >> np.uint64(self.bbitbits)).astype(np.uint8),
+                (fields & self._bbit_mask).astype(self.bbit_type))
+
+    def join(self, hll, bbit):
+        '''Packs (hll, bbit) arrays into fields'''
+        return ((np.asarray(hll, dtype=np.uint64) << np.uint64(self.bbitbits))
+                | np.asarray(bbit, dtype=np.uint64))
+
+    def get(self, idx):
+        '''Returns the (hll, bbit) values of the buckets idx'''
+        return self.split(self.get_fields(idx))
+
+    def set(self, idx, hll, bbit):
+        '''Overwrites the (hll, bbit) values of the buckets idx, which must be distinct'''
+        self.set_fields(idx, self.join(hll, bbit))
+
+    def get_all(self):
+        '''Returns dense (hll, bbit) arrays of all buckets'''
+        return self.get(np.arange(self.count))
+
+    def set_all(self, hll, bbit):
+        '''Overwrites all buckets from dense (hll, bbit) arrays'''
+        self.words[:] = 0
+        self.set(np.arange(self.count), hll, bbit)
+
+    def _chunks(self):
+        for start in range(0, self.count, self.chunk_size):
+            yield np.arange(start, min(start + self.chunk_size, self.count))
+
+    def filled(self):
+        '''Returns the number of nonzero buckets'''
+        return sum(np.count_nonzero(self.get_fields(idx)) for idx in self._chunks())
+
+    def match_count(self, other):
+        '''Returns the number of nonzero buckets holding identical fields in self and other'''
+        matches = 0
+        for idx in self._chunks():
+            a = self.get_fields(idx)
+            matches += np.count_nonzero((a == other.get_fields(idx)) & (a != 0))
+        return matches
+
+    def merge(self, other):
+        '''Replaces every bucket with the union of itself and the same bucket of other'''
+        for idx in self._chunks():
+            a = self.get_fields(idx)
+            b = other.get_fields(idx)
+            hll_a, bbit_a = self.split(a)
+            hll_b, bbit_b = self.split(b)
+            take_other = union_take_other(hll_a, bbit_a, hll_b, bbit_b)
+            if np.any(take_other):
+                self.set_fields(idx[take_other], b[take_other])
+
+
 class HyperMinHash:
     '''Class that stores HyperMinHash sketch
 
        Defines an HLL structure augmented with a b-bit kpartition minhash, and takes l as a generator
 
     '''
-    def __init__(self, bucketbits, bucketsize, subbucketsize, collision_correction="approx"):
+    def __init__(self, bucketbits, bucketsize, subbucketsize, collision_correction="approx", hasher="str", sparse=False, packed=False):
         '''2^bucketbits is number of buckets used to store hashes,
            bucketsize is the number of bits for the LogLog hash
            subbucketsize is the number of bits for the bbit hash
 
             collision_correction={"approx", "precise", "false")
                 approx --> use approximate fast expected collision function
-                precise --> use big decimals and do the exact calculation
+                precise --> do the exact calculation, using a cached per-parameter table (see expected_collisions_tabulated)
                 false --> don't use expected collision function
 
+           hasher names the function used to hash items (see HASHERS):
+                str --> hash str(item).encode(), compatible with existing sketches
+                native --> hash the raw bytes of numbers, bytes and UTF-8 strings
+           Sketches built with different hashers cannot be merged or compared.
+
+           sparse=True starts the sketch in the sparse representation, which stores only
+           the touched buckets and converts itself to dense buckets once that saves memory
+           (see to_sparse). packed=True stores the buckets bit-packed, using exactly
+           bucketsize + 1 + subbucketsize bits per bucket (see to_packed). Results are
+           identical in every representation.
            '''
+        self._set_params(bucketbits, bucketsize, subbucketsize, collision_correction, hasher)
+        if sparse and packed:
+            raise ValueError('A sketch cannot be both sparse and packed')
+        if packed:
+            self._packed = self._new_packed()
+        elif sparse:
+            self._sparse = (np.zeros(0, dtype=self._index_type), np.zeros(0, dtype=self._hll_type),
+                            np.zeros(0, dtype=self._subbucket_type))
+        else:
+            self.hll = np.zeros(2**bucketbits, dtype=self._hll_type)
+            self.bbit = np.zeros(2**bucketbits, dtype=self._subbucket_type)
+
+    def _set_params(self, bucketbits, bucketsize, subbucketsize, collision_correction, hasher="str"):
+        '''Validates and stores the sketch parameters, without allocating any buckets'''
         if bucketsize > 6:  # Using bucketsize > 6 would require >64 bits in the hash function
             raise ValueError('bucketsize for HyperMinHash implementation cannot be greater than 6')
         if bucketbits + subbucketsize > 64:
             raise ValueError('Sum of bucketbits and subbucketsize cannot exceed 64')
+        if hasher not in HASHERS:
+            raise ValueError('Unknown hasher {}'.format(hasher))
         if subbucketsize <= 8:
             self._subbucket_type = np.uint8
         elif subbucketsize <= 16:
@@ -81,41 +707,260 @@ class HyperMinHash:
         elif subbucketsize <= 64:
             self._subbucket_type = np.uint64
         self._hll_type = np.uint8
+        self._index_type = np.uint32 if bucketbits <= 32 else np.uint64
+        # Number of sparse entries beyond which the dense buckets take less memory
+        entry_size = np.dtype(self._index_type).itemsize + 1 + np.dtype(self._subbucket_type).itemsize
+        self.sparse_limit = 2**bucketbits * (1 + np.dtype(self._subbucket_type).itemsize) // entry_size
+        self._sparse = None
+        self._packed = None
+        self._hll = None
+        self._bbit = None
 
         self.bucketbits = bucketbits
         self.bucketsize = bucketsize
         self.subbucketsize = subbucketsize
-        self.hll = np.zeros(2**bucketbits, dtype=self._hll_type)
-        self.bbit = np.zeros(2**bucketbits, dtype=self._subbucket_type)
         self.collision_correction = collision_correction
+        self.hasher = hasher
+        self._cached_count = None
+        self._histogram = None
 
         self._bbit_mask = 2**self.subbucketsize - 1
         self._bucketbit_shift = 64 - self.bucketbits
 
-    def serialize(self):
-        '''Returns a Bytes object that can be reconstructed into a HyperMinHash sketch'''
+    @classmethod
+    def _from_arrays(cls, bucketbits, bucketsize, subbucketsize, collision_correction, hll, bbit, hasher="str"):
+        '''Returns a sketch that uses the given hll and bbit arrays as its buckets, without copying them'''
+        obj = cls.__new__(cls)
+        obj._set_params(bucketbits, bucketsize, subbucketsize, collision_correction, hasher)
+        obj.hll = hll
+        obj.bbit = bbit
+        return obj
+
+    @property
+    def hll(self):
+        '''Array of the LogLog value of every bucket. For a sparse or packed sketch, the
+        getter returns a copy, so writing into that array does not modify the sketch;
+        assign a whole array instead. Assigning drops the cached count (see invalidate_count).'''
+        return self._bucket_arrays()[0]
+
+    @hll.setter
+    def hll(self, value):
+        if self._packed is not None:
+            self._packed.set_all(value, self._packed.get_all()[1])
+        else:
+            if self._sparse is not None:
+                self.to_dense()
+            self._hll = value
+        self.invalidate_count()
+
+    @property
+    def bbit(self):
+        '''Array of the b-bit MinHash value of every bucket; see hll'''
+        return self._bucket_arrays()[1]
+
+    @bbit.setter
+    def bbit(self, value):
+        if self._packed is not None:
+            self._packed.set_all(self._packed.get_all()[0], value)
+        else:
+            if self._sparse is not None:
+                self.to_dense()
+            self._bbit = value
+        self.invalidate_count()
+
+    def _bucket_arrays(self):
+        '''Returns dense (hll, bbit) arrays of all buckets, for any representation'''
+        if self._sparse is not None:
+            return self._dense_arrays()
+        if self._packed is not None:
+            return self._packed.get_all()
+        return self._hll, self._bbit
+
+    @property
+    def is_sparse(self):
+        '''True iff the sketch currently uses the sparse representation'''
+        return self._sparse is not None
+
+    @property
+    def is_packed(self):
+        '''True iff the sketch currently uses the bit-packed representation'''
+        return self._packed is not None
+
+    @property
+    def nbytes(self):
+        '''Number of bytes used by the buckets in the current representation'''
+        if self._sparse is not None:
+            return sum(a.nbytes for a in self._sparse)
+        if self._packed is not None:
+            return self._packed.nbytes
+        return self._hll.nbytes + self._bbit.nbytes
+
+    def _new_packed(self):
+        '''Returns empty packed buckets for the parameters of this sketch'''
+        return PackedBuckets(2**self.bucketbits, self.bucketsize + 1, self.subbucketsize, self._subbucket_type)
+
+    def _dense_arrays(self):
+        '''Returns dense (hll, bbit) arrays built from the sparse entries'''
+        idx, hll, bbit = self._sparse
+        dense_hll = np.zeros(2**self.bucketbits, dtype=self._hll_type)
+        dense_bbit = np.zeros(2**self.bucketbits, dtype=self._subbucket_type)
+        dense_hll[idx] = hll
+        dense_bbit[idx] = bbit
+        return dense_hll, dense_bbit
+
+    def to_dense(self):
+        '''Converts the sketch to the dense representation in place'''
+        if self._sparse is not None or self._packed is not None:
+            self._hll, self._bbit = self._bucket_arrays()
+            self._sparse = None
+            self._packed = None
+        return self
+
+    def to_sparse(self):
+        '''Converts the sketch to the sparse representation in place
+
+        Only the (index, hll, bbit) entries of touched buckets are stored, in arrays
+        sorted by index. The sketch converts itself back to dense buckets when an update
+        or merge takes it past sparse_limit entries.'''
+        if self._packed is not None:
+            self.to_dense()
+        if self._sparse is None:
+            idx = np.flatnonzero((self._hll != 0) | (self._bbit != 0)).astype(self._index_type)
+            self._sparse = (idx, np.array(self._hll[idx]), np.array(self._bbit[idx]))
+            self._hll = None
+            self._bbit = None
+        return self
+
+    def to_packed(self):
+        '''Converts the sketch to the bit-packed representation in place
+
+        The buckets are stored in a PackedBuckets word array taking exactly
+        bucketsize + 1 + subbucketsize bits per bucket, rather than the 1 + 1, 2, 4 or 8
+        bytes of the dense numpy arrays. Updates read and write only the touched fields,
+        and unions and comparisons between packed sketches work on the packed words.
+        Reading hll or bbit unpacks a fresh dense copy.'''
+        if self._packed is None:
+            hll, bbit = self._bucket_arrays()
+            packed = self._new_packed()
+            packed.set_all(hll, bbit)
+            self._packed = packed
+            self._sparse = None
+            self._hll = None
+            self._bbit = None
+        return self
+
+    def _set_sparse(self, idx, hll, bbit):
+        '''Stores sorted sparse entries, switching to dense buckets past sparse_limit'''
+        self._sparse = (idx.astype(self._index_type), hll, bbit)
+        self._cached_count = None
+        self._histogram = None
+        if len(idx) > self.sparse_limit:
+            self.to_dense()
+
+    def _sparse_entries(self):
+        '''Returns the (idx, hll, bbit) entries of the touched buckets, for either representation'''
+        if self._sparse is not None:
+            return self._sparse
+        hll, bbit = self._bucket_arrays()
+        idx = np.flatnonzero((hll != 0) | (bbit != 0))
+        return idx, hll[idx], bbit[idx]
+
+    @_instrumented("serialize")
+    def serialize(self, compression=None):
+        '''Returns a Bytes object that can be reconstructed into a HyperMinHash sketch
+
+        With compression set to one of COMPRESSORS ("zlib", "lzma" or "bz2"), a versioned
+        compressed format is written instead of fixed-width packed fields. The hll registers
+        of a sketch concentrate on a few values around log2(n / 2^bucketbits), so they are
+        entropy-coded as one byte per register; the near-uniform bbit values are kept
+        packed. deserialize detects the format automatically.'''
+        data = self._serialize(compression)
+        _add_counter("serialized_bytes", len(data))
+        return data
+
+    def _serialize(self, compression):
+        '''Returns the serialization of the sketch written by serialize'''
+        if compression is not None:
+            return self._serialize_compressed(compression)
         params = struct.pack("<3L", self.bucketbits, self.bucketsize, self.subbucketsize)
         cc = bytes(self.collision_correction[0], "utf-8")
         hll_bytes = packbits(self.bucketsize + 1, self.hll)
         bbit_bytes = packbits(self.subbucketsize, self.bbit)
         ans = params + cc + hll_bytes + bbit_bytes
+        if self.hasher != "str":
+            # Sketches using the original str hasher carry no trailer, as before hashers existed
+            ans += HASHERS[self.hasher][0]
         return ans
 
+    def _serialize_compressed(self, compression):
+        '''Returns the compressed serialization format written by serialize(compression)'''
+        if compression not in COMPRESSORS:
+            raise ValueError("Unknown compression {}".format(compression))
+        code = COMPRESSORS[compression][0]
+        compress, _ = _codec(compression)
+        hll = self.hll
+        streams = [packbits(self.bucketsize + 1, hll), packbits(self.subbucketsize, self.bbit)]
+        compressed = [compress(np.asarray(hll, dtype=np.uint8).tobytes()), compress(streams[1])]
+        flags = 0
+        for k in range(2):
+            if len(compressed[k]) < len(streams[k]):
+                streams[k] = compressed[k]
+                flags |= 1 << k
+        header = _WIRE_HEADER.pack(_WIRE_MAGIC, _WIRE_VERSION, code, flags, self.bucketbits, self.bucketsize,
+                                   self.subbucketsize, bytes(self.collision_correction[0], "utf-8"),
+                                   HASHERS[self.hasher][0], len(streams[0]), len(streams[1]))
+        return header + streams[0] + streams[1]
+
+    @classmethod
+    def _deserialize_compressed(cls, byte_array):
+        '''Unserializes the compressed format written by serialize(compression)'''
+        if len(byte_array) < _WIRE_HEADER.size:
+            raise ValueError("Buffer too short for a compressed HyperMinHash header")
+        header = _WIRE_HEADER.unpack(bytes(byte_array[:_WIRE_HEADER.size]))
+        _, version, code, flags, bucketbits, bucketsize, subbucketsize, cc, hasher, hll_len, bbit_len = header
+        if version != _WIRE_VERSION:
+            raise ValueError("Unsupported compressed HyperMinHash version {}".format(version))
+        names = [name for name, (c, _) in COMPRESSORS.items() if c == code]
+        if not names:
+            raise ValueError("Unknown compression code {}".format(code))
+        _, decompress = _codec(names[0])
+        start_bbit = _WIRE_HEADER.size + hll_len
+        if len(byte_array) < start_bbit + bbit_len:
+            raise ValueError("Truncated compressed HyperMinHash sketch")
+        streams = [bytes(byte_array[_WIRE_HEADER.size:start_bbit]), bytes(byte_array[start_bbit:start_bbit + bbit_len])]
+        obj = cls._from_arrays(bucketbits, bucketsize, subbucketsize, _collision_correction_from_code(cc),
+                               None, None, _hasher_from_code(hasher))
+        if flags & 1:
+            hll_L = np.frombuffer(decompress(streams[0]), dtype=np.uint8)
+        else:
+            hll_b, hll_L = unpackbits(streams[0])
+        if flags & 2:
+            streams[1] = decompress(streams[1])
+        bbit_b, bbit_L = unpackbits(streams[1])
+        if len(hll_L) != 2**bucketbits or len(bbit_L) != 2**bucketbits:
+            raise ValueError("Corrupt compressed HyperMinHash sketch")
+        obj.hll = hll_L.astype(obj._hll_type)
+        obj.bbit = bbit_L.astype(obj._subbucket_type)
+        return obj
+
     @classmethod
-    def deserialize(cls, byte_array):
-        '''Unserializes a Bytes object that has been packed by serialize'''
+    @_instrumented("deserialize")
+    def deserialize(cls, byte_array, sparse=False):
+        '''Unserializes a Bytes object that has been packed by serialize, in either format
+
+        With sparse=True, the sketch is returned in the sparse representation if it
+        has few enough touched buckets.'''
+        _add_counter("deserialized_bytes", len(byte_array))
+        if bytes(byte_array[:len(_WIRE_MAGIC)]) == _WIRE_MAGIC:
+            # The original format starts with bucketbits <= 64 as a 32-bit integer, which never matches
+            obj = cls._deserialize_compressed(byte_array)
+            if sparse and obj.filled_buckets() <= obj.sparse_limit:
+                obj.to_sparse()
+            return obj
         params = byte_array[0:12]
         bucketbits, bucketsize, subbucketsize = struct.unpack("<3L", params)
-        cc = byte_array[12:13].decode("utf-8")
-        if cc == 'a':
-            collision_correction = "approx"
-        elif cc == 'p':
-            collision_correction = "precise"
-        elif cc == 'f':
-            collision_correction = "false"
-        else:
-            raise ValueError("Invalid collision_correction code in deserialization")
-        obj = cls(bucketbits, bucketsize, subbucketsize, collision_correction)
+        collision_correction = _collision_correction_from_code(byte_array[12:13])
+        obj = cls._from_arrays(bucketbits, bucketsize, subbucketsize, collision_correction, None, None)
         start_hll = 13
         end_hll = start_hll + num_bytes_packbits(bucketsize + 1, 2**bucketbits)
         end_bbit = end_hll + num_bytes_packbits(subbucketsize, 2**bucketbits)
@@ -123,6 +968,63 @@ class HyperMinHash:
         obj.hll = hll_L.astype(obj._hll_type)
         bbit_b, bbit_L = unpackbits(byte_array[end_hll:end_bbit])
         obj.bbit = bbit_L.astype(obj._subbucket_type)
+        if len(byte_array) > end_bbit:
+            obj.hasher = _hasher_from_code(bytes(byte_array[end_bbit:end_bbit + 1]))
+        if sparse and obj.filled_buckets() <= obj.sparse_limit:
+            obj.to_sparse()
+        return obj
+
+    def to_buffer(self):
+        '''Returns a Bytes object in the unpacked, memory-mappable layout read by from_buffer
+
+        The layout is a fixed header followed by the hll and bbit arrays stored as
+        little-endian integers, each starting at a 64-byte aligned offset.'''
+        hll_offset, bbit_offset, size = _mmap_layout(self.bucketbits, np.dtype(self._subbucket_type).itemsize)
+        buf = bytearray(size)
+        _MMAP_HEADER.pack_into(buf, 0, _MMAP_MAGIC, _MMAP_VERSION, self.bucketbits, self.bucketsize,
+                               self.subbucketsize, bytes(self.collision_correction[0], "utf-8"),
+                               HASHERS[self.hasher][0], hll_offset, bbit_offset)
+        hll = np.asarray(self.hll, dtype=np.dtype(self._hll_type).newbyteorder("<"))
+        bbit = np.asarray(self.bbit, dtype=np.dtype(self._subbucket_type).newbyteorder("<"))
+        buf[hll_offset:hll_offset + hll.nbytes] = hll.tobytes()
+        buf[bbit_offset:bbit_offset + bbit.nbytes] = bbit.tobytes()
+        return bytes(buf)
+
+    def save_mmap(self, path):
+        '''Writes the sketch to path in the memory-mappable layout, for use with open_mmap'''
+        with open(path, "wb") as f:
+            f.write(self.to_buffer())
+
+    @classmethod
+    def from_buffer(cls, buf):
+        '''Returns a sketch whose buckets are views into buf, which holds the layout
+        written by to_buffer. No bucket data is copied or decoded.
+
+        The sketch is read-only if buf is (e.g. bytes); it still supports count, jaccard
+        and intersection, but not update or merge_into.'''
+        header = _read_mmap_header(bytes(memoryview(buf)[:_MMAP_HEADER.size]))
+        bucketbits, bucketsize, subbucketsize, collision_correction, hasher, hll_offset, bbit_offset = header
+        obj = cls._from_arrays(bucketbits, bucketsize, subbucketsize, collision_correction, None, None, hasher)
+        obj.hll = np.frombuffer(buf, dtype=np.dtype(obj._hll_type).newbyteorder("<"),
+                                count=2**bucketbits, offset=hll_offset)
+        obj.bbit = np.frombuffer(buf, dtype=np.dtype(obj._subbucket_type).newbyteorder("<"),
+                                 count=2**bucketbits, offset=bbit_offset)
+        return obj
+
+    @classmethod
+    def open_mmap(cls, path, mode="r"):
+        '''Opens a sketch written by save_mmap, backing its buckets by np.memmap
+
+        Only the header is read up front; bucket pages are loaded by the OS when accessed.
+        mode="r" gives a read-only sketch, mode="r+" writes updates back to the file.'''
+        with open(path, "rb") as f:
+            header = _read_mmap_header(f.read(_MMAP_HEADER.size))
+        bucketbits, bucketsize, subbucketsize, collision_correction, hasher, hll_offset, bbit_offset = header
+        obj = cls._from_arrays(bucketbits, bucketsize, subbucketsize, collision_correction, None, None, hasher)
+        obj.hll = np.memmap(path, dtype=np.dtype(obj._hll_type).newbyteorder("<"), mode=mode,
+                            offset=hll_offset, shape=(2**bucketbits,))
+        obj.bbit = np.memmap(path, dtype=np.dtype(obj._subbucket_type).newbyteorder("<"), mode=mode,
+                             offset=bbit_offset, shape=(2**bucketbits,))
         return obj
 
     def triple_hash(self, item):
@@ -130,28 +1032,187 @@ class HyperMinHash:
         val is the position of the leading one in a 64-bit integer, and aug is the bits
         to go in the subbuckets'''
 
-        y, h2 = mmh3.hash64(str(item).encode())
-        val = 64 + 1 - int(np.uint64(y)).bit_length()
+        if self.hasher == "str":
+            import mmh3
+            y, h2 = mmh3.hash64(str(item).encode())
+        else:
+            y, h2 = (int(h[0]) for h in HASHERS[self.hasher][1]([item]))
+        y &= _UINT64_MASK
+        val = 64 + 1 - y.bit_length()
         val = min(val, 2**self.bucketsize)
 
-        h2prime = int(np.uint64(h2))
+        h2prime = h2 & _UINT64_MASK
         i = h2prime >> self._bucketbit_shift
         aug = h2prime & self._bbit_mask
 
         return (i, val, aug)
 
-    def update(self, l):
-        '''Inserts a list of items l into the sketch'''
-        hash_lists = (self.triple_hash(item) for item in l)
-        for i, val, aug in hash_lists:
-            if self.hll[i] > val:
-                pass
-            # this only works because we've already checked that bucket_i[0] <> val. Do not reorder
-            elif self.hll[i] < val or self.bbit[i] > aug:
-                self.hll[i] = val
-                self.bbit[i] = aug
-
-    def count(self):
+    def triple_hash_batch(self, items):
+        '''Vectorized version of triple_hash over a batch of items (a list or a NumPy array).
+
+        Returns three NumPy arrays (i, val, aug), elementwise identical to calling
+        triple_hash on every item.'''
+        y, h2 = HASHERS[self.hasher][1](items)
+        return self.triples_from_hashes(y, h2)
+
+    def triples_from_hashes(self, y, h2):
+        '''Converts two arrays of unsigned 64-bit hash halves into (i, val, aug) arrays'''
+        y = np.asarray(y, dtype=np.uint64)
+        h2 = np.asarray(h2, dtype=np.uint64)
+        val = 64 + 1 - bit_length64(y)
+        val = np.minimum(val, 2**self.bucketsize).astype(self._hll_type)
+        i = (h2 >> np.uint64(self._bucketbit_shift)).astype(np.intp)
+        aug = (h2 & np.uint64(self._bbit_mask)).astype(self._subbucket_type)
+        return (i, val, aug)
+
+    def _kernel_buckets(self):
+        '''True iff the compiled kernel can update the buckets of this sketch in place,
+        i.e. they are dense, writable, contiguous arrays of the sketch's types'''
+        if _kernel is None or self._hll is None or self._packed is not None or self._sparse is not None:
+            return False
+        return all(a.flags.writeable and a.flags.c_contiguous and a.flags.aligned and a.dtype == np.dtype(t)
+                   for a, t in ((self._hll, self._hll_type), (self._bbit, self._subbucket_type)))
+
+    @_instrumented("update")
+    def update_hashes(self, y, h2):
+        '''Inserts items given by the two unsigned 64-bit halves (y, h2) of their hashes
+
+        Dense buckets are updated in a single pass by the compiled kernel when it is
+        available, and otherwise through triples_from_hashes and update_triples; the
+        buckets are identical either way.'''
+        if not self._kernel_buckets():
+            self.update_triples(*self.triples_from_hashes(y, h2))
+            return
+        y = np.ascontiguousarray(y, dtype=np.uint64)
+        h2 = np.ascontiguousarray(h2, dtype=np.uint64)
+        instrumentation = _instrumentation
+        # Counting distinct changed buckets, as the NumPy path does, costs a bitmap of the buckets
+        applied = _kernel.update_buckets(y, h2, self._hll, self._bbit, self._bbit.itemsize, self._histogram,
+                                         2**self.bucketsize, self._bucketbit_shift, self._bbit_mask,
+                                         instrumentation is not None)
+        if applied:
+            self._cached_count = None
+        if instrumentation is not None:
+            _record_ingest(instrumentation, len(y), applied)
+
+    def update_triples(self, i, val, aug):
+        '''Inserts already hashed (i, val, aug) arrays into the sketch.
+
+        Within each bucket, the largest val wins, with ties broken by the smallest aug;
+        this is the same rule that update applies one item at a time.'''
+        if len(i) == 0:
+            return
+        instrumentation = _instrumentation
+        if self._sparse is not None:
+            old = self._sparse
+            entries = reduce_bucket_entries(np.concatenate((old[0], i)), np.concatenate((old[1], val)),
+                                            np.concatenate((old[2], aug)))
+            self._set_sparse(*entries)
+            if instrumentation is not None:
+                _record_ingest(instrumentation, len(i), _sparse_changes(old, entries))
+            return
+        applied = self._apply_entries(*reduce_bucket_entries(i, val, aug))
+        if instrumentation is not None:
+            _record_ingest(instrumentation, len(i), applied)
+
+    def _apply_entries(self, idx, best_val, best_aug):
+        '''Inserts (idx, val, aug) entries with distinct bucket indices into dense or packed
+        buckets, returning the number of buckets changed'''
+        if self._packed is not None:
+            cur_val, cur_aug = self._packed.get(idx)
+        else:
+            cur_val = self._hll[idx]
+            cur_aug = self._bbit[idx]
+        replace = (best_val > cur_val) | ((best_val == cur_val) & (best_aug < cur_aug))
+        idx = idx[replace]
+        if len(idx):
+            if self._histogram is not None:
+                self._histogram -= np.bincount(cur_val[replace], minlength=len(self._histogram))
+                self._histogram += np.bincount(best_val[replace], minlength=len(self._histogram))
+            if self._packed is not None:
+                self._packed.set(idx, best_val[replace], best_aug[replace])
+            else:
+                self._hll[idx] = best_val[replace]
+                self._bbit[idx] = best_aug[replace]
+            self._cached_count = None
+        return len(idx)
+
+    def update_batch(self, batch):
+        '''Inserts a single batch of items (a list or a NumPy array) into the sketch,
+        hashing and updating buckets in vectorized form'''
+        hash_function = HASHERS[self.hasher][1]
+        if _instrumentation is not None:
+            hash_function = _instrumented("hash")(hash_function)
+        self.update_hashes(*hash_function(batch))
+
+    def update(self, l, batch_size=2**16):
+        '''Inserts a list of items l into the sketch
+
+        Items are consumed in batches of batch_size and inserted through update_batch,
+        so l may be any iterable, including a generator or a NumPy array.'''
+        for batch in iter_batches(l, batch_size):
+            self.update_batch(batch)
+
+    def parallel_update(self, l, workers=None, files=False, batch_size=2**18):
+        '''Inserts items into the sketch using a pool of worker processes
+
+        l is either an iterable of items, which is cut into batches of batch_size, or,
+        if files is True, a list of paths to newline-delimited text files, each line of
+        which is one item. Every batch or file is inserted into a fresh sketch with the
+        same parameters by a worker, shipped back in the serialize format and merged
+        into this sketch, so the result is bucket-identical to a serial update.
+        workers defaults to the number of CPUs.'''
+        import concurrent.futures
+        if workers is None:
+            workers = os.cpu_count() or 1
+        params = (self.bucketbits, self.bucketsize, self.subbucketsize, self.collision_correction, self.hasher)
+        if files:
+            tasks = ((_sketch_file, params, path) for path in l)
+        else:
+            tasks = ((_sketch_items, params, batch) for batch in iter_batches(l, batch_size))
+        with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as pool:
+            pending = set()
+            for task in tasks:
+                # Bound the number of batches in flight, so a long input is not read into memory at once
+                if len(pending) >= 2 * workers:
+                    done, pending = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+                    for future in done:
+                        self.merge_into(HyperMinHash.deserialize(future.result()))
+                pending.add(pool.submit(*task))
+            for future in concurrent.futures.as_completed(pending):
+                self.merge_into(HyperMinHash.deserialize(future.result()))
+
+    def threaded_update(self, l, workers=None, batch_size=2**16):
+        '''Inserts items into the sketch using a pool of threads
+
+        Every thread inserts batches of l, cut as in update, into its own dense sketch
+        with the same parameters, and the thread sketches are merged into this sketch at
+        the end, so the result is bucket-identical to a serial update. Threads only run
+        in parallel while the GIL is released, which the compiled kernel (see
+        build_kernel.py) does while hashing and updating buckets; this is most effective
+        for NumPy arrays hashed with hasher="native". workers defaults to the number of CPUs.'''
+        import concurrent.futures
+        import threading
+        if workers is None:
+            workers = os.cpu_count() or 1
+        batches = iter_batches(l, batch_size)
+        lock = threading.Lock()
+
+        def work():
+            sketch = HyperMinHash(self.bucketbits, self.bucketsize, self.subbucketsize, self.collision_correction, self.hasher)
+            while True:
+                with lock:
+                    batch = next(batches, None)
+                if batch is None:
+                    return sketch
+                sketch.update_batch(batch)
+        with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as pool:
+            sketches = [future.result() for future in [pool.submit(work) for _ in range(workers)]]
+        for sketch in sketches:
+            self.merge_into(sketch)
+
+    @_instrumented("count")
+    def count(self, estimator="classic"):
         '''Returns an estimate of the cardinality of the unique items inserted into the sketch
 
         Returns cardinality based on either the HLL estimator, or the MinHash
@@ -162,52 +1223,171 @@ class HyperMinHash:
         to MinHash
 
         Also uses MinHash estimator if bucketsize = 0
+
+        With estimator="improved", Ertl's improved estimator (see improved_estimator)
+        replaces the HLL estimator and its linear counting correction, giving lower
+        variance around the small range transition. It is computed from register_histogram,
+        which is maintained incrementally by update.
+
+        The classic estimate is cached until the sketch is next modified through update,
+        update_triples or merge_into; code writing to hll or bbit directly must call
+        invalidate_count afterwards.
         '''
+        if estimator == "improved":
+            return self._estimate_count(improved=True)
+        elif estimator != "classic":
+            raise ValueError("Unknown estimator {}".format(estimator))
+        if self._cached_count is None:
+            self._cached_count = self._estimate_count()
+        return self._cached_count
 
-        hll_count = hll_estimator(self.hll)
-        if hll_count < 2**(self.bucketbits + 10) and self.bucketsize > 0:
-            ans = hll_count
-        else:
-            if self.bucketsize == 0:
-                vals = self.bbit.astype(np.float64) / 2**self.subbucketsize
+    def register_histogram(self):
+        '''Returns an array whose element k is the number of buckets with hll value k'''
+        if self._histogram is None:
+            if self._sparse is not None:
+                self._histogram = np.bincount(self._sparse[1], minlength=2**self.bucketsize + 1)
+                self._histogram[0] += 2**self.bucketbits - len(self._sparse[1])
             else:
-                vals = 2**-self.hll.astype(np.float64) * (1 + self.bbit.astype(np.float64) / 2**self.subbucketsize)
-            if sum(vals) == 0:
-                ans = float('Inf')
+                self._histogram = np.bincount(self.hll, minlength=2**self.bucketsize + 1)
+        return self._histogram
+
+    def invalidate_count(self):
+        '''Drops the cached cardinality estimate, after the buckets were modified directly'''
+        self._cached_count = None
+        self._histogram = None
+
+    def _estimate_count(self, improved=False):
+        '''Computes the estimate returned by count'''
+        if self.bucketsize > 0:
+            if improved:
+                hll_count = improved_estimator(self.register_histogram(), 2**self.bucketsize)
             else:
-                ans = len(vals) * len(vals) / sum(vals)
-        return ans
+                hll_count = hll_estimator_histogram(self.register_histogram())
+            if hll_count < 2**(self.bucketbits + 10):
+                return hll_count
+            vals_sum = np.dot(_NEG_POW2[self.hll], 1 + self.bbit / 2**self.subbucketsize)
+        else:
+            vals_sum = np.sum(self.bbit, dtype=np.float64) / 2**self.subbucketsize
+        if vals_sum == 0:
+            return float('Inf')
+        return 2**self.bucketbits * 2**self.bucketbits / float(vals_sum)
 
     def __len__(self):
         '''Returns:
             int: number of buckets used for hash values
         '''
-        return len(self.hll)
+        return 2**self.bucketbits
 
     def filled_buckets(self):
         '''Returns:
             int: number of buckets that have a nonzero value
         '''
-        empty = sum(np.logical_and(self.hll == 0, self.bbit == 0))
-        return len(self.hll) - empty
+        if self._sparse is not None:
+            return np.count_nonzero((self._sparse[1] != 0) | (self._sparse[2] != 0))
+        if self._packed is not None:
+            return self._packed.filled()
+        return np.count_nonzero((self._hll != 0) | (self._bbit != 0))
 
-    def __add__(self, other):
-        '''Returns the union of two HyperMinHash sketches, or more precisely, the
-        HyperMinHash sketch of the union'''
+    def _check_compatible(self, other):
+        '''Asserts that other was generated with the same parameters as self'''
         assert(self.bucketbits == other.bucketbits)
         assert(self.bucketsize == other.bucketsize)
         assert(self.subbucketsize == other.subbucketsize)
-        result = HyperMinHash(self.bucketbits, self.bucketsize, self.subbucketsize, collision_correction=self.collision_correction)
-        for i in range(len(result.hll)):
-            if self.hll[i] == other.hll[i]:
-                result.hll[i] = self.hll[i]
-                result.bbit[i] = min(self.bbit[i], other.bbit[i])
-            elif self.hll[i] < other.hll[i]:
-                result.hll[i] = other.hll[i]
-                result.bbit[i] = other.bbit[i]
-            elif self.hll[i] > other.hll[i]:
-                result.hll[i] = self.hll[i]
-                result.bbit[i] = self.bbit[i]
+        if self.hasher != other.hasher:
+            raise ValueError("Cannot combine sketches built with different hashers: {} and {}".format(self.hasher, other.hasher))
+
+    @_instrumented("union")
+    def __add__(self, other):
+        '''Returns the union of two HyperMinHash sketches, or more precisely, the
+        HyperMinHash sketch of the union'''
+        self._check_compatible(other)
+        _add_counter("merges")
+        if self._sparse is not None and other._sparse is not None:
+            result = HyperMinHash(self.bucketbits, self.bucketsize, self.subbucketsize, collision_correction=self.collision_correction, hasher=self.hasher, sparse=True)
+            return result._merge_into(self)._merge_into(other)
+        if self._packed is not None:
+            result = HyperMinHash(self.bucketbits, self.bucketsize, self.subbucketsize, collision_correction=self.collision_correction, hasher=self.hasher, packed=True)
+            result._packed = self._packed.copy()
+            return result._merge_into(other)
+        if self._sparse is not None:
+            dense, sparse = other, self
+        else:
+            dense, sparse = self, other
+        result = HyperMinHash(self.bucketbits, self.bucketsize, self.subbucketsize, collision_correction=self.collision_correction, hasher=self.hasher)
+        if sparse._sparse is not None:
+            dense_hll, dense_bbit = dense._bucket_arrays()
+            result.hll = np.array(dense_hll, dtype=self._hll_type)
+            result.bbit = np.array(dense_bbit, dtype=self._subbucket_type)
+            result._apply_entries(*sparse._sparse)
+            return result
+        hll_a, bbit_a = self._bucket_arrays()
+        hll_b, bbit_b = other._bucket_arrays()
+        take_other = union_take_other(hll_a, bbit_a, hll_b, bbit_b)
+        result.hll = np.where(take_other, hll_b, hll_a)
+        result.bbit = np.where(take_other, bbit_b, bbit_a)
+        return result
+
+    @_instrumented("union")
+    def merge_into(self, other):
+        '''Merges the sketch other into this sketch in place, reusing this sketch's
+        arrays, so that afterwards self is the HyperMinHash sketch of the union'''
+        self._check_compatible(other)
+        _add_counter("merges")
+        return self._merge_into(other)
+
+    def _merge_into(self, other):
+        '''Same as merge_into, for compatible sketches and without instrumentation'''
+        if self._packed is not None:
+            if other._packed is not None:
+                self._packed.merge(other._packed)
+                self.invalidate_count()
+            else:
+                self._apply_entries(*other._sparse_entries())
+            return self
+        if self._sparse is not None:
+            if other._sparse is None:
+                self.to_dense()
+            else:
+                self._set_sparse(*reduce_bucket_entries(*map(np.concatenate, zip(self._sparse, other._sparse))))
+                return self
+        if other._sparse is not None:
+            self._apply_entries(*other._sparse)
+            return self
+        other_hll, other_bbit = other._bucket_arrays()
+        take_other = union_take_other(self._hll, self._bbit, other_hll, other_bbit)
+        np.copyto(self._hll, other_hll, where=take_other)
+        np.copyto(self._bbit, other_bbit, where=take_other)
+        self.invalidate_count()
+        return self
+
+    def __iadd__(self, other):
+        '''In-place union; A += B is equivalent to A.merge_into(B)'''
+        return self.merge_into(other)
+
+    @classmethod
+    @_instrumented("union")
+    def union_many(cls, sketches, chunk_size=256):
+        '''Returns the HyperMinHash sketch of the union of a list of sketches
+
+        The buckets of up to chunk_size sketches at a time are stacked into 2-D arrays
+        and reduced in one pass, without creating intermediate sketch objects.'''
+        sketches = list(sketches)
+        if not sketches:
+            raise ValueError("union_many requires at least one sketch")
+        first = sketches[0]
+        for other in sketches[1:]:
+            first._check_compatible(other)
+        _add_counter("merges", len(sketches))
+        result = cls(first.bucketbits, first.bucketsize, first.subbucketsize, collision_correction=first.collision_correction, hasher=first.hasher)
+        for start in range(0, len(sketches), chunk_size):
+            chunk = sketches[start:start + chunk_size]
+            hll = np.stack([sketch.hll for sketch in chunk] + [result.hll])
+            bbit = np.stack([sketch.bbit for sketch in chunk] + [result.bbit])
+            result.hll = hll.max(axis=0)
+            # Among the sketches holding the maximal hll value, keep the minimal bbit
+            not_max = hll != result.hll
+            bbit[not_max] = np.iinfo(result._subbucket_type).max
+            result.bbit = bbit.min(axis=0)
         return result
 
     def __eq__(self, other):
@@ -216,6 +1396,7 @@ class HyperMinHash:
                 and (self.bucketsize == other.bucketsize)
                 and (self.subbucketsize == other.subbucketsize)
                 and (self.collision_correction == other.collision_correction)
+                and (self.hasher == other.hasher)
                 and np.array_equal(self.hll, other.hll)
                 and np.array_equal(self.bbit, other.bbit))
 
@@ -223,6 +1404,7 @@ class HyperMinHash:
         '''Returns False iff all parameters and buckets match'''
         return not (self == other)
 
+    @_instrumented("jaccard")
     def jaccard(self, other):
         '''Determines the Jaccard index of two sets using HyperMinHash sketches of them
 
@@ -231,21 +1413,14 @@ class HyperMinHash:
         the intersection computation return the expected value of 0.
         '''
         # Can only intersect if generation parameters were the same
-        assert(self.bucketbits == other.bucketbits)
-        assert(self.bucketsize == other.bucketsize)
-        assert(self.subbucketsize == other.subbucketsize)
-        self_nonzeros = np.logical_or(self.hll != 0, self.bbit != 0)
-        matches_with_zeros = np.logical_and(self.hll == other.hll, self.bbit == other.bbit)
-        matches = np.logical_and(self_nonzeros, matches_with_zeros)
-
-        match_num = sum(matches)
+        self._check_compatible(other)
+        _add_counter("comparisons_" + self.collision_correction)
+        match_num = self._match_count(other)
 
         union = self + other
 
-        if self.collision_correction == "approx":
-            collisions = float(collision_estimate_final(self.count(), other.count(), bucketsize=self.bucketsize, abb1=self.subbucketsize, bucketbits=self.bucketbits))
-        elif self.collision_correction == 'precise':
-            collisions = float(expected_collisions(self.count(), other.count(), bucketsize=self.bucketsize, abb1=self.subbucketsize, bucketbits=self.bucketbits))
+        if self.collision_correction in ("approx", "precise"):
+            collisions = estimate_collisions(self.collision_correction, self.count(), other.count(), bucketbits=self.bucketbits, bucketsize=self.bucketsize, abb1=self.subbucketsize)
         else:
             collisions = 0
 
@@ -257,6 +1432,23 @@ class HyperMinHash:
             jaccard = intersect_size / union_filled_buckets
         return jaccard
 
+    def _match_count(self, other):
+        '''Returns the number of nonempty buckets in which both sketches hold the same values'''
+        if self._sparse is not None or other._sparse is not None:
+            idx_a, hll_a, bbit_a = self._sparse_entries()
+            idx_b, hll_b, bbit_b = other._sparse_entries()
+            _, a, b = np.intersect1d(idx_a, idx_b, assume_unique=True, return_indices=True)
+            return np.count_nonzero((hll_a[a] == hll_b[b]) & (bbit_a[a] == bbit_b[b]) & ((hll_a[a] != 0) | (bbit_a[a] != 0)))
+        if self._packed is not None and other._packed is not None:
+            return self._packed.match_count(other._packed)
+        hll_a, bbit_a = self._bucket_arrays()
+        hll_b, bbit_b = other._bucket_arrays()
+        self_nonzeros = np.logical_or(hll_a != 0, bbit_a != 0)
+        matches_with_zeros = np.logical_and(hll_a == hll_b, bbit_a == bbit_b)
+        matches = np.logical_and(self_nonzeros, matches_with_zeros)
+        return np.count_nonzero(matches)
+
+    @_instrumented("intersection")
     def intersection(self, other):
         '''Intersects two HyperMinHash sketches and computes:
                 Intersection cardinality
@@ -273,25 +1465,479 @@ class HyperMinHash:
         return jaccard * union_cardinality, jaccard, intersect_size, union_cardinality
 
 
+class SketchCollection:
+    '''Stacks the buckets of many HyperMinHash sketches for all-pairs comparisons
+
+    The hll and bbit arrays of N sketches with identical parameters are stored as
+    contiguous (N, 2^bucketbits) matrices, and every sketch's cardinality is computed
+    once. Pairwise quantities are then computed block by block with vectorized
+    operations, and agree with calling HyperMinHash.jaccard/intersection on each pair,
+    up to floating-point rounding in the collision correction (union cardinalities go
+    through the same register histogram estimator as count).
+    '''
+    def __init__(self, sketches, collision_correction=None, max_block_elements=2**24):
+        '''sketches is a list of HyperMinHash sketches generated with the same parameters.
+
+           collision_correction defaults to that of the first sketch.
+           max_block_elements bounds the size of the (rows, columns, buckets) temporaries
+           used when comparing blocks of sketches, and hence the memory used.
+           '''
+        sketches = list(sketches)
+        if not sketches:
+            raise ValueError("SketchCollection requires at least one sketch")
+        first = sketches[0]
+        for other in sketches[1:]:
+            first._check_compatible(other)
+        self.bucketbits = first.bucketbits
+        self.bucketsize = first.bucketsize
+        self.subbucketsize = first.subbucketsize
+        if collision_correction is None:
+            collision_correction = first.collision_correction
+        self.collision_correction = collision_correction
+        self.max_block_elements = max_block_elements
+
+        self.hll = np.stack([sketch.hll for sketch in sketches])
+        self.bbit = np.stack([sketch.bbit for sketch in sketches])
+        self.nonzero = (self.hll != 0) | (self.bbit != 0)
+        self.filled = self.nonzero.sum(axis=1)
+        self.counts = np.array([sketch.count() for sketch in sketches], dtype=np.float64)
+
+    def __len__(self):
+        '''Returns:
+            int: number of sketches in the collection
+        '''
+        return len(self.hll)
+
+    def _block_size(self):
+        '''Number of sketches per block, so that a block pair stays within max_block_elements'''
+        return max(1, int(math.sqrt(self.max_block_elements / self.hll.shape[1])))
+
+    def _block_pairs(self, block_size=None):
+        '''Yields (rows, cols) slices covering the upper triangle of the N x N pair matrix'''
+        if block_size is None:
+            block_size = self._block_size()
+        n = len(self)
+        for a in range(0, n, block_size):
+            for b in range(a, n, block_size):
+                yield slice(a, min(a + block_size, n)), slice(b, min(b + block_size, n))
+
+    def _compare_block(self, rows, cols, union_counts=False):
+        '''Returns (matches, union_filled, collisions, union_cardinality) matrices for a block
+        of rows against a block of columns; union_cardinality is None unless requested'''
+        hll_a = self.hll[rows, np.newaxis, :]
+        bbit_a = self.bbit[rows, np.newaxis, :]
+        hll_b = self.hll[np.newaxis, cols, :]
+        bbit_b = self.bbit[np.newaxis, cols, :]
+        equal = (hll_a == hll_b) & (bbit_a == bbit_b) & self.nonzero[rows, np.newaxis, :]
+        matches = equal.sum(axis=2)
+        both_filled = np.dot(self.nonzero[rows].astype(np.float64), self.nonzero[cols].T.astype(np.float64))
+        union_filled = self.filled[rows, np.newaxis] + self.filled[np.newaxis, cols] - both_filled.astype(np.int64)
+
+        _add_counter("comparisons_" + self.collision_correction, matches.size)
+        collisions = np.zeros(matches.shape)
+        if self.collision_correction in ("approx", "precise"):
+            collisions, valid = estimate_collisions_array(self.collision_correction, self.counts[rows, np.newaxis], self.counts[np.newaxis, cols],
+                                                          bucketbits=self.bucketbits, bucketsize=self.bucketsize, abb1=self.subbucketsize)
+            if not valid.all():
+                raise ValueError("Cardinalities too large for approximate collision error handling")
+
+        union_cardinality = None
+        if union_counts:
+            # The union keeps the larger hll value of every bucket
+            union_hll = np.maximum(hll_a, hll_b).reshape(-1, self.hll.shape[1])
+
+            def union_bbit(k):
+                '''bbit arrays of the unions of the flattened (row, column) pairs k'''
+                r, c = np.divmod(k, hll_b.shape[1])
+                hll_r, bbit_r = self.hll[rows][r], self.bbit[rows][r]
+                hll_c, bbit_c = self.hll[cols][c], self.bbit[cols][c]
+                return np.where(union_take_other(hll_r, bbit_r, hll_c, bbit_c), bbit_c, bbit_r)
+            union_cardinality = _count_rows(union_hll, union_bbit, self.bucketbits, self.bucketsize,
+                                            self.subbucketsize).reshape(matches.shape)
+        return matches, union_filled, collisions, union_cardinality
+
+    @staticmethod
+    def _jaccard_from(matches, union_filled, collisions):
+        '''Jaccard index from bucket matches, union filled buckets and expected collisions'''
+        with np.errstate(divide="ignore", invalid="ignore"):
+            jaccard = (matches - collisions) / union_filled
+        return np.where(union_filled == 0, 0., jaccard)
+
+    def jaccard_matrix(self, block_size=None):
+        '''Returns the N x N matrix of estimated Jaccard indices between all pairs of sketches'''
+        n = len(self)
+        result = np.zeros((n, n))
+        for rows, cols in self._block_pairs(block_size):
+            matches, union_filled, collisions, _ = self._compare_block(rows, cols)
+            jaccard = self._jaccard_from(matches, union_filled, collisions)
+            result[rows, cols] = jaccard
+            result[cols, rows] = jaccard.T
+        return result
+
+    def intersection_matrix(self, block_size=None):
+        '''Returns the N x N matrix of estimated intersection cardinalities between all
+        pairs of sketches, i.e. the first element of HyperMinHash.intersection'''
+        n = len(self)
+        result = np.zeros((n, n))
+        for rows, cols in self._block_pairs(block_size):
+            matches, union_filled, collisions, union_cardinality = self._compare_block(rows, cols, union_counts=True)
+            intersection = self._jaccard_from(matches, union_filled, collisions) * union_cardinality
+            result[rows, cols] = intersection
+            result[cols, rows] = intersection.T
+        return result
+
+    def pairs_above(self, threshold, block_size=None):
+        '''Returns a list of (i, j, jaccard) for all pairs i < j whose estimated Jaccard
+        index is at least threshold, without materializing the full matrix'''
+        pairs = []
+        for rows, cols in self._block_pairs(block_size):
+            matches, union_filled, collisions, _ = self._compare_block(rows, cols)
+            jaccard = self._jaccard_from(matches, union_filled, collisions)
+            for r, c in zip(*np.nonzero(jaccard >= threshold)):
+                i, j = rows.start + r, cols.start + c
+                if i < j:
+                    pairs.append((i, j, float(jaccard[r, c])))
+        return pairs
+
+
+@_instrumented("query_many")
+def query_many(query, candidates, max_block_elements=2**24):
+    '''Compares one query sketch against many candidate sketches
+
+    Returns four arrays (intersection, jaccard, matches, union_cardinality) whose element
+    i is query.intersection(candidates[i]). The query's buckets, non-zero mask and
+    cardinality are computed once; the candidates are stacked in blocks of at most
+    max_block_elements buckets, and each block is matched against and united with the
+    query in vectorized passes, with union cardinalities computed from per-row register
+    histograms exactly as count does.'''
+    candidates = list(candidates)
+    for candidate in candidates:
+        query._check_compatible(candidate)
+    q_hll, q_bbit = query.hll, query.bbit
+    q_nonzero = (q_hll != 0) | (q_bbit != 0)
+    q_count = query.count()
+    n = len(candidates)
+    matches = np.zeros(n, dtype=np.int64)
+    union_filled = np.zeros(n, dtype=np.int64)
+    union_cardinality = np.zeros(n)
+    counts = np.zeros(n)
+    block_size = max(1, max_block_elements // len(q_hll))
+    for start in range(0, n, block_size):
+        block = candidates[start:start + block_size]
+        rows = slice(start, start + len(block))
+        hll = np.stack([candidate.hll for candidate in block])
+        bbit = np.stack([candidate.bbit for candidate in block])
+        matches[rows] = ((hll == q_hll) & (bbit == q_bbit) & q_nonzero).sum(axis=1)
+        union_filled[rows] = (q_nonzero | (hll != 0) | (bbit != 0)).sum(axis=1)
+
+        def union_bbit(k):
+            '''bbit arrays of the unions of the query with the candidates of the block rows k'''
+            take_other = union_take_other(q_hll, q_bbit, hll[k], bbit[k])
+            return np.where(take_other, bbit[k], q_bbit)
+        # The union keeps the larger hll value of every bucket
+        union_cardinality[rows] = _count_rows(np.maximum(hll, q_hll), union_bbit,
+                                              query.bucketbits, query.bucketsize, query.subbucketsize)
+        counts[rows] = [candidate.count() for candidate in block]
+    _add_counter("comparisons_" + query.collision_correction, n)
+    collisions = np.zeros(n)
+    if query.collision_correction in ("approx", "precise"):
+        collisions, valid = estimate_collisions_array(query.collision_correction, q_count, counts, bucketbits=query.bucketbits,
+                                                      bucketsize=query.bucketsize, abb1=query.subbucketsize)
+        if not valid.all():
+            raise ValueError("Cardinalities too large for approximate collision error handling")
+    jaccard = SketchCollection._jaccard_from(matches, union_filled, collisions)
+    intersect_size = np.round(jaccard * union_filled).astype(np.int64)
+    return jaccard * union_cardinality, jaccard, intersect_size, union_cardinality
+
+
+class LSHIndex:
+    '''Approximate nearest-neighbour index over HyperMinHash sketches, using LSH banding
+
+    The 2^bucketbits (hll, bbit) bucket tuples of every inserted sketch are split into
+    bands of rows_per_band consecutive buckets, and each band is stored in its own hash
+    table. Two sketches with Jaccard index J match in a given bucket with probability
+    about J, so they share at least one band with probability about
+        1 - (1 - J**rows_per_band)**num_bands.
+    Candidates sharing a band with the query are then verified with HyperMinHash.jaccard.
+    '''
+    def __init__(self, bucketbits, bucketsize, subbucketsize, rows_per_band=4, hasher="str"):
+        if (2**bucketbits) % rows_per_band != 0:
+            raise ValueError("rows_per_band must divide the number of buckets")
+        self.bucketbits = bucketbits
+        self.bucketsize = bucketsize
+        self.subbucketsize = subbucketsize
+        self.rows_per_band = rows_per_band
+        self.hasher = hasher
+        self.num_bands = 2**bucketbits // rows_per_band
+        self.tables = [dict() for _ in range(self.num_bands)]
+        self.sketches = dict()
+        self._band_keys = dict()
+
+    def __len__(self):
+        '''Returns:
+            int: number of sketches in the index
+        '''
+        return len(self.sketches)
+
+    def __contains__(self, key):
+        '''Returns True iff a sketch is stored under key'''
+        return key in self.sketches
+
+    def _bands(self, sketch):
+        '''Returns a list of (band number, band key) for the non-empty bands of sketch'''
+        assert(self.bucketbits == sketch.bucketbits)
+        assert(self.bucketsize == sketch.bucketsize)
+        assert(self.subbucketsize == sketch.subbucketsize)
+        if self.hasher != sketch.hasher:
+            raise ValueError("Cannot index a sketch built with hasher {} in an index of {} sketches".format(sketch.hasher, self.hasher))
+        hll = np.ascontiguousarray(sketch.hll).reshape(self.num_bands, self.rows_per_band)
+        bbit = np.ascontiguousarray(sketch.bbit).reshape(self.num_bands, self.rows_per_band)
+        # A band of empty buckets carries no information, and would match every small sketch
+        filled = np.nonzero(((hll != 0) | (bbit != 0)).any(axis=1))[0]
+        return [(band, hll[band].tobytes() + bbit[band].tobytes()) for band in filled]
+
+    def insert(self, key, sketch):
+        '''Adds sketch to the index under key, replacing any sketch already stored under key'''
+        if key in self.sketches:
+            self.remove(key)
+        bands = self._bands(sketch)
+        for band, band_key in bands:
+            self.tables[band].setdefault(band_key, set()).add(key)
+        self.sketches[key] = sketch
+        self._band_keys[key] = bands
+
+    def remove(self, key):
+        '''Removes the sketch stored under key from the index'''
+        for band, band_key in self._band_keys.pop(key):
+            keys = self.tables[band][band_key]
+            keys.discard(key)
+            if not keys:
+                del self.tables[band][band_key]
+        del self.sketches[key]
+
+    def candidates(self, sketch):
+        '''Returns the set of keys of stored sketches sharing at least one band with sketch'''
+        found = set()
+        for band, band_key in self._bands(sketch):
+            found.update(self.tables[band].get(band_key, ()))
+        return found
+
+    def query(self, sketch, threshold):
+        '''Returns a list of (key, jaccard) for the stored sketches whose estimated Jaccard
+        index with sketch is at least threshold, in decreasing order of Jaccard index.
+
+        Only candidates sharing a band with sketch are verified, so pairs near or below
+        the S-curve of the index may be missed.'''
+        results = []
+        for key in self.candidates(sketch):
+            jaccard = sketch.jaccard(self.sketches[key])
+            if jaccard >= threshold:
+                results.append((key, jaccard))
+        results.sort(key=lambda result: result[1], reverse=True)
+        return results
+
+
+class WindowedHyperMinHash:
+    '''HyperMinHash sketch of the items seen in a sliding window of recent epochs
+
+    Keeps a ring of one HyperMinHash sub-sketch per epoch for the last `epochs` epochs.
+    Items go into the sub-sketch of the current epoch; advance starts a new epoch and
+    drops the oldest one. Because the union of sub-sketches is the sketch of the union,
+    count, jaccard and intersection over any trailing window of up to `epochs` epochs
+    are answered from the sub-sketches, without rescanning the input.
+
+    Memory is at most `epochs` sketches; sub-sketches start sparse (see
+    HyperMinHash.to_sparse), so quiet epochs take little space, and nbytes reports the
+    total. An update costs the same as HyperMinHash.update on a single sketch. A window
+    query merges the window's sub-sketches, O(window * 2^bucketbits) for dense
+    sub-sketches; the union of the window's past epochs is cached until the next
+    advance, so repeated queries only merge it with the current epoch.'''
+    def __init__(self, bucketbits, bucketsize, subbucketsize, epochs, collision_correction="approx", hasher="str"):
+        if epochs < 1:
+            raise ValueError("epochs must be at least 1")
+        self.bucketbits = bucketbits
+        self.bucketsize = bucketsize
+        self.subbucketsize = subbucketsize
+        self.epochs = epochs
+        self.collision_correction = collision_correction
+        self.hasher = hasher
+        self.current_epoch = 0
+        self.sketches = collections.deque([self._new_sketch()], maxlen=epochs)
+        self._past_unions = dict()
+
+    def _new_sketch(self):
+        return HyperMinHash(self.bucketbits, self.bucketsize, self.subbucketsize, collision_correction=self.collision_correction,
+                            hasher=self.hasher, sparse=True)
+
+    @property
+    def nbytes(self):
+        '''Number of bytes used by the buckets of all sub-sketches'''
+        return sum(sketch.nbytes for sketch in self.sketches)
+
+    def advance(self, steps=1):
+        '''Starts a new epoch, steps times; sub-sketches older than `epochs` epochs are dropped'''
+        if steps < 0:
+            raise ValueError("Cannot advance by a negative number of epochs: {}".format(steps))
+        for _ in range(min(steps, self.epochs)):
+            self.sketches.append(self._new_sketch())
+        self.current_epoch += steps
+        self._past_unions.clear()
+
+    def advance_to(self, epoch):
+        '''Advances until the current epoch is epoch, e.g. int(time.time() // epoch_seconds)'''
+        if epoch < self.current_epoch:
+            raise ValueError("Cannot go back from epoch {} to epoch {}".format(self.current_epoch, epoch))
+        if epoch > self.current_epoch:
+            self.advance(epoch - self.current_epoch)
+
+    def update(self, l, epoch=None, batch_size=2**16):
+        '''Inserts a list of items l into the current epoch, after advancing to epoch if given'''
+        if epoch is not None:
+            self.advance_to(epoch)
+        self.sketches[-1].update(l, batch_size=batch_size)
+
+    def window(self, epochs=None):
+        '''Returns the HyperMinHash sketch of the items seen in the last epochs epochs,
+        including the current one; epochs defaults to the whole ring'''
+        if epochs is None:
+            epochs = self.epochs
+        if not 1 <= epochs <= self.epochs:
+            raise ValueError("window must be between 1 and {} epochs".format(self.epochs))
+        epochs = min(epochs, len(self.sketches))
+        past = self._past_unions.get(epochs)
+        if past is None:
+            past = self._new_sketch()
+            for sketch in list(self.sketches)[-epochs:-1]:
+                past.merge_into(sketch)
+            self._past_unions[epochs] = past
+        return past + self.sketches[-1]
+
+    def _other_window(self, other, epochs):
+        if isinstance(other, WindowedHyperMinHash):
+            return other.window(epochs)
+        return other
+
+    def count(self, window=None):
+        '''Returns an estimate of the cardinality of the items seen in the last window epochs'''
+        return self.window(window).count()
+
+    def jaccard(self, other, window=None):
+        '''Returns the Jaccard index of the items seen in the last window epochs with other,
+        a WindowedHyperMinHash (over the same window) or a HyperMinHash'''
+        return self.window(window).jaccard(self._other_window(other, window))
+
+    def intersection(self, other, window=None):
+        '''Same as HyperMinHash.intersection, over the last window epochs; see jaccard'''
+        return self.window(window).intersection(self._other_window(other, window))
+
+
+def hll_estimator_stacked(buckets):
+    '''Same as hll_estimator, applied along the last axis of an array of buckets'''
+    buckets = np.asarray(buckets)
+    bucketnum = buckets.shape[-1]
+    if buckets.dtype == np.uint8:
+        powers = _NEG_POW2[buckets]
+    else:
+        powers = np.exp2(-buckets.astype(np.float64))
+    res = _hll_alpha(bucketnum) * bucketnum**2 / powers.sum(axis=-1)
+    V = (buckets == 0).sum(axis=-1)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        linear = np.where(V != 0, bucketnum * np.log(bucketnum / V), res)  # linear counting
+        large = -(1 << 32) * np.log(1 - res / (1 << 32))
+    return np.where(res <= (5. / 2.) * bucketnum, linear,
+                    np.where(res <= (1. / 30.) * (1 << 32), res, large))
+
+
+def count_stacked(hll, bbit, bucketbits, bucketsize, subbucketsize):
+    '''Same as HyperMinHash.count, applied along the last axis of stacked hll and bbit arrays'''
+    hll_count = hll_estimator_stacked(hll)
+    if bucketsize == 0:
+        vals = bbit.astype(np.float64) / 2**subbucketsize
+    else:
+        vals = np.exp2(-hll.astype(np.float64)) * (1 + bbit.astype(np.float64) / 2**subbucketsize)
+    total = vals.sum(axis=-1)
+    with np.errstate(divide="ignore"):
+        minhash_count = np.where(total == 0, float('Inf'), hll.shape[-1] * hll.shape[-1] / total)
+    if bucketsize == 0:
+        return minhash_count
+    return np.where(hll_count < 2**(bucketbits + 10), hll_count, minhash_count)
+
+
+def _count_rows(hll, bbit_rows, bucketbits, bucketsize, subbucketsize):
+    '''Same as HyperMinHash.count for every row of a stacked hll array, where
+    bbit_rows(k) returns the bbit arrays of the rows k, which are only built for the
+    rows that need the MinHash estimator
+
+    Unlike count_stacked, every row goes through the register histogram, as count does,
+    so the estimates are identical to those of the corresponding sketches.'''
+    rows, bucketnum = hll.shape
+    counts = np.zeros(rows)
+    if bucketsize > 0:
+        width = 2**bucketsize + 1
+        offsets = (np.arange(rows) * width)[:, np.newaxis]
+        histograms = np.bincount((offsets + hll).ravel(), minlength=rows * width).reshape(rows, width)
+        harmonic_sums = histograms.dot(np.exp2(-np.arange(width, dtype=np.float64)))
+        for k, (harmonic_sum, V) in enumerate(zip(harmonic_sums, histograms[:, 0])):
+            counts[k] = _hll_range_corrections(_hll_alpha(bucketnum) * bucketnum**2 / float(harmonic_sum), bucketnum, V)
+        minhash_rows = np.flatnonzero(counts >= 2**(bucketbits + 10))
+    else:
+        minhash_rows = np.arange(rows)
+    if len(minhash_rows):
+        bbit = bbit_rows(minhash_rows)
+        if bucketsize > 0:
+            vals_sums = np.einsum("ij,ij->i", _NEG_POW2[hll[minhash_rows]], 1 + bbit / 2**subbucketsize)
+        else:
+            vals_sums = np.sum(bbit, axis=1, dtype=np.float64) / 2**subbucketsize
+        with np.errstate(divide="ignore"):
+            counts[minhash_rows] = np.where(vals_sums == 0, float('Inf'), 2**bucketbits * 2**bucketbits / vals_sums)
+    return counts
+
+
+def _hll_alpha(bucketnum):
+    '''Returns the HLL bias correction constant alpha for bucketnum buckets'''
+    if bucketnum == 16:
+        return 0.673
+    elif bucketnum == 32:
+        return 0.697
+    elif bucketnum == 64:
+        return 0.709
+    return 0.7213 / (1 + 1.079 / bucketnum)
+
+
+def register_histogram(buckets):
+    '''Returns the histogram of integer bucket values: element k is the number of buckets equal to k'''
+    return np.bincount(np.asarray(buckets).ravel().astype(np.intp, copy=False))
+
+
 def hll_estimator(buckets):
     '''Returns cardinality based on HLL estimator, given a list of buckets,
     each with a single integer specifying the maximum number of leading zeros
     within that bucket.
+
+    Integer buckets are reduced to a histogram of their values, so only one 2^-k term
+    per distinct value is computed.
     '''
-    buckets = np.float64(np.asarray((buckets)))
+    buckets = np.asarray(buckets)
     bucketnum = len(buckets)
-    if bucketnum == 16:
-        alpha = 0.673
-    elif bucketnum == 32:
-        alpha = 0.697
-    elif bucketnum == 64:
-        alpha = 0.709
-    else:
-        alpha = 0.7213 / (1 + 1.079 / bucketnum)
+    if buckets.dtype.kind in "ui" and bucketnum > 0 and buckets.min() >= 0:
+        return hll_estimator_histogram(register_histogram(buckets))
+    buckets = buckets.astype(np.float64)
+    harmonic_sum = np.exp2(-buckets).sum()
+    V = np.count_nonzero(buckets == 0)
+    return _hll_range_corrections(_hll_alpha(bucketnum) * bucketnum**2 / float(harmonic_sum), bucketnum, V)
+
+
+def hll_estimator_histogram(histogram):
+    '''Same as hll_estimator, given the histogram of the bucket values (see register_histogram)'''
+    bucketnum = int(np.sum(histogram))
+    harmonic_sum = np.dot(histogram, np.exp2(-np.arange(len(histogram), dtype=np.float64)))
+    return _hll_range_corrections(_hll_alpha(bucketnum) * bucketnum**2 / float(harmonic_sum), bucketnum, histogram[0])
+
 
-    res = alpha * bucketnum**2 * 1 / sum([2**-val for val in buckets])
+def _hll_range_corrections(res, bucketnum, V):
+    '''Applies the HLL small range (linear counting) and large range corrections to the
+    raw estimate res, where V is the number of zero buckets'''
     if res <= (5. / 2.) * bucketnum:
-        V = sum(val == 0 for val in buckets)
         if V != 0:
             res2 = bucketnum * math.log(bucketnum / V)  # linear counting
         else:
@@ -303,8 +1949,60 @@ def hll_estimator(buckets):
     return res2
 
 
+def _ertl_sigma(x):
+    '''sigma(x) = x + sum_k x^(2^k) 2^(k-1), from Ertl (2017)'''
+    if x == 1:
+        return float('Inf')
+    y = 1.
+    z = x
+    while True:
+        x = x * x
+        z_old = z
+        z += x * y
+        y += y
+        if z == z_old:
+            return z
+
+
+def _ertl_tau(x):
+    '''tau(x) = (1 - x - sum_k (1 - x^(2^-k))^2 2^-k) / 3, from Ertl (2017)'''
+    if x == 0 or x == 1:
+        return 0.
+    y = 1.
+    z = 1 - x
+    while True:
+        x = math.sqrt(x)
+        z_old = z
+        y *= 0.5
+        z -= (1 - x)**2 * y
+        if z == z_old:
+            return z / 3
+
+
+def improved_estimator(histogram, max_value):
+    '''Returns cardinality based on Ertl's improved HLL estimator, given the histogram of
+    the bucket values and the value max_value at which buckets saturate.
+
+    See Otmar Ertl. New cardinality estimation algorithms for HyperLogLog sketches. (2017)
+    https://arxiv.org/abs/1702.01284
+
+    The estimator needs no empirical bias correction and no switch to linear counting,
+    and its cost depends only on max_value, not on the number of buckets.
+    '''
+    histogram = np.asarray(histogram, dtype=np.float64)
+    counts = np.zeros(max_value + 1)
+    counts[:min(len(histogram), max_value + 1)] = histogram[:max_value + 1]
+    bucketnum = counts.sum()
+    z = bucketnum * _ertl_tau(1 - counts[max_value] / bucketnum)
+    for k in range(max_value - 1, 0, -1):
+        z = 0.5 * (z + counts[k])
+    z += bucketnum * _ertl_sigma(counts[0] / bucketnum)
+    return bucketnum**2 / (2 * math.log(2) * z)
+
+
 def expected_collisions(x_size, y_size, bucketbits=0, bucketsize=6, abb1=10, decimal_prec=True):
     '''Expected number of collisions (exact, assuming sufficient precision)'''
+    import decimal
     num_hll_buckets = 2**bucketsize
     if (decimal_prec):
         decimal.getcontext().prec = 100
@@ -337,6 +2035,81 @@ def expected_collisions(x_size, y_size, bucketbits=0, bucketsize=6, abb1=10, dec
     return cp * bb2
 
 
+@functools.lru_cache(maxsize=32)
+def collision_table(bucketbits, bucketsize, abb1):
+    '''Returns the parameter-dependent part of expected_collisions as a pair of arrays (l1, d)
+
+    For every (HLL value, subbucket value) cell with bounds b1 < b2 used in
+    expected_collisions, l1 = log(1 - b1) and d = log((1 - b1) / (1 - b2)), so that
+        (1 - b1)**n - (1 - b2)**n = exp(n * l1) * (1 - exp(-n * d))
+    can be evaluated for any cardinality n in a single vectorized pass.
+    Tables are cached per (bucketbits, bucketsize, abb1).
+    '''
+    num_hll_buckets = 2**bucketsize
+    i = np.arange(1, num_hll_buckets + 1, dtype=np.float64)[:, np.newaxis]
+    j = np.arange(2**abb1, dtype=np.float64)[np.newaxis, :]
+    last = i == num_hll_buckets
+    # Cell bounds of expected_collisions; the cell width is computed directly so it stays exact
+    b1 = np.where(last, j / 2**(i + abb1 - 1), (2**abb1 + j) / 2**(i + abb1)) / 2**bucketbits
+    width = np.where(last, 1 / 2**(i + abb1 - 1), 1 / 2**(i + abb1)) / 2**bucketbits
+    b2 = b1 + width
+    with np.errstate(divide="ignore"):
+        l1 = np.log1p(-b1).ravel()
+        d = np.log1p(width / (1 - b2)).ravel()
+    l1.setflags(write=False)
+    d.setflags(write=False)
+    return l1, d
+
+
+def expected_collisions_tabulated(x_size, y_size, bucketbits=0, bucketsize=6, abb1=10):
+    '''Expected number of collisions, as computed by expected_collisions, but evaluated in
+    float64 from the cached collision_table instead of with big decimals'''
+    if x_size == 0 or y_size == 0:
+        return 0.
+    l1, d = collision_table(bucketbits, bucketsize, abb1)
+    # l1 is 0 in the cell starting at b1 = 0, where (1 - b1)**n = 1 even for infinite n
+    with np.errstate(invalid="ignore"):
+        pr_x = np.exp(np.where(l1 == 0, 0., x_size * l1)) * -np.expm1(-x_size * d)
+        pr_y = np.exp(np.where(l1 == 0, 0., y_size * l1)) * -np.expm1(-y_size * d)
+    return float(np.dot(pr_x, pr_y)) * 2**bucketbits
+
+
+def expected_collisions_tabulated_array(x_sizes, y_sizes, bucketbits=0, bucketsize=6, abb1=10, max_block_elements=2**22):
+    '''Same as expected_collisions_tabulated for arrays of cardinalities x_sizes and
+    y_sizes, broadcast against each other
+
+    The cell probabilities of every distinct cardinality are computed once, and all pairs
+    are combined by matrix products, in blocks of at most max_block_elements cells.'''
+    x, y = np.broadcast_arrays(np.asarray(x_sizes, dtype=np.float64), np.asarray(y_sizes, dtype=np.float64))
+    x_values, x_index = np.unique(x, return_inverse=True)
+    y_values, y_index = np.unique(y, return_inverse=True)
+    l1, d = collision_table(bucketbits, bucketsize, abb1)
+    block_size = max(1, max_block_elements // len(l1))
+
+    def cell_probabilities(sizes):
+        sizes = sizes[:, np.newaxis]
+        with np.errstate(invalid="ignore"):
+            return np.exp(np.where(l1 == 0, 0., sizes * l1)) * -np.expm1(-sizes * d)
+    products = np.zeros((len(x_values), len(y_values)))
+    for a in range(0, len(x_values), block_size):
+        pr_x = cell_probabilities(x_values[a:a + block_size])
+        for b in range(0, len(y_values), block_size):
+            products[a:a + block_size, b:b + block_size] = pr_x.dot(cell_probabilities(y_values[b:b + block_size]).T)
+    collisions = products[x_index.reshape(x.shape), y_index.reshape(y.shape)] * 2**bucketbits
+    return np.where((x == 0) | (y == 0), 0., collisions)
+
+
+@_instrumented("collisions")
+def estimate_collisions(collision_correction, x_size, y_size, bucketbits=0, bucketsize=6, abb1=10):
+    '''Expected number of bucket collisions between two sketches of cardinalities x_size
+    and y_size, using the method named by collision_correction ("approx" or "precise")'''
+    if collision_correction == "approx":
+        return float(collision_estimate_final(x_size, y_size, bucketbits=bucketbits, bucketsize=bucketsize, abb1=abb1))
+    elif collision_correction == "precise":
+        return float(expected_collisions_tabulated(x_size, y_size, bucketbits=bucketbits, bucketsize=bucketsize, abb1=abb1))
+    raise ValueError("Unknown collision_correction {}".format(collision_correction))
+
+
 def collision_estimate_hll_divided(x_size, y_size, bucketbits=0, bucketsize=6, abb1=10):
     '''Estimates collisions by just summing up the collision probability within HyperLogLog buckets, and then dividing by 2^[# subbuckets]'''
     cp = 0
@@ -362,6 +2135,20 @@ def collision_estimate_hll_divided(x_size, y_size, bucketbits=0, bucketsize=6, a
     return cp * bb2 / 2**abb1
 
 
+def collision_estimate_hll_divided_array(x_sizes, y_sizes, bucketbits=0, bucketsize=6, abb1=10):
+    '''Same as collision_estimate_hll_divided for arrays of cardinalities x_sizes and
+    y_sizes, broadcast against each other, with the HyperLogLog buckets along an extra axis'''
+    n = np.asarray(x_sizes, dtype=np.float64)[..., np.newaxis]
+    m = np.asarray(y_sizes, dtype=np.float64)[..., np.newaxis]
+    num_hll_buckets = 2**bucketsize
+    i = np.arange(1, num_hll_buckets + 1, dtype=np.float64)
+    b1 = np.where(i != num_hll_buckets, 2**-i, 0.) / 2**bucketbits
+    b2 = 2**(-i + 1) / 2**bucketbits
+    pr_x = (1 - b1)**n - (1 - b2)**n
+    pr_y = (1 - b1)**m - (1 - b2)**m
+    return np.sum(pr_x * pr_y, axis=-1) * 2**bucketbits / 2**abb1
+
+
 def collision_estimate_final(x_size, y_size, bucketbits=0, bucketsize=6, abb1=10):
     '''Estimates collisions by using an asymptotic approximation for large cardinalities, or using collision_estimate0 for small cardinalities.
 
@@ -388,3 +2175,61 @@ def collision_estimate_final(x_size, y_size, bucketbits=0, bucketsize=6, abb1=10
         return 0.169919487159739093975315012348630288992889 * 2**p * ratio_factor / 2**r
     else:
         return collision_estimate_hll_divided(x_size, y_size, bucketbits, bucketsize, abb1)
+
+
+def collision_estimate_final_array(x_sizes, y_sizes, bucketbits=0, bucketsize=6, abb1=10):
+    '''Same as collision_estimate_final for arrays of cardinalities x_sizes and y_sizes,
+    broadcast against each other
+
+    Returns (estimates, valid). Instead of raising on cardinalities too large for the
+    approximation, valid is False, and the estimate NaN, for those pairs. Pairs using the
+    high cardinality approximation with an empty set have no collisions.'''
+    x, y = np.broadcast_arrays(np.asarray(x_sizes, dtype=np.float64), np.asarray(y_sizes, dtype=np.float64))
+    n = np.maximum(x, y)
+    m = np.minimum(x, y)
+    p = bucketbits
+    qhat = 2**bucketsize  # num_hll_buckets
+    r = abb1
+
+    valid = n <= 2.**(qhat + r + p - 10)
+    high = n > 2**(p + 5)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        ratio = n / m
+        ratio_factor = np.where(m == 0, 0., 4 * ratio / (1 + ratio)**2)
+    estimates = 0.169919487159739093975315012348630288992889 * 2**p * ratio_factor / 2**r
+    low = ~high
+    estimates[low] = collision_estimate_hll_divided_array(x[low], y[low], bucketbits, bucketsize, abb1)
+    estimates[~valid] = np.nan
+    return estimates, valid
+
+
+@_instrumented("collisions")
+def estimate_collisions_array(collision_correction, x_sizes, y_sizes, bucketbits=0, bucketsize=6, abb1=10):
+    '''Same as estimate_collisions for arrays of cardinalities x_sizes and y_sizes,
+    broadcast against each other
+
+    Returns (estimates, valid), where valid is False, and the estimate NaN, for the pairs
+    that estimate_collisions rejects.'''
+    if collision_correction == "approx":
+        return collision_estimate_final_array(x_sizes, y_sizes, bucketbits=bucketbits, bucketsize=bucketsize, abb1=abb1)
+    elif collision_correction == "precise":
+        estimates = expected_collisions_tabulated_array(x_sizes, y_sizes, bucketbits=bucketbits, bucketsize=bucketsize, abb1=abb1)
+        return estimates, np.ones(estimates.shape, dtype=bool)
+    raise ValueError("Unknown collision_correction {}".format(collision_correction))
+
+
+def load_sketch(path):
+    '''Returns the HyperMinHash sketch serialized in the file at path'''
+    with open(path, "rb") as f:
+        return HyperMinHash.deserialize(f.read())
+
+
+def save_sketch(sketch, path, compression=None):
+    '''Writes sketch to the file at path in the serialize format, compressed if compression is given'''
+    with open(path, "wb") as f:
+        f.write(sketch.serialize(compression=compression))
+
+
+if __name__ == "__main__":
+    from hyperminhash_cli import main
+    main()
@@ -0,0 +1,132 @@
+#!/usr/bin/env python3
+'''Streaming command line interface: python -m hyperminhash build|merge|count|jaccard
+
+The hyperminhash module runs main from this module when executed, and imports it on
+first access of main or read_item_batches, so that argparse and gzip are not loaded
+with the core sketch type.'''
+import argparse
+import gzip
+import sys
+import time
+from hyperminhash import HyperMinHash, HASHERS, COMPRESSORS, load_sketch, save_sketch
+
+_GZIP_MAGIC = b"\x1f\x8b"
+
+
+def _open_input(path):
+    '''Opens path ("-" for stdin) for binary reading, transparently decompressing gzip input'''
+    if path == "-":
+        if sys.stdin.buffer.peek(2)[:2] == _GZIP_MAGIC:
+            return gzip.GzipFile(fileobj=sys.stdin.buffer, mode="rb")
+        return sys.stdin.buffer
+    with open(path, "rb") as f:
+        compressed = f.read(2) == _GZIP_MAGIC
+    # gzip.open owns the file it opens, so closing it also closes the file
+    return gzip.open(path, "rb") if compressed else open(path, "rb")
+
+
+def read_item_batches(path, record_size=None, chunk_bytes=2**22):
+    '''Yields batches of items read from path ("-" for stdin), which may be gzip compressed
+
+    The input is read in chunks of about chunk_bytes, so memory use is bounded. If
+    record_size is None, every newline-delimited line is an item (as a str, without the
+    newline); otherwise every record_size bytes form one item (as bytes).'''
+    f = _open_input(path)
+    try:
+        remainder = b""
+        while True:
+            chunk = f.read(chunk_bytes)
+            if not chunk:
+                break
+            chunk = remainder + chunk
+            if record_size is None:
+                lines = chunk.split(b"\n")
+                remainder = lines.pop()
+                yield [line.decode("utf-8") for line in lines]
+            else:
+                end = len(chunk) - len(chunk) % record_size
+                remainder = chunk[end:]
+                yield [chunk[start:start + record_size] for start in range(0, end, record_size)]
+        if remainder:
+            if record_size is None:
+                yield [remainder.decode("utf-8")]
+            else:
+                raise ValueError("Trailing partial record of {} bytes in {}".format(len(remainder), path))
+    finally:
+        if f is not sys.stdin.buffer:
+            f.close()
+
+
+def _cli_build(args):
+    sketch = HyperMinHash(args.bucketbits, args.bucketsize, args.subbucketsize, collision_correction=args.collision_correction, hasher=args.hasher)
+    num_items = 0
+    starttime = time.time()
+    for path in args.inputs:
+        for batch in read_item_batches(path, record_size=args.record_size, chunk_bytes=args.chunk_bytes):
+            sketch.update_batch(batch)
+            num_items += len(batch)
+    elapsedtime = time.time() - starttime
+    save_sketch(sketch, args.output, compression=args.compression)
+    print("Items:\t{}\t|\tTime (s):\t{:.3f}\t|\tItems/s:\t{:.0f}".format(
+        num_items, elapsedtime, num_items / elapsedtime if elapsedtime > 0 else float('Inf')), file=sys.stderr)
+
+
+def _cli_merge(args):
+    sketch = load_sketch(args.inputs[0])
+    for path in args.inputs[1:]:
+        sketch.merge_into(load_sketch(path))
+    save_sketch(sketch, args.output, compression=args.compression)
+
+
+def _cli_count(args):
+    for path in args.inputs:
+        print("{}\t{}".format(path, load_sketch(path).count()))
+
+
+def _cli_jaccard(args):
+    sketch_a = load_sketch(args.first)
+    for path in args.others:
+        intersection, jaccard, matches, union = sketch_a.intersection(load_sketch(path))
+        print("{}\t{}\t{}\t{}\t{}".format(args.first, path, jaccard, intersection, union))
+
+
+def main(argv=None):
+    '''Command line interface: python -m hyperminhash build|merge|count|jaccard'''
+    parser = argparse.ArgumentParser(prog="python -m hyperminhash", description="Build, merge and query HyperMinHash sketches")
+    subparsers = parser.add_subparsers(dest="command")
+    subparsers.required = True
+
+    build = subparsers.add_parser("build", help="sketch newline-delimited or fixed-size binary records from files or stdin")
+    build.add_argument("inputs", nargs="+", help="input files, optionally gzip compressed; - for stdin")
+    build.add_argument("-o", "--output", required=True, help="output sketch file")
+    build.add_argument("--bucketbits", type=int, default=14)
+    build.add_argument("--bucketsize", type=int, default=6)
+    build.add_argument("--subbucketsize", type=int, default=10)
+    build.add_argument("--collision-correction", choices=["approx", "precise", "false"], default="approx")
+    build.add_argument("--hasher", choices=sorted(HASHERS), default="str", help="hash function; native hashes raw bytes and is faster")
+    build.add_argument("--record-size", type=int, default=None, help="read fixed-size binary records of this many bytes instead of lines")
+    build.add_argument("--chunk-bytes", type=int, default=2**22, help="bytes read from the input at a time")
+    build.add_argument("--compression", choices=sorted(COMPRESSORS), default=None, help="write the compressed sketch format")
+    build.set_defaults(func=_cli_build)
+
+    merge = subparsers.add_parser("merge", help="write the union of several sketch files")
+    merge.add_argument("inputs", nargs="+", help="input sketch files")
+    merge.add_argument("-o", "--output", required=True, help="output sketch file")
+    merge.add_argument("--compression", choices=sorted(COMPRESSORS), default=None, help="write the compressed sketch format")
+    merge.set_defaults(func=_cli_merge)
+
+    count = subparsers.add_parser("count", help="print the estimated cardinality of sketch files")
+    count.add_argument("inputs", nargs="+", help="input sketch files")
+    count.set_defaults(func=_cli_count)
+
+    jaccard = subparsers.add_parser("jaccard", help="print the Jaccard index, intersection and union cardinality of a sketch against others")
+    jaccard.add_argument("first", help="sketch file")
+    jaccard.add_argument("others", nargs="+", help="sketch files to compare against")
+    jaccard.set_defaults(func=_cli_jaccard)
+
+    args = parser.parse_args(argv)
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
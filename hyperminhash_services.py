@@ -0,0 +1,348 @@
+#!/usr/bin/env python3
+'''Keyed HyperMinHash sketch services: SketchStore, a sqlite3-backed store, and
+AsyncSketchService, an asyncio ingestion front end
+
+Both are also available from the hyperminhash module, which imports this module (and
+sqlite3 and asyncio) on first use.'''
+import asyncio
+import collections
+import itertools
+import sqlite3
+import numpy as np
+from hyperminhash import HyperMinHash
+
+
+class SketchStore:
+    '''Persistent store of HyperMinHash sketches keyed by entity ID, in a sqlite3 file
+
+    Sketches are stored in the serialize format (compressed if compression is given).
+    Recently used sketches are kept deserialized in an LRU cache holding at most
+    cache_bytes of buckets (see HyperMinHash.nbytes), so repeated merge_update calls
+    on a hot key update the cached sketch in place rather than round-tripping it through
+    deserialize. Modified sketches are written back in transactions of up to
+    write_batch_size sketches, when evicted or when flush or close is called; writes
+    not yet flushed are lost if the process dies.
+
+    New keys get sparse sketches with the parameters given here. Sketches returned by
+    get are shared with the cache and must only be modified through the store.
+    '''
+    def __init__(self, path, bucketbits, bucketsize, subbucketsize, collision_correction="approx", hasher="str",
+                 cache_bytes=2**28, write_batch_size=256, compression=None):
+        self.bucketbits = bucketbits
+        self.bucketsize = bucketsize
+        self.subbucketsize = subbucketsize
+        self.collision_correction = collision_correction
+        self.hasher = hasher
+        self.cache_bytes = cache_bytes
+        self.write_batch_size = write_batch_size
+        self.compression = compression
+        self._db = sqlite3.connect(path)
+        self._db.execute("CREATE TABLE IF NOT EXISTS sketches (key PRIMARY KEY, sketch BLOB NOT NULL)")
+        self._db.commit()
+        self._cache = collections.OrderedDict()
+        self._sizes = dict()
+        self._cached_bytes = 0
+        self._dirty = set()
+        # Serialized sketches evicted from the cache, waiting for the next batched write
+        self._pending = dict()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _load(self, key):
+        '''Returns the sketch stored under key, loading it into the cache, or None'''
+        sketch = self._cache.get(key)
+        if sketch is not None:
+            self._cache.move_to_end(key)
+            return sketch
+        data = self._pending.get(key)
+        if data is None:
+            row = self._db.execute("SELECT sketch FROM sketches WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return None
+            data = row[0]
+        sketch = HyperMinHash.deserialize(data, sparse=True)
+        self._cache[key] = sketch
+        self._sizes[key] = 0
+        self._resized(key)
+        return sketch
+
+    def _resized(self, key):
+        '''Updates the cache accounting after the sketch under key was loaded or modified'''
+        size = self._cache[key].nbytes
+        self._cached_bytes += size - self._sizes[key]
+        self._sizes[key] = size
+        # The most recently used sketch stays cached even if it exceeds the budget alone
+        while self._cached_bytes > self.cache_bytes and len(self._cache) > 1:
+            old_key, old_sketch = self._cache.popitem(last=False)
+            self._cached_bytes -= self._sizes.pop(old_key)
+            if old_key in self._dirty:
+                self._dirty.discard(old_key)
+                self._pending[old_key] = old_sketch.serialize(compression=self.compression)
+        if len(self._pending) >= self.write_batch_size:
+            self._write_pending()
+
+    def _modified(self, key):
+        self._dirty.add(key)
+        self._resized(key)
+        if len(self._dirty) >= self.write_batch_size:
+            self.flush()
+
+    def _write_pending(self):
+        if self._pending:
+            with self._db:
+                self._db.executemany("INSERT OR REPLACE INTO sketches (key, sketch) VALUES (?, ?)", self._pending.items())
+            self._pending.clear()
+
+    def flush(self):
+        '''Writes all modified sketches to the file in one transaction'''
+        for key in self._dirty:
+            self._pending[key] = self._cache[key].serialize(compression=self.compression)
+        self._dirty.clear()
+        self._write_pending()
+
+    def close(self):
+        '''Flushes modified sketches and closes the file'''
+        self.flush()
+        self._db.close()
+
+    def get(self, key, default=None):
+        '''Returns the sketch stored under key, or default'''
+        sketch = self._load(key)
+        return default if sketch is None else sketch
+
+    def __getitem__(self, key):
+        sketch = self._load(key)
+        if sketch is None:
+            raise KeyError(key)
+        return sketch
+
+    def put(self, key, sketch):
+        '''Stores sketch under key, replacing any stored sketch; the store keeps sketch itself'''
+        if key in self._cache:
+            self._cache.move_to_end(key)
+        else:
+            self._sizes[key] = 0
+        self._cache[key] = sketch
+        self._pending.pop(key, None)
+        self._modified(key)
+
+    __setitem__ = put
+
+    def merge(self, key, sketch):
+        '''Merges sketch into the sketch stored under key, which is created if missing'''
+        stored = self._load(key)
+        if stored is None:
+            stored = HyperMinHash(sketch.bucketbits, sketch.bucketsize, sketch.subbucketsize, collision_correction=sketch.collision_correction,
+                                  hasher=sketch.hasher, sparse=True)
+            self.put(key, stored)
+        stored.merge_into(sketch)
+        self._modified(key)
+        return stored
+
+    def merge_update(self, key, items):
+        '''Inserts items into the sketch stored under key, which is created if missing'''
+        stored = self._load(key)
+        if stored is None:
+            stored = HyperMinHash(self.bucketbits, self.bucketsize, self.subbucketsize, collision_correction=self.collision_correction,
+                                  hasher=self.hasher, sparse=True)
+            self.put(key, stored)
+        stored.update(items)
+        self._modified(key)
+        return stored
+
+    def __delitem__(self, key):
+        if key not in self:
+            raise KeyError(key)
+        if key in self._cache:
+            del self._cache[key]
+            self._cached_bytes -= self._sizes.pop(key)
+        self._dirty.discard(key)
+        self._pending.pop(key, None)
+        with self._db:
+            self._db.execute("DELETE FROM sketches WHERE key = ?", (key,))
+
+    def __contains__(self, key):
+        if key in self._cache or key in self._pending:
+            return True
+        return self._db.execute("SELECT 1 FROM sketches WHERE key = ?", (key,)).fetchone() is not None
+
+    def keys(self):
+        '''Returns a list of all stored keys'''
+        self.flush()
+        return [row[0] for row in self._db.execute("SELECT key FROM sketches")]
+
+    def __len__(self):
+        '''Returns:
+            int: number of stored sketches
+        '''
+        self.flush()
+        return self._db.execute("SELECT COUNT(*) FROM sketches").fetchone()[0]
+
+
+class _IngestKey:
+    '''Queue, sketch and progress counters of one key of an AsyncSketchService'''
+    def __init__(self, sketch, max_queue):
+        self.sketch = sketch
+        self.queue = asyncio.Queue(max_queue)
+        self.lock = asyncio.Lock()
+        self.applied = asyncio.Condition()
+        self.num_enqueued = 0
+        self.num_applied = 0
+        self.error = None
+        self.task = None
+
+
+def _concat_chunks(chunks):
+    '''Joins chunks of items into one batch for HyperMinHash.update'''
+    if all(isinstance(chunk, np.ndarray) for chunk in chunks):
+        return np.concatenate(chunks)
+    return list(itertools.chain.from_iterable(chunks))
+
+
+class AsyncSketchService:
+    '''asyncio front end that ingests items into HyperMinHash sketches keyed by stream
+
+    Producers call add or add_many from coroutines; every call enqueues one chunk on the
+    bounded queue of its key, so producers wait (backpressure) once max_queue chunks of a
+    key are waiting. One consumer task per key coalesces waiting chunks into batches of
+    about batch_size items and inserts them with HyperMinHash.update in executor
+    (the event loop's default executor if None), so the event loop is never blocked by
+    hashing. count, jaccard and intersection wait until every chunk enqueued before the
+    call has been inserted, then query the sketches in the executor. If inserting a chunk
+    raises, only that chunk is dropped, and the next query on its key raises the error once.
+
+    Use as `async with AsyncSketchService(...) as service:`, or call close when done.
+    '''
+    def __init__(self, bucketbits, bucketsize, subbucketsize, collision_correction="approx", hasher="str",
+                 batch_size=2**16, max_queue=1024, executor=None):
+        self.bucketbits = bucketbits
+        self.bucketsize = bucketsize
+        self.subbucketsize = subbucketsize
+        self.collision_correction = collision_correction
+        self.hasher = hasher
+        self.batch_size = batch_size
+        self.max_queue = max_queue
+        self.executor = executor
+        self._keys = dict()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    def keys(self):
+        '''Returns a list of the keys that items were added to'''
+        return list(self._keys)
+
+    def _state(self, key):
+        state = self._keys.get(key)
+        if state is None:
+            sketch = HyperMinHash(self.bucketbits, self.bucketsize, self.subbucketsize, collision_correction=self.collision_correction,
+                                  hasher=self.hasher, sparse=True)
+            state = self._keys[key] = _IngestKey(sketch, self.max_queue)
+            state.task = asyncio.ensure_future(self._consume(state))
+        return state
+
+    async def _insert(self, state, chunks):
+        async with state.lock:
+            await asyncio.get_running_loop().run_in_executor(self.executor, state.sketch.update, _concat_chunks(chunks),
+                                                             self.batch_size)
+
+    async def _consume(self, state):
+        while True:
+            chunks = [await state.queue.get()]
+            try:
+                size = len(chunks[0])
+                while size < self.batch_size and not state.queue.empty():
+                    chunks.append(state.queue.get_nowait())
+                    size += len(chunks[-1])
+                await self._insert(state, chunks)
+            except Exception as e:
+                error = e
+                if len(chunks) > 1:
+                    # Insert the chunks one at a time, so that only the failing ones are lost;
+                    # reinserting items already inserted leaves the sketch unchanged
+                    error = None
+                    for chunk in chunks:
+                        try:
+                            await self._insert(state, [chunk])
+                        except Exception as e:
+                            error = e
+                if error is not None:
+                    state.error = error
+            finally:
+                for _ in chunks:
+                    state.queue.task_done()
+                async with state.applied:
+                    state.num_applied += len(chunks)
+                    state.applied.notify_all()
+
+    async def add(self, key, item):
+        '''Enqueues one item for the sketch of key'''
+        await self.add_many(key, [item])
+
+    async def add_many(self, key, items):
+        '''Enqueues a list or NumPy array (or any other iterable, which is copied into a
+        list) of items for the sketch of key'''
+        if not isinstance(items, (list, np.ndarray)):
+            items = list(items)
+        state = self._state(key)
+        await state.queue.put(items)
+        state.num_enqueued += 1
+
+    async def _query(self, fn, *keys):
+        '''Runs fn on the sketches of keys once every chunk enqueued so far was inserted'''
+        states = []
+        for key in keys:
+            if key not in self._keys:
+                raise KeyError(key)
+            state = self._keys[key]
+            target = state.num_enqueued
+            async with state.applied:
+                await state.applied.wait_for(lambda: state.num_applied >= target)
+            if state.error is not None:
+                error, state.error = state.error, None
+                raise error
+            states.append(state)
+        # Locks are taken in a fixed order, so concurrent queries on the same keys cannot deadlock
+        locked = sorted(set(states), key=id)
+        for state in locked:
+            await state.lock.acquire()
+        try:
+            return await asyncio.get_running_loop().run_in_executor(self.executor, fn, *(state.sketch for state in states))
+        finally:
+            for state in locked:
+                state.lock.release()
+
+    async def count(self, key):
+        '''Returns HyperMinHash.count of the sketch of key'''
+        return await self._query(HyperMinHash.count, key)
+
+    async def jaccard(self, key_a, key_b):
+        '''Returns HyperMinHash.jaccard of the sketches of two keys'''
+        return await self._query(HyperMinHash.jaccard, key_a, key_b)
+
+    async def intersection(self, key_a, key_b):
+        '''Returns HyperMinHash.intersection of the sketches of two keys'''
+        return await self._query(HyperMinHash.intersection, key_a, key_b)
+
+    async def sketch(self, key):
+        '''Returns a copy of the sketch of key, including every chunk enqueued so far'''
+        return await self._query(lambda sketch: HyperMinHash.deserialize(sketch.serialize()), key)
+
+    async def flush(self):
+        '''Waits until every enqueued chunk has been inserted'''
+        for state in list(self._keys.values()):
+            await state.queue.join()
+
+    async def close(self):
+        '''Flushes all queues and stops the consumer tasks'''
+        await self.flush()
+        for state in self._keys.values():
+            state.task.cancel()
+        await asyncio.gather(*(state.task for state in self._keys.values()), return_exceptions=True)
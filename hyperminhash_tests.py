@@ -1,9 +1,29 @@
 #!/usr/bin/env python3
 
+import asyncio
+import contextlib
+import gc
+import gzip
+import io
+import os
+import subprocess
+import sys
+import tempfile
 import unittest
+import unittest.mock
+import warnings
+import mmh3
 import numpy as np
-from hyperminhash import HyperMinHash
-from hyperminhash import packbits, unpackbits
+import hyperminhash
+from hyperminhash import HyperMinHash, SketchCollection, LSHIndex, PackedBuckets, WindowedHyperMinHash
+from hyperminhash import SketchStore, AsyncSketchService
+from hyperminhash import enable_instrumentation, disable_instrumentation, get_instrumentation
+from hyperminhash import packbits, unpackbits, hll_estimator, query_many
+from hyperminhash import hash_native, murmur3_x64_128, murmur3_x64_128_many
+from hyperminhash import collision_table, expected_collisions, expected_collisions_tabulated
+from hyperminhash import collision_estimate_final, collision_estimate_final_array, collision_estimate_hll_divided
+from hyperminhash import collision_estimate_hll_divided_array, estimate_collisions, estimate_collisions_array
+from hyperminhash import expected_collisions_tabulated_array
 
 def is_within_relerr(x, ex, relerr):
     return (x * (1-relerr) <= ex <= x*(1+relerr))
@@ -68,6 +88,39 @@ class BaseTestCases:
             self.assertTrue(np.array_equal(self.hmx.hll, hmy.hll))
         def test_self_equality(self):
             self.assertTrue(self.hmx == self.hmx)
+        def test_compressed_round_trip(self):
+            for compression in hyperminhash.COMPRESSORS:
+                bytes_array = self.hmx.serialize(compression=compression)
+                hmy = HyperMinHash.deserialize(bytes_array)
+                self.assertTrue(self.hmx == hmy)
+                self.assertEqual(self.hmx.count(), hmy.count())
+            with self.assertRaises(ValueError):
+                self.hmx.serialize(compression="snappy")
+            with self.assertRaises(ValueError):
+                HyperMinHash.deserialize(bytes_array[:-10])
+        def test_buffer_round_trip(self):
+            hmy = HyperMinHash.from_buffer(self.hmx.to_buffer())
+            self.assertTrue(self.hmx == hmy)
+            self.assertFalse(hmy.hll.flags.writeable)
+            self.assertEqual(self.hmx.count(), hmy.count())
+            self.assertEqual(self.hmx.jaccard(hmy), hmy.jaccard(self.hmx))
+            self.assertEqual(self.hmx.intersection(self.hmx), hmy.intersection(hmy))
+        def test_mmap_round_trip(self):
+            with tempfile.TemporaryDirectory() as tmpdir:
+                path = os.path.join(tmpdir, "sketch.hmh")
+                self.hmx.save_mmap(path)
+                hmy = HyperMinHash.open_mmap(path)
+                self.assertTrue(self.hmx == hmy)
+                self.assertEqual(self.hmx.count(), hmy.count())
+                with self.assertRaises(ValueError):
+                    hmy.merge_into(self.hmx)
+                del hmy
+                hmz = HyperMinHash.open_mmap(path, mode="r+")
+                hmz.update(["new item"])
+                hmz.hll.flush()
+                hmz.bbit.flush()
+                self.assertTrue(hmz == HyperMinHash.open_mmap(path))
+                del hmz
 
 class Test_HMH_1(BaseTestCases.TestHyperMinHash):
     def setUp(self):
@@ -93,6 +146,804 @@ class Test_Serialization2(BaseTestCases.TestSerialization):
     def setUp(self):
         self.setUp_with_params(314159000, 5000, 6, 0, 8, "false")
 
+class Test_BatchUpdate(unittest.TestCase):
+    def per_item_update(self, hmh, items):
+        for item in items:
+            i, val, aug = hmh.triple_hash(item)
+            if hmh.hll[i] > val:
+                pass
+            elif hmh.hll[i] < val or hmh.bbit[i] > aug:
+                hmh.hll[i] = val
+                hmh.bbit[i] = aug
+    def test_matches_per_item(self):
+        np.random.seed(314159006)
+        for params in [(8, 6, 8), (8, 0, 10), (4, 4, 4), (6, 0, 16)]:
+            batch = np.random.random(5000)
+            hmx = HyperMinHash(*params)
+            hmy = HyperMinHash(*params)
+            hmx.update(batch, batch_size=1000)
+            self.per_item_update(hmy, batch)
+            self.assertTrue(hmx == hmy, str(params))
+    def test_generator_input(self):
+        hmx = HyperMinHash(8, 6, 8)
+        hmy = HyperMinHash(8, 6, 8)
+        hmx.update((i for i in range(3000)), batch_size=512)
+        self.per_item_update(hmy, range(3000))
+        self.assertTrue(hmx == hmy)
+
+class Test_ParallelUpdate(unittest.TestCase):
+    def test_items(self):
+        np.random.seed(314159010)
+        batch = np.random.random(20000)
+        hmx = HyperMinHash(8, 6, 8)
+        hmx.update(batch)
+        hmy = HyperMinHash(8, 6, 8)
+        hmy.parallel_update(batch, workers=2, batch_size=3000)
+        self.assertTrue(hmx == hmy)
+    def test_files(self):
+        hmx = HyperMinHash(8, 4, 4)
+        with tempfile.TemporaryDirectory() as tmpdir:
+            paths = []
+            for k in range(3):
+                lines = ["item{}".format(i) for i in range(k * 1000, k * 1000 + 1500)]
+                hmx.update(lines)
+                paths.append(os.path.join(tmpdir, "items{}.txt".format(k)))
+                with open(paths[-1], "w") as f:
+                    f.write("\n".join(lines) + "\n")
+            hmy = HyperMinHash(8, 4, 4)
+            hmy.parallel_update(paths, workers=2, files=True)
+        self.assertTrue(hmx == hmy)
+
+class Test_ThreadedUpdate(unittest.TestCase):
+    def test_matches_update(self):
+        np.random.seed(314159027)
+        for hasher, batch in [("native", np.random.randint(0, 2**62, size=20000)), ("str", list(np.random.random(5000)))]:
+            hmx = HyperMinHash(8, 6, 8, hasher=hasher)
+            hmx.update(batch)
+            hmy = HyperMinHash(8, 6, 8, hasher=hasher, sparse=True)
+            hmy.threaded_update(batch, workers=3, batch_size=1500)
+            self.assertTrue(hmx == hmy, hasher)
+
+@unittest.skipIf(hyperminhash._kernel is None, "compiled kernel not built (see build_kernel.py)")
+class Test_Kernel(unittest.TestCase):
+    def test_hashes_match_numpy(self):
+        np.random.seed(314159028)
+        keys = [np.random.bytes(np.random.randint(0, 50)) for _ in range(300)]
+        h1, h2 = murmur3_x64_128_many(keys)
+        records = np.random.randint(0, 256, size=(100, 37)).astype(np.uint8)
+        r1, r2 = murmur3_x64_128(records)
+        with unittest.mock.patch.object(hyperminhash, "_kernel", None):
+            self.assertTrue(np.array_equal(np.stack(murmur3_x64_128_many(keys)), np.stack((h1, h2))))
+            self.assertTrue(np.array_equal(np.stack(murmur3_x64_128(records)), np.stack((r1, r2))))
+    def test_update_matches_numpy(self):
+        np.random.seed(314159029)
+        for params in [(8, 6, 8), (8, 0, 10), (4, 4, 4), (6, 0, 16), (10, 6, 40), (0, 6, 10), (4, 6, 60)]:
+            y, h2 = np.random.randint(0, 2**63, size=(2, 5000)).astype(np.uint64) * np.uint64(2)
+            y[::7] >>= np.uint64(50)
+            y[::11] = 0
+            hmx = HyperMinHash(*params)
+            hmx.register_histogram()
+            hmx.update_hashes(y, h2)
+            hmy = HyperMinHash(*params)
+            with unittest.mock.patch.object(hyperminhash, "_kernel", None):
+                hmy.update_hashes(y, h2)
+            self.assertTrue(np.array_equal(hmx.hll, hmy.hll) and np.array_equal(hmx.bbit, hmy.bbit), params)
+            self.assertTrue(np.array_equal(hmx.register_histogram(), np.bincount(hmx.hll, minlength=2**params[1] + 1)), params)
+    def test_read_only_falls_back(self):
+        hmx = HyperMinHash(8, 6, 8)
+        hmx.update(range(1000))
+        hmy = HyperMinHash.from_buffer(hmx.to_buffer())
+        self.assertFalse(hmy._kernel_buckets())
+        with self.assertRaises(ValueError):
+            hmy.update(range(1000, 2000))
+
+class Test_Instrumentation(unittest.TestCase):
+    def tearDown(self):
+        disable_instrumentation()
+    def test_counters(self):
+        instrumentation = enable_instrumentation()
+        self.assertTrue(get_instrumentation() is instrumentation)
+        hmx = HyperMinHash(8, 6, 8, collision_correction="precise")
+        hmx.update(range(3000))
+        hmy = HyperMinHash(8, 6, 8, sparse=True)
+        hmy.update(range(20))
+        hmy.update(range(10, 30))
+        data = hmx.serialize()
+        HyperMinHash.deserialize(data)
+        hmz = hmx + HyperMinHash.union_many([hmx, hmx])
+        hmz.merge_into(hmx)
+        hmx.intersection(hmz)
+        snapshot = instrumentation.snapshot()
+        counters = snapshot["counters"]
+        self.assertEqual(counters["items_ingested"], 3040)
+        self.assertEqual(counters["bucket_updates_applied"] + counters["bucket_updates_skipped"], 3040)
+        self.assertGreaterEqual(counters["bucket_updates_applied"], hmx.filled_buckets() + hmy.filled_buckets())
+        self.assertEqual(counters["serialized_bytes"], len(data))
+        self.assertEqual(counters["deserialized_bytes"], len(data))
+        self.assertEqual(counters["merges"], 6)  # +, 2 in union_many, merge_into, + in intersection and in jaccard
+        self.assertEqual(counters["comparisons_precise"], 1)
+        for operation in ["hash", "update", "count", "union", "serialize", "deserialize", "jaccard", "intersection", "collisions"]:
+            stats = snapshot["latencies"][operation]
+            self.assertEqual(sum(stats["buckets"]), stats["count"], operation)
+            self.assertGreater(stats["count"], 0, operation)
+        self.assertEqual(snapshot["latencies"]["intersection"]["count"], 1)
+        text = instrumentation.export_text()
+        self.assertIn("hyperminhash_items_ingested_total 3040\n", text)
+        self.assertIn('hyperminhash_operation_seconds_count{operation="intersection"} 1\n', text)
+        self.assertIn('hyperminhash_operation_seconds_bucket{operation="intersection",le="+Inf"} 1\n', text)
+    def test_same_counters_with_and_without_kernel(self):
+        snapshots = []
+        for kernel in [hyperminhash._kernel, None]:
+            with unittest.mock.patch.object(hyperminhash, "_kernel", kernel):
+                instrumentation = enable_instrumentation()
+                hmx = HyperMinHash(8, 6, 8, hasher="native")
+                hmx.update(np.arange(3000) % 700, batch_size=1000)
+                hmx.update(np.arange(5000, 5100))
+                snapshots.append(instrumentation.snapshot()["counters"])
+        self.assertEqual(snapshots[0], snapshots[1])
+        self.assertEqual(snapshots[0]["items_ingested"], 3100)
+    def test_disable_during_update(self):
+        class Disabling(hyperminhash.Instrumentation):
+            def add(self, name, value=1):
+                disable_instrumentation()
+                super().add(name, value)
+        instrumentation = enable_instrumentation(Disabling())
+        hmx = HyperMinHash(8, 6, 8)
+        hmx.update(range(100))
+        counters = instrumentation.snapshot()["counters"]
+        self.assertEqual(counters["items_ingested"], 100)
+        self.assertEqual(counters["bucket_updates_applied"] + counters["bucket_updates_skipped"], 100)
+    def test_merges_are_not_ingestion(self):
+        instrumentation = enable_instrumentation()
+        sketches = []
+        for kwargs in [{"sparse": True}, {"sparse": True}, {}, {"packed": True}]:
+            hmh = HyperMinHash(12, 6, 8, **kwargs)
+            hmh.update(range(len(sketches) * 100, len(sketches) * 100 + 200))
+            sketches.append(hmh)
+        self.assertTrue(sketches[0].is_sparse and sketches[1].is_sparse)
+        before = instrumentation.snapshot()["counters"]
+        for a in sketches:
+            for b in sketches:
+                a + b
+                HyperMinHash(12, 6, 8, sparse=True).merge_into(a).merge_into(b)
+        counters = instrumentation.snapshot()["counters"]
+        for name in ["items_ingested", "bucket_updates_applied", "bucket_updates_skipped"]:
+            self.assertEqual(counters.get(name), before.get(name), name)
+        self.assertEqual(counters["merges"], 3 * 16)
+    def test_disabled(self):
+        instrumentation = enable_instrumentation()
+        self.assertTrue(disable_instrumentation() is instrumentation)
+        hmx = HyperMinHash(8, 6, 8)
+        hmx.update(range(100))
+        hmx.count()
+        self.assertEqual(instrumentation.snapshot()["counters"], {})
+        self.assertEqual(instrumentation.snapshot()["latencies"], {})
+        self.assertTrue(get_instrumentation() is None)
+    def test_collections(self):
+        sketches = []
+        for k in range(4):
+            hmh = HyperMinHash(6, 4, 4)
+            hmh.update(range(k * 100, k * 100 + 500))
+            sketches.append(hmh)
+        instrumentation = enable_instrumentation()
+        SketchCollection(sketches, max_block_elements=64).jaccard_matrix()
+        query_many(sketches[0], sketches)
+        counters = instrumentation.snapshot()["counters"]
+        self.assertEqual(counters["comparisons_approx"], 10 + 4)
+        instrumentation.reset()
+        self.assertEqual(instrumentation.snapshot()["counters"], {})
+
+class Test_LazyImports(unittest.TestCase):
+    def test_optional_modules_not_loaded(self):
+        lazy = ["asyncio", "sqlite3", "argparse", "gzip", "decimal", "lzma", "bz2", "hyperminhash_services", "hyperminhash_cli"]
+        code = "import sys, hyperminhash; print(' '.join(m for m in {!r} if m in sys.modules))".format(lazy)
+        result = subprocess.run([sys.executable, "-c", code], cwd=os.path.dirname(os.path.abspath(hyperminhash.__file__)),
+                                check=True, stdout=subprocess.PIPE, universal_newlines=True)
+        self.assertEqual(result.stdout.strip(), "")
+    def test_lazy_attributes(self):
+        import hyperminhash_services
+        self.assertTrue(hyperminhash.SketchStore is hyperminhash_services.SketchStore)
+        self.assertTrue(AsyncSketchService is hyperminhash_services.AsyncSketchService)
+        with self.assertRaises(AttributeError):
+            hyperminhash.NoSuchAttribute
+
+class Test_Sparse(unittest.TestCase):
+    def make_pair(self, size, seed):
+        np.random.seed(seed)
+        items = np.random.randint(0, 5000, size=size)
+        hmd = HyperMinHash(10, 6, 10, collision_correction="precise")
+        hmd.update(items)
+        hms = HyperMinHash(10, 6, 10, collision_correction="precise", sparse=True)
+        hms.update(items[:size // 2])
+        hms.update(items[size // 2:])
+        return hmd, hms
+    def test_identical_results(self):
+        dx, sx = self.make_pair(50, 314159013)
+        dy, sy = self.make_pair(80, 314159014)
+        self.assertTrue(sx.is_sparse and sy.is_sparse)
+        self.assertTrue(sx == dx)
+        self.assertEqual(sx.count(), dx.count())
+        self.assertEqual(sx.count(estimator="improved"), dx.count(estimator="improved"))
+        self.assertEqual(sx.serialize(), dx.serialize())
+        for a, b in [(sx, sy), (sx, dy), (dx, sy)]:
+            self.assertEqual(a.jaccard(b), dx.jaccard(dy))
+            self.assertEqual(a.intersection(b), dx.intersection(dy))
+            self.assertTrue(a + b == dx + dy)
+        self.assertTrue((sx + sy).is_sparse)
+    def test_merge_into(self):
+        dx, sx = self.make_pair(50, 314159015)
+        dy, sy = self.make_pair(2000, 314159016)
+        sx += sy
+        self.assertTrue(sx == dx + dy)
+        hmz = HyperMinHash(10, 6, 10, collision_correction="precise")
+        hmz += self.make_pair(30, 314159017)[1]
+        self.assertTrue(hmz == self.make_pair(30, 314159017)[0])
+    def test_converts_to_dense(self):
+        dx, sx = self.make_pair(5000, 314159018)
+        self.assertFalse(sx.is_sparse)
+        self.assertTrue(sx == dx)
+        self.assertTrue(HyperMinHash.deserialize(dx.serialize(), sparse=True).is_sparse is False)
+        dy, sy = self.make_pair(20, 314159019)
+        hmy = HyperMinHash.deserialize(dy.serialize(), sparse=True)
+        self.assertTrue(hmy.is_sparse and hmy == dy)
+        self.assertTrue(dy.to_sparse().is_sparse and dy == sy)
+
+class Test_Compression(unittest.TestCase):
+    def test_smaller_than_packed_fields(self):
+        for size in [100, 10**5]:
+            hmx = HyperMinHash(14, 6, 10, hasher="native")
+            hmx.update(np.arange(size))
+            for compression in hyperminhash.COMPRESSORS:
+                bytes_array = hmx.serialize(compression=compression)
+                self.assertLess(len(bytes_array), 0.9 * len(hmx.serialize()))
+                self.assertTrue(HyperMinHash.deserialize(bytes_array) == hmx)
+            self.assertTrue(HyperMinHash.deserialize(hmx.serialize(compression="zlib"), sparse=True).is_sparse == (size == 100))
+
+class Test_Packed(unittest.TestCase):
+    def make_pair(self, params, size, seed):
+        np.random.seed(seed)
+        items = np.random.randint(0, 10**6, size=size)
+        hmd = HyperMinHash(*params, collision_correction="precise")
+        hmd.update(items)
+        hmp = HyperMinHash(*params, collision_correction="precise", packed=True)
+        hmp.update(items[:size // 2])
+        hmp.update(items[size // 2:])
+        return hmd, hmp
+    def test_packed_buckets(self):
+        # Widths that do and do not divide 64, so fields straddle words
+        for hllbits, bbitbits in [(7, 10), (5, 4), (1, 0), (7, 57), (1, 63)]:
+            packed = PackedBuckets(1000, hllbits, bbitbits)
+            hll = np.random.randint(0, 2**hllbits, size=1000)
+            bbit = np.random.randint(0, 2**min(bbitbits, 62), size=1000).astype(np.uint64)
+            bbit[0] = 2**bbitbits - 1
+            packed.set_all(hll, bbit)
+            idx = np.random.choice(1000, size=300, replace=False)
+            hll[idx] = np.random.randint(0, 2**hllbits, size=300)
+            packed.set(idx, hll[idx], bbit[idx])
+            got_hll, got_bbit = packed.get_all()
+            self.assertTrue(np.array_equal(got_hll, hll) and np.array_equal(got_bbit, bbit))
+            self.assertEqual(packed.nbytes, 8 * (-(-1000 * (hllbits + bbitbits) // 64) + 1))
+        with self.assertRaises(ValueError):
+            PackedBuckets(10, 7, 58)
+    def test_identical_results(self):
+        for params in [(6, 4, 4), (6, 0, 8), (5, 0, 16), (10, 6, 10)]:
+            dx, px = self.make_pair(params, 3000, 314159020)
+            dy, py = self.make_pair(params, 5000, 314159021)
+            self.assertTrue(px.is_packed and px == dx)
+            self.assertEqual(px.count(), dx.count())
+            self.assertEqual(px.filled_buckets(), dx.filled_buckets())
+            self.assertEqual(px.serialize(), dx.serialize())
+            for a, b in [(px, py), (px, dy), (dx, py)]:
+                self.assertEqual(a.jaccard(b), dx.jaccard(dy))
+                self.assertEqual(a.intersection(b), dx.intersection(dy))
+                self.assertTrue(a + b == dx + dy)
+            self.assertTrue((px + py).is_packed)
+            px += py
+            self.assertTrue(px.is_packed and px == dx + dy)
+    def test_update_union(self):
+        dx, px = self.make_pair((10, 6, 10), 3000, 314159030)
+        dy, py = self.make_pair((10, 6, 10), 5000, 314159031)
+        for kernel in [hyperminhash._kernel, None]:
+            with unittest.mock.patch.object(hyperminhash, "_kernel", kernel):
+                union = px + py
+                self.assertTrue(union.is_packed and union._hll is None and union._bbit is None)
+                expected = dx + dy
+                union.update(range(10**6, 10**6 + 4000))
+                expected.update(range(10**6, 10**6 + 4000))
+                self.assertTrue(union == expected)
+                self.assertEqual(union.filled_buckets(), expected.filled_buckets())
+    def test_conversions(self):
+        dx, px = self.make_pair((10, 6, 10), 200, 314159022)
+        sx = HyperMinHash(10, 6, 10, collision_correction="precise", sparse=True)
+        sx.merge_into(px)
+        self.assertTrue(sx == dx)
+        self.assertTrue(sx.to_packed().is_packed and sx == dx)
+        px.merge_into(HyperMinHash.deserialize(dx.serialize(), sparse=True))
+        self.assertTrue(px == dx)
+        self.assertTrue(px.to_sparse().is_sparse and px == dx)
+        self.assertTrue(dx.to_packed()._packed.nbytes < (1 + 2) * 2**10)
+        self.assertFalse(dx.to_dense().is_packed)
+        with self.assertRaises(ValueError):
+            HyperMinHash(10, 6, 10, sparse=True, packed=True)
+
+class Test_Windowed(unittest.TestCase):
+    def setUp(self):
+        np.random.seed(314159023)
+        self.batches = [np.random.randint(0, 10**6, size=size) for size in [100, 5000, 20, 3000, 700]]
+        self.hmw = WindowedHyperMinHash(10, 6, 10, epochs=3, hasher="native")
+        for epoch, batch in enumerate(self.batches):
+            self.hmw.update(batch, epoch=epoch)
+    def sketch_of(self, batches):
+        hmh = HyperMinHash(10, 6, 10, hasher="native")
+        for batch in batches:
+            hmh.update(batch)
+        return hmh
+    def test_window(self):
+        self.assertEqual(self.hmw.current_epoch, 4)
+        self.assertEqual(len(self.hmw.sketches), 3)
+        for window in [1, 2, 3]:
+            expected = self.sketch_of(self.batches[-window:])
+            self.assertTrue(self.hmw.window(window) == expected)
+            self.assertEqual(self.hmw.count(window), expected.count())
+        self.hmw.update(self.batches[0])
+        self.assertTrue(self.hmw.window(2) == self.sketch_of(self.batches[-2:] + self.batches[:1]))
+        with self.assertRaises(ValueError):
+            self.hmw.window(4)
+        with self.assertRaises(ValueError):
+            self.hmw.advance_to(3)
+        with self.assertRaises(ValueError):
+            self.hmw.advance(-1)
+        self.assertEqual(self.hmw.current_epoch, 4)
+    def test_advance(self):
+        self.hmw.advance_to(6)
+        self.assertEqual(self.hmw.count(1), 0)
+        self.assertTrue(self.hmw.window() == self.sketch_of(self.batches[-1:]))
+        self.hmw.advance(10)
+        self.assertEqual(self.hmw.count(), 0)
+        self.assertEqual(len(self.hmw.sketches), 3)
+    def test_compare(self):
+        other = WindowedHyperMinHash(10, 6, 10, epochs=3, hasher="native")
+        other.update(self.batches[3])
+        other.advance()
+        other.update(self.batches[2])
+        x, y = self.sketch_of(self.batches[-2:]), self.sketch_of(self.batches[2:4])
+        self.assertEqual(self.hmw.jaccard(other, window=2), x.jaccard(y))
+        self.assertEqual(self.hmw.intersection(other, window=2), x.intersection(y))
+        self.assertEqual(self.hmw.jaccard(y, window=2), x.jaccard(y))
+
+class Test_SketchStore(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmpdir.name, "sketches.db")
+        np.random.seed(314159024)
+        self.batches = [np.random.randint(0, 10**6, size=size) for size in [50, 3000, 200, 5000]]
+    def tearDown(self):
+        self.tmpdir.cleanup()
+    def expected(self, batches):
+        hmh = HyperMinHash(10, 6, 10, hasher="native")
+        for batch in batches:
+            hmh.update(batch)
+        return hmh
+    def test_merge_update(self):
+        # A budget of about one dense sketch and tiny write batches exercise eviction and write-back
+        with SketchStore(self.path, 10, 6, 10, hasher="native", cache_bytes=4000, write_batch_size=2) as store:
+            for k, batch in enumerate(self.batches):
+                store.merge_update("user{}".format(k % 3), batch)
+            self.assertTrue(store["user0"] == self.expected([self.batches[0], self.batches[3]]))
+            self.assertLessEqual(len(store._cache), 2)
+        with SketchStore(self.path, 10, 6, 10, hasher="native", compression="zlib") as store:
+            self.assertEqual(len(store), 3)
+            self.assertEqual(sorted(store.keys()), ["user0", "user1", "user2"])
+            self.assertTrue(store["user1"] == self.expected([self.batches[1]]))
+            store.merge_update("user2", self.batches[0])
+            store.merge("user3", self.expected(self.batches[:2]))
+        with SketchStore(self.path, 10, 6, 10, hasher="native") as store:
+            self.assertTrue(store["user2"] == self.expected([self.batches[2], self.batches[0]]))
+            self.assertTrue(store.get("user3") == self.expected(self.batches[:2]))
+    def test_put_and_delete(self):
+        with SketchStore(self.path, 10, 6, 10, hasher="native") as store:
+            store["a"] = self.expected(self.batches[:1])
+            self.assertTrue("a" in store and "b" not in store)
+            self.assertIsNone(store.get("b"))
+            with self.assertRaises(KeyError):
+                store["b"]
+            store.flush()
+            del store["a"]
+            self.assertEqual(len(store), 0)
+            with self.assertRaises(KeyError):
+                del store["a"]
+
+class Test_AsyncSketchService(unittest.TestCase):
+    def setUp(self):
+        np.random.seed(314159025)
+        self.items = {key: np.random.randint(0, 10**5, size=3000) for key in ["a", "b"]}
+    def expected(self, key):
+        hmh = HyperMinHash(10, 6, 10)
+        hmh.update(self.items[key])
+        return hmh
+    async def produce(self, service, key, chunk_size):
+        items = self.items[key]
+        for start in range(0, len(items), chunk_size):
+            await service.add_many(key, list(items[start:start + chunk_size]))
+        await service.add(key, items[0])
+    def test_concurrent_producers(self):
+        async def run():
+            async with AsyncSketchService(10, 6, 10, batch_size=500, max_queue=4) as service:
+                await asyncio.gather(self.produce(service, "a", 7), self.produce(service, "b", 100),
+                                     self.produce(service, "a", 1000))
+                for key in ["a", "b"]:
+                    self.assertLessEqual(service._keys[key].queue.qsize(), 4)
+                return (await service.count("a"), await service.jaccard("a", "b"), await service.intersection("b", "a"),
+                        await service.sketch("b"), await service.jaccard("a", "a"))
+        count, jaccard, intersection, sketch, self_jaccard = asyncio.run(run())
+        self.assertEqual(count, self.expected("a").count())
+        self.assertEqual(jaccard, self.expected("a").jaccard(self.expected("b")))
+        self.assertEqual(intersection, self.expected("b").intersection(self.expected("a")))
+        self.assertTrue(sketch == self.expected("b"))
+        self.assertEqual(self_jaccard, self.expected("a").jaccard(self.expected("a")))
+    def test_errors(self):
+        async def run():
+            async with AsyncSketchService(10, 6, 10, hasher="native") as service:
+                with self.assertRaises(KeyError):
+                    await service.count("a")
+                await service.add("a", object())
+                with self.assertRaises(TypeError):
+                    await service.count("a")
+                self.assertEqual(await service.count("a"), 0)
+        asyncio.run(run())
+    def test_bad_chunk_in_batch(self):
+        async def run():
+            async with AsyncSketchService(10, 6, 10, hasher="native", batch_size=10**6) as service:
+                await service.add_many("a", iter(self.items["a"][:1000]))
+                await service.add_many("a", [object()])
+                await service.add_many("a", (item for item in self.items["a"][1000:]))
+                with self.assertRaises(TypeError):
+                    await service.count("a")
+                self.assertEqual(service._keys["a"].num_applied, 3)
+                return await service.sketch("a")
+        sketch = asyncio.run(run())
+        expected = HyperMinHash(10, 6, 10, hasher="native")
+        expected.update(self.items["a"])
+        self.assertTrue(sketch == expected)
+
+class Test_Hashers(unittest.TestCase):
+    def test_murmur_matches_mmh3(self):
+        keys = [bytes(range(length)) for length in range(40)] + [b"hyperminhash", "\u00e9".encode()]
+        h1, h2 = murmur3_x64_128_many(keys)
+        for key, x, y in zip(keys, h1, h2):
+            expected = [h & (2**64 - 1) for h in mmh3.hash64(key)]
+            self.assertEqual([int(x), int(y)], expected)
+    def test_native_types_agree(self):
+        values = [0, 1, 300, -5]
+        expected = hash_native(np.array(values, dtype=np.int64))
+        for other in [values, np.array(values, dtype=np.int32), [np.int16(v) for v in values]]:
+            self.assertTrue(np.array_equal(hash_native(other)[0], expected[0]))
+        self.assertTrue(np.array_equal(hash_native(np.array([2**40]))[0], hash_native([2**40])[0]))
+        self.assertTrue(np.array_equal(hash_native(np.array([2**64 - 1], dtype=np.uint64))[0], hash_native([2**64 - 1])[0]))
+        floats = np.random.random(100)
+        self.assertTrue(np.array_equal(hash_native(floats)[1], hash_native(list(floats))[1]))
+        self.assertTrue(np.array_equal(hash_native(["abc", b"abc"])[0], hash_native([bytearray(b"abc")] * 2)[0]))
+        with self.assertRaises(TypeError):
+            hash_native([object()])
+    def test_native_sketch(self):
+        np.random.seed(314159011)
+        batch = np.random.random(20000)
+        hmx = HyperMinHash(8, 6, 8, hasher="native")
+        hmx.update(batch)
+        hmy = HyperMinHash(8, 6, 8, hasher="native")
+        for item in batch[:100]:
+            hmy.update_triples(*[np.array([x]) for x in hmy.triple_hash(item)])
+        hmy.update(list(batch[100:]))
+        self.assertTrue(hmx == hmy)
+        self.assertTrue(is_within_relerr(20000, hmx.count(), 2 / np.sqrt(2**8)))
+    def test_refuse_mixed_hashers(self):
+        hmx = HyperMinHash(8, 6, 8, hasher="native")
+        hmy = HyperMinHash(8, 6, 8)
+        hmx.update(range(100))
+        hmy.update(range(100))
+        self.assertTrue(hmx != hmy)
+        for combine in [lambda: hmx + hmy, lambda: hmx.jaccard(hmy), lambda: hmy.merge_into(hmx)]:
+            with self.assertRaises(ValueError):
+                combine()
+    def test_hasher_serialization(self):
+        hmx = HyperMinHash(8, 6, 8, hasher="native")
+        hmx.update(range(1000))
+        self.assertTrue(HyperMinHash.deserialize(hmx.serialize()) == hmx)
+        self.assertTrue(HyperMinHash.from_buffer(hmx.to_buffer()) == hmx)
+        hmy = HyperMinHash(8, 6, 8)
+        self.assertEqual(HyperMinHash.deserialize(hmy.serialize()).hasher, "str")
+
+class Test_Union(unittest.TestCase):
+    def setUp(self):
+        np.random.seed(314159007)
+        self.sketches = []
+        for _ in range(5):
+            hmh = HyperMinHash(6, 4, 4)
+            hmh.update(np.random.randint(0, 3000, size=1000))
+            self.sketches.append(hmh)
+    def loop_union(self, hmx, hmy):
+        result = HyperMinHash(hmx.bucketbits, hmx.bucketsize, hmx.subbucketsize)
+        for i in range(len(result.hll)):
+            if hmx.hll[i] == hmy.hll[i]:
+                result.hll[i] = hmx.hll[i]
+                result.bbit[i] = min(hmx.bbit[i], hmy.bbit[i])
+            elif hmx.hll[i] < hmy.hll[i]:
+                result.hll[i] = hmy.hll[i]
+                result.bbit[i] = hmy.bbit[i]
+            else:
+                result.hll[i] = hmx.hll[i]
+                result.bbit[i] = hmx.bbit[i]
+        return result
+    def test_add_matches_loop(self):
+        hmx, hmy = self.sketches[:2]
+        self.assertTrue(hmx + hmy == self.loop_union(hmx, hmy))
+    def test_iadd(self):
+        hmx, hmy = self.sketches[:2]
+        expected = hmx + hmy
+        hll = hmx.hll
+        hmx += hmy
+        self.assertTrue(hmx == expected)
+        self.assertTrue(hmx.hll is hll)
+    def test_union_many(self):
+        expected = self.sketches[0]
+        for hmh in self.sketches[1:]:
+            expected = expected + hmh
+        self.assertTrue(HyperMinHash.union_many(self.sketches) == expected)
+        self.assertTrue(HyperMinHash.union_many(self.sketches, chunk_size=2) == expected)
+
+class Test_Count(unittest.TestCase):
+    def test_hll_estimator_histogram(self):
+        np.random.seed(314159012)
+        buckets = np.random.randint(0, 20, size=1024).astype(np.uint8)
+        expected = hll_estimator(buckets.astype(np.float64))
+        self.assertAlmostEqual(hll_estimator(buckets), expected, delta=1e-9 * expected)
+        self.assertAlmostEqual(hll_estimator(list(buckets)), expected, delta=1e-9 * expected)
+    def test_cached_count(self):
+        hmx = HyperMinHash(8, 6, 8)
+        hmx.update(range(1000))
+        first = hmx.count()
+        self.assertEqual(hmx._cached_count, first)
+        hmx.update(range(1000))
+        self.assertEqual(hmx._cached_count, first)
+        hmx.update(range(1000, 3000))
+        self.assertIsNone(hmx._cached_count)
+        self.assertTrue(hmx.count() > first)
+        hmy = HyperMinHash(8, 6, 8)
+        hmy.update(range(5000, 9000))
+        before = hmx.count()
+        hmx += hmy
+        self.assertTrue(hmx.count() > before)
+    def test_improved_estimator(self):
+        for size in [0, 10, 500, 5000, 100000]:
+            hmx = HyperMinHash(8, 6, 10, hasher="native")
+            hmx.update(np.arange(size))
+            self.assertTrue(is_within_relerr(size, hmx.count(estimator="improved"), 3 / np.sqrt(2**8)), size)
+        self.assertEqual(HyperMinHash(8, 4, 4).count(estimator="improved"), 0)
+    def test_incremental_histogram(self):
+        hmx = HyperMinHash(8, 4, 4)
+        hmx.update(range(1000))
+        hmx.register_histogram()
+        hmx.update(range(500, 3000))
+        self.assertTrue(np.array_equal(hmx.register_histogram(), np.bincount(hmx.hll, minlength=17)))
+    def test_assign_buckets(self):
+        hmy = HyperMinHash(8, 6, 8)
+        hmy.update(range(5000, 5300))
+        for kwargs in [{}, {"sparse": True}, {"packed": True}]:
+            hmx = HyperMinHash(8, 6, 8, **kwargs)
+            hmx.update(range(1000))
+            first = hmx.count()
+            hmx.register_histogram()
+            hmx.hll = hmy.hll.copy()
+            hmx.bbit = hmy.bbit.copy()
+            self.assertNotEqual(hmx.count(), first, kwargs)
+            self.assertEqual(hmx.count(), hmy.count(), kwargs)
+            self.assertTrue(np.array_equal(hmx.register_histogram(), np.bincount(hmy.hll, minlength=65)), kwargs)
+            hmx.hll = np.zeros_like(hmy.hll)
+            hmx.bbit = np.zeros_like(hmy.bbit)
+            self.assertEqual(hmx.count(), 0, kwargs)
+        hmx = HyperMinHash(8, 6, 8, packed=True)
+        hmx.update(range(1000))
+        filled = hmx.filled_buckets()
+        hmx.hll[:] = 0  # writes into a copy
+        self.assertEqual(hmx.filled_buckets(), filled)
+    def test_minhash_branch(self):
+        hmx = HyperMinHash(6, 0, 10)
+        hmx.update(range(5000))
+        vals = hmx.bbit.astype(np.float64) / 2**10
+        self.assertAlmostEqual(hmx.count(), 64 * 64 / sum(vals), delta=1e-9)
+
+class Test_CollisionTable(unittest.TestCase):
+    def test_matches_decimal(self):
+        for bucketbits, bucketsize, abb1 in [(0, 0, 4), (4, 4, 4), (6, 6, 4), (8, 6, 8)]:
+            for x_size, y_size in [(1, 1), (10, 1000), (1000, 1000), (1e6, 3e5), (2.5e9, 1e9), (1e15, 1e12)]:
+                exact = float(expected_collisions(x_size, y_size, bucketbits, bucketsize, abb1))
+                fast = expected_collisions_tabulated(x_size, y_size, bucketbits, bucketsize, abb1)
+                self.assertTrue(is_within_relerr(exact, fast, 1e-9), (bucketbits, bucketsize, abb1, x_size, y_size))
+    def test_empty(self):
+        self.assertEqual(expected_collisions_tabulated(0, 100, 4, 4, 4), 0)
+    def test_table_is_cached(self):
+        self.assertTrue(collision_table(5, 4, 4) is collision_table(5, 4, 4))
+
+class Test_CollisionArrays(unittest.TestCase):
+    sizes = np.array([0., 1., 10., 1000., 5e4, 1e6, 3e9, 1e30])
+    def check(self, params, array_fn, scalar_fn):
+        estimates, valid = array_fn(self.sizes[:, np.newaxis], self.sizes[np.newaxis, :], *params)
+        self.assertEqual(estimates.shape, (len(self.sizes), len(self.sizes)))
+        for r, x_size in enumerate(self.sizes):
+            for c, y_size in enumerate(self.sizes):
+                try:
+                    with np.errstate(divide="ignore", invalid="ignore"):
+                        expected = scalar_fn(x_size, y_size, *params)
+                except ValueError:
+                    self.assertFalse(valid[r, c])
+                    self.assertTrue(np.isnan(estimates[r, c]))
+                    continue
+                self.assertTrue(valid[r, c])
+                if not np.isnan(expected):
+                    self.assertTrue(is_within_relerr(expected, estimates[r, c], 1e-6) or abs(expected) < 1e-300, (params, x_size, y_size))
+        return valid
+    def test_final(self):
+        for params in [(4, 0, 4), (6, 4, 4), (10, 6, 10)]:
+            valid = self.check(params, collision_estimate_final_array, collision_estimate_final)
+            self.assertFalse(valid.all())
+    def test_hll_divided(self):
+        for params in [(0, 0, 4), (6, 4, 4), (10, 6, 10)]:
+            fn = lambda x, y, *p: (collision_estimate_hll_divided_array(x, y, *p), np.ones((len(x), len(y[0])), dtype=bool))
+            self.check(params, fn, collision_estimate_hll_divided)
+    def test_precise(self):
+        for params in [(4, 4, 4), (8, 6, 8)]:
+            fn = lambda x, y, *p: estimate_collisions_array("precise", x, y, *p)
+            valid = self.check(params, fn, lambda x, y, *p: estimate_collisions("precise", x, y, *p))
+            self.assertTrue(valid.all())
+    def test_precise_blocks(self):
+        x, y = np.arange(50.) * 100, np.arange(1., 40.) * 300
+        blocked = expected_collisions_tabulated_array(x[:, np.newaxis], y, 6, 4, 4, max_block_elements=1)
+        self.assertTrue(np.allclose(blocked, expected_collisions_tabulated_array(x[:, np.newaxis], y, 6, 4, 4), rtol=1e-12, atol=0))
+
+class Test_SketchCollection(unittest.TestCase):
+    def setUp(self):
+        np.random.seed(314159008)
+        self.sketches = []
+        for size in [0, 500, 1000, 2000, 3000, 4000, 2500]:
+            hmh = HyperMinHash(6, 4, 4, collision_correction="precise")
+            hmh.update(np.random.randint(0, 5000, size=size))
+            self.sketches.append(hmh)
+        self.collection = SketchCollection(self.sketches, max_block_elements=1000)
+    def test_jaccard_matrix(self):
+        expected = np.array([[a.jaccard(b) for b in self.sketches] for a in self.sketches])
+        self.assertTrue(np.allclose(self.collection.jaccard_matrix(), expected, rtol=1e-12, atol=0))
+    def test_intersection_matrix(self):
+        expected = np.array([[a.intersection(b)[0] for b in self.sketches] for a in self.sketches])
+        self.assertTrue(np.allclose(self.collection.intersection_matrix(), expected, rtol=1e-12, atol=0))
+    def test_union_cardinalities(self):
+        # Same estimator as intersection, so union cardinalities agree exactly
+        minhash_sketches = []
+        for size in [0, 300, 3000]:
+            hmh = HyperMinHash(6, 0, 8, collision_correction="false")
+            hmh.update(range(size))
+            minhash_sketches.append(hmh)
+        np.random.seed(314159036)
+        large_sketches = []
+        for size in np.random.randint(1000, 20000, size=12):
+            hmh = HyperMinHash(10, 6, 10, collision_correction="false")
+            hmh.update(np.random.randint(0, 10**6, size=size))
+            large_sketches.append(hmh)
+        for sketches in [self.sketches, minhash_sketches, large_sketches]:
+            collection = SketchCollection(sketches, max_block_elements=5000)
+            for rows, cols in collection._block_pairs():
+                union_cardinality = collection._compare_block(rows, cols, union_counts=True)[3]
+                expected = [[a.intersection(b)[3] for b in sketches[cols]] for a in sketches[rows]]
+                self.assertTrue(np.array_equal(union_cardinality, expected))
+    def test_pairs_above(self):
+        expected = [(i, j) for i, a in enumerate(self.sketches) for j, b in enumerate(self.sketches)
+                    if i < j and a.jaccard(b) >= 0.3]
+        pairs = self.collection.pairs_above(0.3)
+        self.assertEqual([(i, j) for i, j, _ in pairs], expected)
+
+class Test_QueryMany(unittest.TestCase):
+    def test_matches_intersection(self):
+        np.random.seed(314159026)
+        for params, collision_correction in [((6, 4, 4), "precise"), ((6, 0, 8), "false"), ((10, 6, 10), "approx"), ((5, 0, 16), "precise")]:
+            query = HyperMinHash(*params, collision_correction=collision_correction)
+            query.update(np.random.randint(0, 5000, size=2000))
+            candidates = []
+            for size in [0, 10, 500, 2000, 4000, 20000]:
+                candidate = HyperMinHash(*params, collision_correction=collision_correction, sparse=(size == 10))
+                candidate.update(np.random.randint(0, 5000, size=size))
+                candidates.append(candidate)
+            candidates.append(query)
+            expected = np.array([query.intersection(candidate) for candidate in candidates])
+            result = query_many(query, candidates, max_block_elements=3 * 2**params[0])
+            for k in range(4):
+                self.assertTrue(np.allclose(result[k], expected[:, k], rtol=1e-12, atol=0), (params, k))
+            self.assertTrue(np.array_equal(result[2], expected[:, 2]), params)
+        with self.assertRaises(ValueError):
+            query_many(query, [HyperMinHash(*params, hasher="native")])
+
+class Test_LSHIndex(unittest.TestCase):
+    def setUp(self):
+        np.random.seed(314159009)
+        base = np.arange(3000)
+        self.sketches = {}
+        for key, keep in enumerate([1.0, 0.95, 0.9, 0.5, 0.2]):
+            hmh = HyperMinHash(8, 6, 10)
+            hmh.update(base[np.random.random(len(base)) < keep])
+            self.sketches[key] = hmh
+        hmh = HyperMinHash(8, 6, 10)
+        hmh.update(np.arange(10000, 13000))
+        self.sketches["disjoint"] = hmh
+        self.index = LSHIndex(8, 6, 10, rows_per_band=4)
+        for key, hmh in self.sketches.items():
+            self.index.insert(key, hmh)
+    def test_query(self):
+        query = self.sketches[0]
+        expected = set(key for key, hmh in self.sketches.items() if query.jaccard(hmh) >= 0.7)
+        results = self.index.query(query, 0.7)
+        self.assertEqual(set(key for key, _ in results), expected)
+        self.assertEqual(results[0][0], 0)
+        self.assertNotIn("disjoint", self.index.candidates(query))
+    def test_remove(self):
+        self.index.remove(1)
+        self.assertEqual(len(self.index), len(self.sketches) - 1)
+        self.assertNotIn(1, self.index)
+        self.assertNotIn(1, self.index.candidates(self.sketches[0]))
+        for key in list(self.sketches):
+            if key != 1:
+                self.index.remove(key)
+        self.assertTrue(all(len(table) == 0 for table in self.index.tables))
+
+class Test_CommandLine(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.lines = ["line {}".format(i) for i in range(5000)]
+        self.plain = os.path.join(self.tmpdir.name, "items.txt")
+        with open(self.plain, "w") as f:
+            f.write("\n".join(self.lines[:3000]) + "\n")
+        self.gzipped = os.path.join(self.tmpdir.name, "items.txt.gz")
+        with gzip.open(self.gzipped, "wt") as f:
+            f.write("\n".join(self.lines[2000:]))
+    def tearDown(self):
+        self.tmpdir.cleanup()
+    def path(self, name):
+        return os.path.join(self.tmpdir.name, name)
+    def test_build_and_merge(self):
+        hyperminhash.main(["build", self.plain, "-o", self.path("a.hmh"), "--bucketbits", "8", "--chunk-bytes", "100"])
+        hyperminhash.main(["build", self.gzipped, "-o", self.path("b.hmh"), "--bucketbits", "8"])
+        hyperminhash.main(["merge", self.path("a.hmh"), self.path("b.hmh"), "-o", self.path("u.hmh"), "--compression", "zlib"])
+        hmx = HyperMinHash(8, 6, 10)
+        hmx.update(self.lines[:3000])
+        self.assertTrue(hmx == hyperminhash.load_sketch(self.path("a.hmh")))
+        hmx.update(self.lines[2000:])
+        self.assertTrue(hmx == hyperminhash.load_sketch(self.path("u.hmh")))
+    def test_count_and_jaccard(self):
+        hyperminhash.main(["build", self.plain, "-o", self.path("a.hmh"), "--bucketbits", "8"])
+        hyperminhash.main(["build", self.gzipped, "-o", self.path("b.hmh"), "--bucketbits", "8"])
+        out = io.StringIO()
+        with contextlib.redirect_stdout(out):
+            hyperminhash.main(["count", self.path("a.hmh")])
+            hyperminhash.main(["jaccard", self.path("a.hmh"), self.path("b.hmh")])
+        count_line, jaccard_line = out.getvalue().splitlines()
+        hma = hyperminhash.load_sketch(self.path("a.hmh"))
+        hmb = hyperminhash.load_sketch(self.path("b.hmh"))
+        self.assertEqual(float(count_line.split("\t")[1]), hma.count())
+        self.assertEqual(float(jaccard_line.split("\t")[2]), hma.jaccard(hmb))
+    def test_closes_inputs(self):
+        for path in [self.plain, self.gzipped]:
+            with warnings.catch_warnings(record=True) as caught:
+                warnings.simplefilter("always", ResourceWarning)
+                batches = list(hyperminhash.read_item_batches(path, chunk_bytes=100))
+                gc.collect()
+            self.assertEqual([w for w in caught if issubclass(w.category, ResourceWarning)], [], path)
+            self.assertEqual(sum(map(len, batches)), 3000)
+    def test_binary_records(self):
+        records = np.arange(1000, dtype=np.uint32)
+        with open(self.path("records.bin"), "wb") as f:
+            f.write(records.tobytes())
+        hyperminhash.main(["build", self.path("records.bin"), "-o", self.path("r.hmh"), "--bucketbits", "8", "--record-size", "4", "--chunk-bytes", "10"])
+        hmx = HyperMinHash(8, 6, 10)
+        hmx.update([records[i:i + 1].tobytes() for i in range(len(records))])
+        self.assertTrue(hmx == hyperminhash.load_sketch(self.path("r.hmh")))
+
 class Test_PackBits(unittest.TestCase):
     def test_round_trip(self):
         A=[32,15,55,29,100,121,4,3,23,56,56,78]
@@ -107,6 +958,20 @@ class Test_PackBits(unittest.TestCase):
         (b, L) = unpackbits(X)
         A = np.array(A)
         self.assertTrue(np.array_equal(A, L))
+    def test_known_bytes(self):
+        # Output of the original bitstring-based packer
+        X = packbits(7, [32, 15, 55, 29, 100, 121, 4, 3, 23, 56, 56, 78])
+        self.assertEqual(X[16:], b'@=\xb9\xdc\x9eB\x03.\xe1\xc4\xe0')
+        X = packbits(3, [5])
+        self.assertEqual(X, b'\x03' + b'\x00' * 7 + b'\x01' + b'\x00' * 7 + b'\xa0')
+    def test_round_trip_64(self):
+        A = [2**64 - 1, 5, 2**63 + 7, 0]
+        (b, L) = unpackbits(packbits(64, A))
+        self.assertEqual(b, 64)
+        self.assertEqual([int(x) for x in L], A)
+    def test_too_wide(self):
+        with self.assertRaises(ValueError):
+            packbits(4, [16])
 
 
 